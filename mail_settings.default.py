@@ -11,4 +11,5 @@ MAIL_USE_SSL = False
 MAIL_USERNAME = "mymail@mydomain.com"
 MAIL_PASSWORD = "my_secret_password"
 MAIL_DEFAULT_SENDER = ("Me", "mymail@mydomain.com")
+# Batch mails share one smtp connection, renewed every MAIL_MAX_EMAILS mails. None: one connection per batch
 MAIL_MAX_EMAILS = None
@@ -5,14 +5,35 @@ Mini application to manage apache htpasswd file
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
 
-import subprocess
-import string
+import atexit
+import csv
+import functools
+import hashlib
+import importlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import smtplib
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from os.path import dirname, join
-from re import match
+from re import fullmatch, match
 
-from flask import Flask, render_template, request, redirect, url_for
-import htpasswd
-import random
+from flask import Flask, Response, g, jsonify, render_template, request, redirect, stream_with_context, url_for
+
+from pydentity_auth import CredentialCache, authenticate, required_groups
+from pydentity_dbm import DbmFile
+from pydentity_journal import Journal
+from pydentity_mail import MailQueue, MailSpool
+from pydentity_metrics import MAIL_BATCH_SIZE, MAIL_FAILURES, MAIL_SEND_SECONDS, PAGE_CACHE_REQUESTS, REGISTRY
+from pydentity_metrics import REQUEST_SECONDS
+from pydentity_passwd import HASH_SCHEMES, bcrypt, generate_and_hash, generate_password, identify, verify_password
+from pydentity_profile import SlowRequestProfiler
+from pydentity_store import BatchPlan, FileCache, FileStore, Users, Groups
 
 
 app = Flask(__name__)
@@ -34,9 +55,78 @@ CONF = {
     "PASSWORD_PATTERN_HELP": "Lower case, numeric and upper case or special char. At least 8 char",
     # List of used chars for password generation
     "PASSWORD_GENERATION_SPECIAL_CHAR": "!@#$%^&*+;?.!_=()[]{}",
+    # Hash scheme of new passwords: "apr1" (htpasswd -m), "sha256", "sha512" or "bcrypt" (needs bcrypt module).
+    # Existing hashes of any scheme are still checked, and replaced with this scheme on next password change
+    "HASH_SCHEME": "apr1",
+    # Rounds for sha256 and sha512, log2 of rounds for bcrypt. None uses scheme default (5000 rounds, bcrypt cost 12).
+    # python pydentity_bench.py --tune-hash <scheme> finds the one that matches a target check time
+    "HASH_COST": None,
     # Conf for the mailer
     "ENABLE_MAIL_CAPABILITIES": True,
     "MAIL_CONF": "mail_settings.py",
+    # SQLite file where mails of user batches wait to be sent. It contains user passwords until they are sent
+    "MAIL_SPOOL": join(dirname(__file__), "mail_spool.sqlite"),
+    # Number of background threads sending batch mails. Use 0 to send them synchronously within the request
+    "MAIL_QUEUE_WORKERS": 2,
+    # Number of processes generating and hashing passwords of user batches. None uses all cores, 0 or 1 (default) hashes
+    # them within the request. Processes are started with python interpreter of sys.executable: not usable with mod_wsgi
+    "HASH_WORKERS": 0,
+    # Number of users displayed per page in user list and group administration
+    "PAGE_SIZE": 100,
+    # Where users and groups are stored: "files" uses PWD_FILE and GROUP_FILE directly, "sqlite" uses an indexed
+    # database (STORAGE_DB) and exports PWD_FILE and GROUP_FILE for apache after each change
+    "STORAGE": "files",
+    "STORAGE_DB": join(dirname(__file__), "pydentity.sqlite"),
+    # Seconds to wait before writing changes to htpasswd and htgroup files, so that a burst of changes is written at
+    # once. Changes are visible at once by this process, but other processes and apache see them once written.
+    # Use 0 to write each change right away. Password changes and deletions from user page are always written at once
+    "WRITE_DELAY": 0,
+    # Changes are written before WRITE_DELAY when that many of them are waiting
+    "WRITE_MAX_PENDING": 100,
+    # Apache DBM databases (AuthDBMUserFile, AuthDBMGroupFile) written alongside htpasswd and htgroup files, so that
+    # apache finds a user without reading the whole file. None disables them
+    "DBM_USERS_FILE": None,
+    "DBM_GROUPS_FILE": None,
+    # Python dbm.<module> writing DBM databases: "gnu" (AuthDBMType GDBM in apache) or "ndbm" (AuthDBMType NDBM)
+    "DBM_TYPE": "gnu",
+    # Journal of changes written to htpasswd and htgroup files, pulled by replicas with pydentity_journal.py so that
+    # they get only changes instead of whole files. None disables it
+    "JOURNAL_FILE": None,
+    # Journal keeps at least that many changes: replicas late by more get whole files
+    "JOURNAL_MAX_ENTRIES": 10000,
+    # Path, under URL_PREFIX, of journal page for replicas. Only admin users can read it
+    "JOURNAL_PATH": "/journal",
+    # Path, under URL_PREFIX, of Prometheus metrics of the process (request, file, password hashing and mail timings).
+    # Only admin users can read them unless METRICS_PUBLIC is True: then restrict access in web server configuration.
+    # Use None to disable metrics page
+    "METRICS_PATH": "/metrics",
+    "METRICS_PUBLIC": False,
+    # Log requests slower than this number of milliseconds and keep a cProfile dump of them in PROFILE_DIR.
+    # None disables it
+    "PROFILE_SLOW_REQUESTS_MS": None,
+    # Fraction of requests that are profiled, as profiling slows requests down. Slow requests are always logged
+    "PROFILE_SAMPLE_RATE": 0.1,
+    "PROFILE_DIR": join(dirname(__file__), "profiles"),
+    # Number of profiles kept in PROFILE_DIR, oldest ones are removed
+    "PROFILE_MAX_FILES": 100,
+    # Number of CSV rows imported with each write of the files
+    "IMPORT_CHUNK_SIZE": 500,
+    # Number of rows sent at once by exports
+    "EXPORT_CHUNK_SIZE": 500,
+    # Number of biggest groups shown in stats page
+    "STATS_LARGEST_GROUPS": 10,
+    # Number of rendered admin pages (user and group lists, stats) kept in memory until users or groups change.
+    # Use 0 to render them on each request
+    "PAGE_CACHE_SIZE": 32,
+    # Path, under URL_PREFIX, checking http basic credentials for nginx auth_request, like "/auth". It must only be
+    # reachable by the proxy: anyone else could use it to guess passwords. None (default) disables it
+    "AUTH_PATH": None,
+    # Number of successful credential checks kept in memory, and for how many seconds
+    "AUTH_CACHE_SIZE": 10000,
+    "AUTH_CACHE_TTL": 60,
+    "AUTH_REALM": "pydentity",
+    # Maximum number of operations accepted by one call to the bulk JSON API
+    "API_BULK_MAX_OPERATIONS": 1000,
     # Deployment prefix - useful when behind reverse proxy
     # Don't put trailing slash. For no prefix, use an empty string
     "URL_PREFIX": "",
@@ -52,134 +142,307 @@ except ModuleNotFoundError:
 #
 app.config["PYDENTITY_URL_PREFIX"] = CONF["URL_PREFIX"]
 
+if CONF["PROFILE_SLOW_REQUESTS_MS"] is not None:
+    app.wsgi_app = SlowRequestProfiler(
+        app.wsgi_app,
+        CONF["PROFILE_DIR"],
+        CONF["PROFILE_SLOW_REQUESTS_MS"],
+        CONF["PROFILE_SAMPLE_RATE"],
+        CONF["PROFILE_MAX_FILES"],
+    )
+
 
 # Load all module and config for mailing capabilities
+mail = None
+mail_queues = {}
+hash_pools = {}
 if CONF["ENABLE_MAIL_CAPABILITIES"]:
-    from flask_mail import Mail, Message
+    from flask_mail import Mail, Message, BadHeaderError
 
     try:
         app.config.from_pyfile(CONF["MAIL_CONF"])
     except:
         print("WARNING: unable to find config file %s. Disabling email capabilities" % CONF["MAIL_CONF"])
         CONF["ENABLE_MAIL_CAPABILITIES"] = False
-    mail = None
+
+if CONF["HASH_SCHEME"] not in HASH_SCHEMES or (CONF["HASH_SCHEME"] == "bcrypt" and bcrypt is None):
+    print("WARNING: password hash scheme %s is not available. Using apr1" % CONF["HASH_SCHEME"])
+    CONF["HASH_SCHEME"] = "apr1"
+
+if CONF["DBM_USERS_FILE"] or CONF["DBM_GROUPS_FILE"]:
+    try:
+        importlib.import_module("dbm.%s" % CONF["DBM_TYPE"])
+    except ImportError:
+        print("WARNING: python dbm.%s module is not available. Disabling DBM databases" % CONF["DBM_TYPE"])
+        CONF["DBM_USERS_FILE"] = CONF["DBM_GROUPS_FILE"] = None
+
+# Parsed htpasswd and htgroup files shared by all requests of this process
+users_cache = FileCache(Users.from_file)
+groups_cache = FileCache(Groups.from_file)
+stores = {}
+# Successful credential checks of auth page
+credential_cache = CredentialCache(
+    CONF["AUTH_CACHE_SIZE"], CONF["AUTH_CACHE_TTL"], CONF["HASH_SCHEME"], CONF["HASH_COST"]
+)
+# ETag -> rendered page, least recently used first
+page_cache = OrderedDict()
+page_cache_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if "request_start" in g:
+        duration = time.perf_counter() - g.request_start
+        REQUEST_SECONDS.observe(duration, request.endpoint or "", request.method, response.status_code)
+    return response
+
+
+@app.before_request
+def load_identity():
+    """Identify the user once per request, see Identity"""
+    g.identity = Identity(get_remote_user(request))
+
+
+@app.context_processor
+def inject_identity():
+    """Give identity of current user to all templates"""
+    identity = g.get("identity")
+    if identity is None:
+        return {}
+    return dict(identity=identity, is_admin=identity.is_admin)
+
+
+def cached_page(view):
+    """Serve GET requests of view from the rendered pages cache. Pages depend on url, remote user and version of users
+    and groups, that only costs a stat of the files to check. Their strong ETag lets browsers that already have the
+    page get a 304 without any rendering"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ("GET", "HEAD") or not CONF["PAGE_CACHE_SIZE"]:
+            return view(*args, **kwargs)
+        key = (request.full_path, g.identity.remote_user, get_store().version())
+        etag = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        if etag in request.if_none_match:
+            PAGE_CACHE_REQUESTS.inc(1, request.endpoint, "not_modified")
+            response = Response(status=304)
+        else:
+            with page_cache_lock:
+                body = page_cache.get(etag)
+                if body is not None:
+                    page_cache.move_to_end(etag)
+            if body is None:
+                body = view(*args, **kwargs)
+                if not isinstance(body, str):
+                    return body
+                with page_cache_lock:
+                    page_cache[etag] = body
+                    while len(page_cache) > CONF["PAGE_CACHE_SIZE"]:
+                        page_cache.popitem(last=False)
+                PAGE_CACHE_REQUESTS.inc(1, request.endpoint, "miss")
+            else:
+                PAGE_CACHE_REQUESTS.inc(1, request.endpoint, "hit")
+            response = Response(body, mimetype="text/html")
+        response.set_etag(etag)
+        # Browsers must check the page is still the same each time it is displayed
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    return wrapper
 
 
 @app.route(CONF["URL_PREFIX"] + "/")
 def home():
-    if not get_remote_user(request):
+    if not g.identity.remote_user:
         # No REMOTE_USER header, can't work
         message = "Can't work without REMOTE_USER header, contact an administrator"
         return render_template("message.html", success=False, message=message)
 
-    url = url_for("user", username=get_remote_user(request))
+    url = url_for("user", username=g.identity.remote_user)
     if "return_to" in request.args:
         url += "?return_to=%s" % request.args.get("return_to")
     return redirect(url)
 
 
 @app.route(CONF["URL_PREFIX"] + "/list_users")
+@cached_page
 def list_users():
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-        is_admin, admin_error_message = check_user_is_admin(get_remote_user(request))
-        if not is_admin:
-            # User is not admin, can't allow
-            return render_template("message.html", message=admin_error_message)
-        return render_template("list_users.html", is_admin=is_admin, users=userdb.users)
+    if not g.identity.is_admin:
+        # User is not admin, can't allow
+        return render_template("message.html", message=g.identity.admin_error_message)
+
+    userdb = get_userdb()
+    groupdb = get_groupdb()
+    query = request.args.get("q", "")
+    contains = request.args.get("match") == "contains"
+    sort = request.args.get("sort", "login")
+    users = userdb.search(query, contains)
+    if sort == "-login":
+        users = users[::-1]
+    elif sort in ("groups", "-groups"):
+        users = sorted(users, key=lambda user: len(groupdb.groups_of(user)), reverse=sort == "-groups")
+    page = Pagination(users, request.args.get("page", 1, type=int), request.args.get("per_page", type=int))
+    return render_template(
+        "list_users.html",
+        users=[(user, len(groupdb.groups_of(user))) for user in page.items],
+        page=page,
+        query=query,
+        contains=contains,
+        sort=sort,
+    )
 
 
 @app.route(CONF["URL_PREFIX"] + "/list_groups")
+@cached_page
 def list_groups():
-    is_admin, admin_error_message = check_user_is_admin(get_remote_user(request))
-    if not is_admin:
+    if not g.identity.is_admin:
         # User is not admin, can't allow
-        return render_template("message.html", message=admin_error_message)
+        return render_template("message.html", message=g.identity.admin_error_message)
 
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-        with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-            groups = dict()
-            for user in userdb.users:
-                for group in groupdb.groups:
-                    if group not in groups:
-                        groups[group] = []
-                    if groupdb.is_user_in(user, group):
-                        groups[group].append(user)
+    userdb = get_userdb()
+    groupdb = get_groupdb()
+    groups = dict()
+    for group in groupdb.groups:
+        groups[group] = [user for user in groupdb.members(group) if user in userdb]
 
-    return render_template("list_groups.html", is_admin=is_admin, groups=groups)
+    return render_template("list_groups.html", groups=groups)
+
+
+@app.route(CONF["URL_PREFIX"] + "/export/<kind>.<fmt>")
+def export(kind, fmt):
+    """Stream users (with their groups) or group memberships as CSV or NDJSON, in constant memory"""
+    if not g.identity.is_admin:
+        # User is not admin, can't allow
+        return render_template("message.html", message=g.identity.admin_error_message)
+    if kind == "users":
+        groupdb = get_groupdb()
+        header = ("username", "groups")
+        rows = ((user, sorted(groupdb.groups_of(user))) for user in get_userdb())
+    elif kind == "memberships":
+        header = ("group", "username")
+        rows = get_groupdb().memberships()
+    else:
+        return render_template("message.html", message="Unknown export %s" % kind), 404
+    if fmt == "csv":
+        mimetype = "text/csv"
+        lines = export_csv(header, rows)
+    elif fmt == "ndjson":
+        mimetype = "application/x-ndjson"
+        lines = export_ndjson(header, rows)
+    else:
+        return render_template("message.html", message="Unknown export format %s" % fmt), 404
+    return Response(
+        stream_with_context(chunked(lines, CONF["EXPORT_CHUNK_SIZE"])),
+        mimetype=mimetype,
+        headers={"Content-Disposition": "attachment; filename=%s.%s" % (kind, fmt)},
+    )
 
 
 @app.route(CONF["URL_PREFIX"] + "/user", methods=["POST", "GET"])
 def user_entrypoint():
     """Simple user entrypoint to redirect to the correct user page"""
     if CONF["REQUIRE_REMOTE_USER"]:
-        if not get_remote_user(request):
+        if not g.identity.remote_user:
             return render_template("message.html", message="Sorry, you must be logged with http basic auth to go here")
         else:
-            url = url_for("user", username=get_remote_user(request))
+            url = url_for("user", username=g.identity.remote_user)
             return redirect(url)
 
 
 @app.route(CONF["URL_PREFIX"] + "/user/<username>", methods=["POST", "GET"])
 def user(username):
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
+    new_user = username not in get_userdb()
+    identity = g.identity
+    is_admin = identity.is_admin
 
-        new_user = username not in userdb
-        is_admin, admin_error_message = check_user_is_admin(get_remote_user(request))
+    if CONF["REQUIRE_REMOTE_USER"]:
+        if not identity.remote_user:
+            return render_template("message.html", message="Sorry, you must be logged with http basic auth to go here")
+        if identity.remote_user != username or new_user:
+            # User trying to change someone else password
+            if not is_admin:
+                # User is not admin or admin group does exist. Ciao
+                return render_template("message.html", message=identity.admin_error_message)
+
+    groupdb = get_groupdb()
+    user_groups = identity.groups if username == identity.remote_user else groupdb.groups_of(username)
+    groups = dict((group, group in user_groups) for group in groupdb.groups)
+
+    if request.method == "GET":
+        return render_template(
+            "user.html",
+            username=username,
+            new=new_user,
+            groups=groups,
+            password_pattern=CONF["PASSWORD_PATTERN"],
+            password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
+        )
+    else:
+        # POST Request
+        success = True
+        message = ""
+        message_details = ""
+
+        if "deleteuser" in request.form:
+            with edit_userdb(flush=True) as userdb:
+                with edit_groupdb(flush=True) as groupdb:
+                    # Delete the user
+                    userdb.pop(username)
 
-        if CONF["REQUIRE_REMOTE_USER"]:
-            if not get_remote_user(request):
-                return render_template(
-                    "message.html", message="Sorry, you must be logged with http basic auth to go here"
-                )
-            if get_remote_user(request) != username or new_user:
-                # User trying to change someone else password
-                if not is_admin:
-                    # User is not admin or admin group does exist. Ciao
-                    return render_template("message.html", message=admin_error_message)
-
-        with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-            groups = dict()
-            for group in groupdb.groups:
-                if groupdb.is_user_in(username, group):
-                    groups[group] = True
-                else:
-                    groups[group] = False
+                    # Remove the user from all groups it is in
+                    for group in user_groups:
+                        if groupdb.is_user_in(username, group):
+                            groupdb.delete_user(username, group)
+                            groups[group] = False
 
-        if request.method == "GET":
+            # Redirect to the same page (you can create the user again...)
+            message = "User %s successfully deleted" % username
             return render_template(
                 "user.html",
                 username=username,
-                new=new_user,
-                is_admin=is_admin,
+                new=True,
                 groups=groups,
                 password_pattern=CONF["PASSWORD_PATTERN"],
                 password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
+                message=message,
+                success=success,
             )
-        else:
-            # POST Request
-            success = True
-            message = ""
-            message_details = ""
-
-            if "deleteuser" in request.form:
-                with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-                    with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-                        # Delete the user
-                        userdb.pop(username)
-
-                        # Remove the user from all groups it is in
-                        for group in groupdb.groups:
-                            if groupdb.is_user_in(username, group):
-                                groupdb.delete_user(username, group)
-                                groups[group] = False
-
-                # Redirect to the same page (you can create the user again...)
-                message = "User %s successfully deleted" % username
+
+        if (
+            "generaterandom" in request.form
+            or request.form["new_password"] != ""
+            or request.form["repeat_password"] != ""
+        ):
+            # Then the user wanted to generate a new password (chosen or random)
+
+            # All failure conditions
+            if "generaterandom" not in request.form:
+                if request.form["new_password"] != request.form["repeat_password"]:
+                    message = "Passwords differ. Please try again"
+                    success = False
+                if not match(CONF["PASSWORD_PATTERN"], request.form["new_password"]):
+                    message = "New password does not match requirements (%s)" % CONF["PASSWORD_PATTERN_HELP"]
+                    success = False
+                if not is_admin and not check_password(get_userdb().get_hash(username), request.form["old_password"]):
+                    message = "Old password does not match"
+                    success = False
+                if request.form["new_password"] == "":
+                    message = "New password it required. Please try again."
+                    success = False
+                if request.form["repeat_password"] == "":
+                    message = "Repeated password it required. Please try again."
+                    success = False
+
+            if success == False:
                 return render_template(
                     "user.html",
                     username=username,
-                    new=True,
-                    is_admin=is_admin,
+                    new=new_user,
                     groups=groups,
                     password_pattern=CONF["PASSWORD_PATTERN"],
                     password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
@@ -187,106 +450,69 @@ def user(username):
                     success=success,
                 )
 
-            if (
-                "generaterandom" in request.form
-                or request.form["new_password"] != ""
-                or request.form["repeat_password"] != ""
-            ):
-                # Then the user wanted to generate a new password (chosen or random)
-
-                # All failure conditions
-                if "generaterandom" not in request.form:
-                    if request.form["new_password"] != request.form["repeat_password"]:
-                        message = "Passwords differ. Please try again"
-                        success = False
-                    if not match(CONF["PASSWORD_PATTERN"], request.form["new_password"]):
-                        message = "New password does not match requirements (%s)" % CONF["PASSWORD_PATTERN_HELP"]
-                        success = False
-                    if not is_admin and not check_password(userdb.new_users[username], request.form["old_password"]):
-                        message = "Old password does not match"
-                        success = False
-                    if request.form["new_password"] == "":
-                        message = "New password it required. Please try again."
-                        success = False
-                    if request.form["repeat_password"] == "":
-                        message = "Repeated password it required. Please try again."
-                        success = False
-
-                if success == False:
-                    return render_template(
-                        "user.html",
-                        username=username,
-                        new=new_user,
-                        is_admin=is_admin,
-                        groups=groups,
-                        password_pattern=CONF["PASSWORD_PATTERN"],
-                        password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
-                        message=message,
-                        success=success,
-                    )
-
-                # If the generate random password is checked
-                if "generaterandom" in request.form:
-                    new_password = generate_random_password()
-                    message_details = "Generated random password is: %s" % new_password
-                else:
-                    new_password = request.form["new_password"]
-                    message_details = "Password set to chosen password"
+            # If the generate random password is checked
+            if "generaterandom" in request.form:
+                new_password = generate_random_password()
+                message_details = "Generated random password is: %s" % new_password
+            else:
+                new_password = request.form["new_password"]
+                message_details = "Password set to chosen password"
 
+            # User will log in with this password right away, don't delay it
+            with edit_userdb(flush=True) as userdb:
                 if new_user:
-                    userdb.add(username, new_password)
+                    userdb.add(username, new_password, **hash_options())
                     message = "User created with random password"
                 else:
-                    userdb.change_password(username, new_password)
+                    userdb.change_password(username, new_password, **hash_options())
                     message = "User password updated"
 
-            # Process groups, only for admin user
-            message_groups = ""
-            message_groups_details = ""
-            if is_admin:
-                with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-                    checked_groups = [g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("group_")]
-                    message_groups_details = ""
-                    for group in groupdb.groups:
-                        if group in checked_groups:
-                            if not groupdb.is_user_in(username, group):
-                                groupdb.add_user(username, group)
-                                groups[group] = True
-                                message_groups_details += "add " + group + ", "
-                        else:
-                            if groupdb.is_user_in(username, group):
-                                groupdb.delete_user(username, group)
-                                groups[group] = False
-                                message_groups_details += "delete " + group + ", "
-                    if message_groups_details:
-                        message_groups = "User groups changed"
-                        message_groups_details = "Changed groups are: " + message_groups_details[:-2]
-
-            if request.args.get("return_to"):
-                return redirect(request.args.get("return_to"))
-            else:
-                return render_template(
-                    "user.html",
-                    username=username,
-                    new=False,
-                    is_admin=is_admin,
-                    groups=groups,
-                    password_pattern=CONF["PASSWORD_PATTERN"],
-                    password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
-                    message=message,
-                    message_details=message_details if message_details else None,
-                    message_groups=message_groups,
-                    message_groups_details=message_groups_details,
-                    success=True,
-                )
+        # Process groups, only for admin user
+        message_groups = ""
+        message_groups_details = ""
+        if is_admin:
+            with edit_groupdb() as groupdb:
+                checked_groups = set(g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("group_"))
+                message_groups_details = ""
+                for group in groupdb.groups:
+                    # groups holds current membership from the index, only check the file when a change is needed
+                    if group in checked_groups:
+                        if not groups.get(group) and not groupdb.is_user_in(username, group):
+                            groupdb.add_user(username, group)
+                            groups[group] = True
+                            message_groups_details += "add " + group + ", "
+                    elif groups.get(group):
+                        if groupdb.is_user_in(username, group):
+                            groupdb.delete_user(username, group)
+                            groups[group] = False
+                            message_groups_details += "delete " + group + ", "
+                if message_groups_details:
+                    message_groups = "User groups changed"
+                    message_groups_details = "Changed groups are: " + message_groups_details[:-2]
+
+        if request.args.get("return_to"):
+            return redirect(request.args.get("return_to"))
+        else:
+            return render_template(
+                "user.html",
+                username=username,
+                new=False,
+                groups=groups,
+                password_pattern=CONF["PASSWORD_PATTERN"],
+                password_pattern_help=CONF["PASSWORD_PATTERN_HELP"],
+                message=message,
+                message_details=message_details if message_details else None,
+                message_groups=message_groups,
+                message_groups_details=message_groups_details,
+                success=True,
+            )
 
 
 @app.route(CONF["URL_PREFIX"] + "/group/<group>", methods=["POST", "GET"])
 def group(group):
-    is_admin, admin_error_message = check_user_is_admin(get_remote_user(request))
-    if not is_admin:
+    if not g.identity.is_admin:
         # User is not admin, can't allow
-        return render_template("message.html", message=admin_error_message)
+        return render_template("message.html", message=g.identity.admin_error_message)
 
     message = ""
     if request.method == "POST":
@@ -294,7 +520,7 @@ def group(group):
         user_to_remove = [g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("remove_")]
         if user_to_remove:
             user_to_remove = user_to_remove[0]
-            with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
+            with edit_groupdb() as groupdb:
                 if groupdb.is_user_in(user_to_remove, group):
                     groupdb.delete_user(user_to_remove, group)
                     message = "User %s removed from group %s" % (user_to_remove, group)
@@ -303,10 +529,10 @@ def group(group):
         user_to_delete = [g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("delete_")]
         if user_to_delete:
             user_to_delete = user_to_delete[0]
-            with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-                with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
+            with edit_userdb() as userdb:
+                with edit_groupdb() as groupdb:
                     # Delete the user from all groups it is in
-                    for group_loop in groupdb.groups:
+                    for group_loop in get_groupdb().groups_of(user_to_delete):
                         if groupdb.is_user_in(user_to_delete, group_loop):
                             groupdb.delete_user(user_to_delete, group_loop)
                     # Delete the user
@@ -315,182 +541,816 @@ def group(group):
 
         # If the user clicked the "Add a user" button
         if "add_user_to_group" in request.form:
-            with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-                groupdb.add_user(request.form["select_user"], group)
-                message = "User %s added to group %s" % (request.form["select_user"], group)
-
-    users = []
+            user_to_add = request.form["select_user"]
+            if user_to_add not in get_userdb():
+                message = "User %s does not exist" % user_to_add
+            else:
+                with edit_groupdb() as groupdb:
+                    if not groupdb.is_user_in(user_to_add, group):
+                        groupdb.add_user(user_to_add, group)
+                message = "User %s added to group %s" % (user_to_add, group)
+
+    userdb = get_userdb()
+    members = set(get_groupdb().members(group))
+    query = request.args.get("q", "")
+    users = sorted(user for user in members if user in userdb and user.startswith(query))
+    if request.args.get("sort") == "-login":
+        users.reverse()
+    page = Pagination(users, request.args.get("page", 1, type=int), request.args.get("per_page", type=int))
+
+    # Only propose a bounded list of users to add, filtered with a prefix search
+    candidate_query = request.args.get("candidate", "")
     possible_users = []
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-        with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-            for user in userdb.users:
-                if groupdb.is_user_in(user, group):
-                    users.append(user)
-                else:
-                    possible_users.append(user)
+    for user in userdb.search(candidate_query):
+        if user not in members:
+            possible_users.append(user)
+            if len(possible_users) == CONF["PAGE_SIZE"]:
+                break
 
     return render_template(
-        "group.html", message=message, is_admin=is_admin, group=group, users=users, possible_users=possible_users
+        "group.html",
+        message=message,
+        group=group,
+        users=page.items,
+        page=page,
+        query=query,
+        sort=request.args.get("sort", "login"),
+        possible_users=possible_users,
+        candidate_query=candidate_query,
     )
 
 
 @app.route(CONF["URL_PREFIX"] + "/batch_user_creation", methods=["POST", "GET"])
 def batch_user_creation():
 
-    is_admin, message = check_user_is_admin(get_remote_user(request))
-    if not is_admin:
+    if not g.identity.is_admin:
         # User is not admin or admin group does exist. Ciao
-        return render_template("message.html", message=message)
-
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-        with htpasswd.Group(CONF["GROUP_FILE"]) as groupdb:
-            if request.method == "GET":
-                groups = []
-                for group in groupdb.groups:
-                    groups.append(group)
-                return render_template(
-                    "batch_user_creation.html",
-                    is_admin=is_admin,
-                    groups=groups,
-                    mail_capabilities=CONF["ENABLE_MAIL_CAPABILITIES"],
-                )
+        return render_template("message.html", message=g.identity.admin_error_message)
+
+    if request.method == "GET":
+        return render_template(
+            "batch_user_creation.html",
+            groups=get_groupdb().groups,
+            mail_capabilities=CONF["ENABLE_MAIL_CAPABILITIES"],
+        )
+    else:
+        # POST Request
+        logins = request.form["users_login"].split("\r\n")
+        checked_groups = [g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("group_")]
+        if "dry_run" in request.form:
+            plan = BatchPlan(get_userdb(), get_groupdb(), logins, checked_groups)
+            return render_template("batch_preview.html", plan=plan)
+
+        # Passwords are hashed before files are locked: logins of the plan only depend on the form
+        plan = BatchPlan(get_userdb(), get_groupdb(), logins, checked_groups)
+        generated = generate_and_hash(
+            len(plan.logins),
+            special_chars=CONF["PASSWORD_GENERATION_SPECIAL_CHAR"],
+            executor=get_hash_pool(),
+            **hash_options()
+        )
+        passwords = dict((login, password) for login, (password, password_hash) in zip(plan.logins, generated))
+        hashes = dict((login, password_hash) for login, (password, password_hash) in zip(plan.logins, generated))
+        with edit_userdb() as userdb:
+            with edit_groupdb() as groupdb:
+                plan = BatchPlan(userdb, groupdb, logins, checked_groups)
+                result = plan.apply(userdb, groupdb, passwords, hashes)
+        message = "Batch of user created with generated passwords"
+
+        # If the "send_mail" checkbox is enabled
+        batch_url = None
+        if request.form.get("send_mail") is not None and CONF["ENABLE_MAIL_CAPABILITIES"]:
+            if CONF["MAIL_QUEUE_WORKERS"]:
+                batch_id = queue_mail(result, request.form["mail_suffix"], request.form["instance"])
+                batch_url = url_for("mail_batch", batch_id=batch_id)
+                message = "Batch of user created with generated passwords, mails are being sent (batch %s)" % batch_id
             else:
-                # POST Request
-                users = request.form["users_login"].split("\r\n")
-                checked_groups = [g.split("_", 1)[1] for g in list(request.form.keys()) if g.startswith("group_")]
-                result = []
-                for username in users:
-                    new_password = generate_random_password()
-                    new_user = username not in userdb
-                    if new_user:
-                        userdb.add(username, new_password)
-                        action = "create"
-                    else:
-                        userdb.change_password(username, new_password)
-                        action = "update"
-                    result.append((username, new_password, action))
-                    for group in groupdb.groups:
-                        if group in checked_groups:
-                            if not groupdb.is_user_in(username, group):
-                                groupdb.add_user(username, group)
-                        else:
-                            if groupdb.is_user_in(username, group):
-                                groupdb.delete_user(username, group)
-                message = "Batch of user created with generated passwords"
-
-                # If the "send_mail" checkbox is enabled
-                if request.form.get("send_mail") is not None:
+                failures = send_mail(result, request.form["mail_suffix"], request.form["instance"])
+                if failures:
+                    message = (
+                        "Batch of user created with generated passwords, but mail could not be sent to: %s"
+                        % ", ".join("%s (%s)" % failure for failure in failures)
+                    )
+                else:
                     message = "Batch of user created with generated passwords, a mail has been sent to all of them"
-                    send_mail(result, request.form["mail_suffix"], request.form["instance"])
 
-                return render_template(
-                    "message.html",
-                    message=message,
-                    success=True,
-                    result=render_template("result_template.html", is_admin=is_admin, result=result),
-                )
+        return render_template(
+            "message.html",
+            message=message,
+            success=True,
+            details_url=batch_url,
+            result=render_template("result_template.html", result=result),
+        )
+
+
+@app.route(CONF["URL_PREFIX"] + "/import_users", methods=["POST", "GET"])
+def import_users():
+    """Create or update users from a CSV file: login, mail address, space separated groups and optional password hash.
+    Rows are read and applied by chunks, each with one write of the files, and progress is streamed back as one JSON
+    object per chunk"""
+    if not g.identity.is_admin:
+        # User is not admin or admin group does exist. Ciao
+        return render_template("message.html", message=g.identity.admin_error_message)
+
+    if request.method == "GET":
+        return render_template("import_users.html", mail_capabilities=CONF["ENABLE_MAIL_CAPABILITIES"])
+
+    send = request.form.get("send_mail") is not None and CONF["ENABLE_MAIL_CAPABILITIES"]
+    instance = request.form.get("instance", "")
+    if "file" in request.files:
+        # Form upload: werkzeug already read the whole body, and closes the file once view returns
+        progress = list(import_rows(request.files["file"].stream, send, instance))
+        return Response(progress, mimetype="application/x-ndjson")
+    # CSV sent as request body by scripts is read while imported
+    return Response(stream_with_context(import_rows(request.stream, send, instance)), mimetype="application/x-ndjson")
+
+
+def import_rows(stream, send, instance):
+    """Read CSV rows from binary stream and apply them by chunks of IMPORT_CHUNK_SIZE
+    @return: iterator over progress lines. Each one has the errors of its chunk only, and the total error count, and
+    the generated passwords of its chunk that are not mailed"""
+    progress = dict(rows=0, created=0, updated=0, errors=[], error_count=0, passwords=[], mail_batches=[])
+    chunk = []
+    with io.TextIOWrapper(stream, encoding="utf-8-sig", newline="") as text:
+        for line, row in enumerate(csv.reader(text), 1):
+            if line == 1 and row and row[0].strip().lower() == "login":
+                # Header
+                continue
+            if not any(cell.strip() for cell in row):
+                continue
+            chunk.append((line, row))
+            if len(chunk) >= CONF["IMPORT_CHUNK_SIZE"]:
+                import_chunk(chunk, send, instance, progress)
+                chunk = []
+                yield json.dumps(progress) + "\n"
+                progress["errors"] = []
+                progress["passwords"] = []
+    if chunk:
+        import_chunk(chunk, send, instance, progress)
+    progress["done"] = True
+    yield json.dumps(progress) + "\n"
+
+
+def import_chunk(chunk, send, instance, progress):
+    """Apply a chunk of (line number, CSV row) with one write of the files and update progress"""
+    result = []
+    recipients = {}
+    with edit_userdb(flush=True) as userdb:
+        with edit_groupdb(flush=True) as groupdb:
+            for line, row in chunk:
+                row = [cell.strip() for cell in row] + [""] * (4 - len(row))
+                login, email, groups, password_hash = row[:4]
+                data = dict(groups=groups.split() or None, password_hash=password_hash or None)
+                try:
+                    if email and "@" not in email:
+                        raise ApiError("Invalid mail address %s" % email)
+                    user = api_put_user(userdb, groupdb, login, data)
+                except ApiError as e:
+                    progress["errors"].append(dict(line=line, login=login, error=e.message))
+                    progress["error_count"] += 1
+                    continue
+                progress["created" if user["created"] else "updated"] += 1
+                if "password" in user and send and email:
+                    result.append((login, user["password"], "create"))
+                    recipients[login] = email
+                elif "password" in user:
+                    # Not mailed: given back, like batch user creation does, so that new user can be told
+                    progress["passwords"].append(dict(login=login, password=user["password"]))
+    progress["rows"] += len(chunk)
+    if send and result:
+        if CONF["MAIL_QUEUE_WORKERS"]:
+            progress["mail_batches"].append(queue_mail(result, None, instance, recipients))
+        else:
+            passwords = dict((username, password) for username, password, action in result)
+            for username, error in send_mail(result, None, instance, recipients):
+                progress["errors"].append(dict(login=username, error="Mail not sent: %s" % error))
+                progress["error_count"] += 1
+                progress["passwords"].append(dict(login=username, password=passwords[username]))
+
+
+@app.route(CONF["URL_PREFIX"] + "/mail_batch/<int:batch_id>", methods=["POST", "GET"])
+def mail_batch(batch_id):
+    if not g.identity.is_admin:
+        # User is not admin or admin group does exist. Ciao
+        return render_template("message.html", message=g.identity.admin_error_message)
+    if not CONF["ENABLE_MAIL_CAPABILITIES"]:
+        return render_template("message.html", message="Mail capabilities are disabled")
+
+    queue = get_mail_queue()
+    message = ""
+    if request.method == "POST" and "retry" in request.form:
+        message = "%s mail(s) queued again" % queue.retry(batch_id)
+
+    status = queue.status(batch_id)
+    if status is None:
+        return render_template("message.html", message="Unknown mail batch %s" % batch_id)
+    return render_template("mail_batch.html", batch_id=batch_id, status=status, message=message)
 
 
 @app.route(CONF["URL_PREFIX"] + "/stats", methods=["POST", "GET"])
+@cached_page
 def stats():
-    is_admin, message = check_user_is_admin(get_remote_user(request))
-    if not is_admin:
+    if not g.identity.is_admin:
         # User is not admin or admin group does exist. Ciao
-        return render_template("message.html", message=message)
+        return render_template("message.html", message=g.identity.admin_error_message)
 
-    with htpasswd.Basic(CONF["PWD_FILE"], mode="md5") as userdb:
-        with htpasswd.Group(CONF["GROUP_FILE"]) as groupsdb:
-            number_of_users = len(userdb.users)
-            number_of_groups = len(groupsdb.groups)
-
-            # Compute users without group
-            unassigned_user = userdb.users.copy()
-            for user in userdb.users:
-                for group in groupsdb.groups:
-                    if groupsdb.is_user_in(user, group):
-                        unassigned_user.pop(unassigned_user.index(user))
-                        break
+    # Kept up to date by each change instead of being computed again
+    figures = get_store().stats()
+    group_sizes = figures["group_sizes"]
+    largest_groups = sorted(group_sizes.items(), key=lambda item: (-item[1], item[0]))[: CONF["STATS_LARGEST_GROUPS"]]
 
     return render_template(
         "stats.html",
-        is_admin=is_admin,
-        number_of_users=number_of_users,
-        number_of_groups=number_of_groups,
-        unassigned_user=unassigned_user,
+        number_of_users=figures["number_of_users"],
+        number_of_groups=len(group_sizes),
+        unassigned_user=figures["unassigned_users"],
+        largest_groups=largest_groups,
+        admins=get_groupdb().members(CONF["ADMIN_GROUP"]),
+        hash_schemes=sorted(figures["schemes"].items()),
     )
 
 
-def check_user_is_admin(user):
+def metrics():
+    """Metrics of this process in Prometheus text format"""
+    if not CONF["METRICS_PUBLIC"] and not g.identity.is_admin:
+        return Response(g.identity.admin_error_message, 403, mimetype="text/plain")
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+if CONF["METRICS_PATH"]:
+    app.add_url_rule(CONF["URL_PREFIX"] + CONF["METRICS_PATH"], "metrics", metrics)
+
+
+def auth():
+    """Answer nginx auth_request subrequests: 200 if http basic credentials are valid and user belongs to one of the
+    group query arguments (or X-Auth-Group header, comma separated) if any, 401 or 403 otherwise.
+    Login is given back in X-Auth-User header"""
+    groups = required_groups(request.args.getlist("group"), request.headers.get("X-Auth-Group"))
+    status, user = authenticate(get_store(), credential_cache, request.headers.get("Authorization"), groups)
+    response = Response(status=status)
+    response.headers["Cache-Control"] = "no-store"
+    if user is not None:
+        response.headers["X-Auth-User"] = user
+    if status == 401:
+        response.headers["WWW-Authenticate"] = 'Basic realm="%s"' % CONF["AUTH_REALM"]
+    return response
+
+
+if CONF["AUTH_PATH"]:
+    app.add_url_rule(CONF["URL_PREFIX"] + CONF["AUTH_PATH"], "auth", auth)
+
+
+def journal():
+    """Changes written to htpasswd and htgroup files after the since query argument sequence number, for replicas.
+    Whole files are given instead if asked with snapshot query argument, or if changes are not in journal anymore"""
+    if not g.identity.is_admin:
+        return Response(g.identity.admin_error_message, 403, mimetype="text/plain")
+    change_journal = get_store().journal
+    if change_journal is None:
+        return Response("Journal is disabled", 404, mimetype="text/plain")
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return Response("Invalid since argument", 400, mimetype="text/plain")
+    data = None if request.args.get("snapshot") else change_journal.read(since)
+    if data is None:
+        data = change_journal.snapshot({"users": CONF["PWD_FILE"], "groups": CONF["GROUP_FILE"]})
+    response = jsonify(data)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+if CONF["JOURNAL_PATH"]:
+    app.add_url_rule(CONF["URL_PREFIX"] + CONF["JOURNAL_PATH"], "journal", journal)
+
+
+class ApiError(Exception):
+    """Error returned to JSON API clients, with its http status"""
+
+    def __init__(self, message, status=400):
+        self.message = message
+        self.status = status
+
+    def __str__(self):
+        return self.message
+
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=error.message), error.status
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/users")
+def api_users():
+    check_api_admin()
+    users = get_userdb().search(request.args.get("q", ""), request.args.get("match") == "contains")
+    page = Pagination(users, request.args.get("page", 1, type=int), request.args.get("per_page", type=int))
+    return jsonify(users=page.items, page=page.page, pages=page.pages, total=page.total)
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/users/<username>", methods=["GET", "PUT", "DELETE"])
+def api_user(username):
+    check_api_admin()
+    if request.method == "GET":
+        if username not in get_userdb():
+            raise ApiError("User %s does not exist" % username, 404)
+        return jsonify(api_user_description(get_groupdb(), username))
+
+    data = get_api_json() if request.method == "PUT" else None
+    with edit_userdb(api_flush()) as userdb:
+        with edit_groupdb(api_flush()) as groupdb:
+            if request.method == "PUT":
+                result = api_put_user(userdb, groupdb, username, data)
+            else:
+                result = api_delete_user(userdb, groupdb, username)
+    return jsonify(result), 201 if result.get("created") else 200
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/groups")
+def api_groups():
+    check_api_admin()
+    groupdb = get_groupdb()
+    return jsonify(groups=dict((group, groupdb.members(group)) for group in groupdb.groups))
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/groups/<group>")
+def api_group(group):
+    check_api_admin()
+    groupdb = get_groupdb()
+    if group not in groupdb:
+        raise ApiError("Group %s does not exist" % group, 404)
+    return jsonify(group=group, members=groupdb.members(group))
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/groups/<group>/members/<username>", methods=["PUT", "DELETE"])
+def api_group_member(group, username):
+    check_api_admin()
+    with edit_groupdb(api_flush()) as groupdb:
+        result = api_set_membership(get_userdb(), groupdb, username, group, request.method == "PUT")
+    return jsonify(result)
+
+
+@app.route(CONF["URL_PREFIX"] + "/api/bulk", methods=["POST"])
+def api_bulk():
+    """Apply a list of operations with a single write of each file. Operations are objects with an "op" key:
+    put_user and delete_user (with the same fields as /api/users/<username>), add_to_group and remove_from_group.
+    By default a failed operation is reported in results and the others are applied. With "atomic": true, the first
+    failure aborts the whole batch and nothing is written"""
+    check_api_admin()
+    data = get_api_json()
+    operations = data.get("operations")
+    if not isinstance(operations, list):
+        raise ApiError("operations list expected")
+    if len(operations) > CONF["API_BULK_MAX_OPERATIONS"]:
+        raise ApiError("Too many operations, maximum is %s" % CONF["API_BULK_MAX_OPERATIONS"], 413)
+
+    results = []
+    with edit_userdb(api_flush()) as userdb:
+        with edit_groupdb(api_flush()) as groupdb:
+            for index, operation in enumerate(operations):
+                try:
+                    result = api_operation(userdb, groupdb, operation)
+                    results.append(dict(result, status=201 if result.get("created") else 200))
+                except ApiError as e:
+                    if data.get("atomic"):
+                        raise ApiError("Operation %s failed, nothing done: %s" % (index, e.message), e.status)
+                    results.append(dict(status=e.status, error=e.message))
+    return jsonify(results=results)
+
+
+def check_api_admin():
+    """Ensure API caller is admin, with the same rules as html pages
+    @raise ApiError: if not"""
+    if not g.identity.is_admin:
+        raise ApiError(g.identity.admin_error_message, 403)
+
+
+def api_flush():
+    """@return: True if API caller asked changes to be written to disk before the response, with flush=1 argument"""
+    return request.args.get("flush", "").lower() in ("1", "true", "yes")
+
+
+def get_api_json():
+    """@return: JSON object posted to the API"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError("JSON object expected")
+    return data
+
+
+def api_operation(userdb, groupdb, operation):
+    """Apply one operation of a bulk API call
+    @return: operation result, as for the single operation API"""
+    if not isinstance(operation, dict) or not isinstance(operation.get("username"), str):
+        raise ApiError("Operation must be an object with a username")
+    op = operation.get("op")
+    username = operation["username"]
+    if op == "put_user":
+        return api_put_user(userdb, groupdb, username, operation)
+    if op == "delete_user":
+        return api_delete_user(userdb, groupdb, username)
+    if op in ("add_to_group", "remove_from_group"):
+        if not isinstance(operation.get("group"), str):
+            raise ApiError("Operation %s needs a group" % op)
+        return api_set_membership(userdb, groupdb, username, operation["group"], op == "add_to_group")
+    raise ApiError("Unknown operation %s" % op)
+
+
+def api_user_description(groupdb, username):
+    """@return: user as returned by the API"""
+    return dict(username=username, groups=sorted(groupdb.groups_of(username)))
+
+
+def api_put_user(userdb, groupdb, username, data):
+    """Create or update a user. data may hold password or password_hash (already hashed with a htpasswd scheme),
+    generate_password (a random password is generated, and returned, for new users without password) and groups, the
+    full list of groups of the user. Everything is checked before any change is made
+    @return: user description, with created flag and generated password if any"""
+    if not username or ":" in username or username.split() != [username]:
+        raise ApiError("Invalid username %r" % username)
+    created = username not in userdb
+    password = data.get("password")
+    password_hash = data.get("password_hash")
+    if password_hash is not None and (not isinstance(password_hash, str) or identify(password_hash) is None):
+        raise ApiError("Unknown password hash scheme")
+    # Would break htpasswd lines, or add some
+    if password_hash is not None and not fullmatch(r"[^\s:]+", password_hash):
+        raise ApiError("Invalid password hash")
+    generated = bool(data.get("generate_password")) or (created and password is None and password_hash is None)
+    if generated:
+        password = generate_random_password()
+    elif password is not None and (not isinstance(password, str) or not match(CONF["PASSWORD_PATTERN"], password)):
+        raise ApiError("Password does not match requirements (%s)" % CONF["PASSWORD_PATTERN_HELP"])
+    groups = data.get("groups")
+    if groups is not None:
+        if not isinstance(groups, list) or not all(isinstance(group, str) for group in groups):
+            raise ApiError("groups must be a list of group names")
+        unknown = [group for group in groups if group not in groupdb]
+        if unknown:
+            raise ApiError("Unknown group(s): %s" % ", ".join(str(group) for group in unknown))
+
+    if password_hash is not None and not generated:
+        userdb.set_hash(username, password_hash)
+    elif created:
+        userdb.add(username, password, **hash_options())
+    elif password is not None:
+        userdb.change_password(username, password, **hash_options())
+    if groups is not None:
+        groups = set(groups)
+        for group in groupdb.groups:
+            if group in groups and not groupdb.is_user_in(username, group):
+                groupdb.add_user(username, group)
+            elif group not in groups and groupdb.is_user_in(username, group):
+                groupdb.delete_user(username, group)
+
+    result = api_user_description(groupdb, username)
+    result["created"] = created
+    if generated:
+        result["password"] = password
+    return result
+
+
+def api_delete_user(userdb, groupdb, username):
+    """Delete a user and remove it from all its groups
+    @return: deleted user description"""
+    if username not in userdb:
+        raise ApiError("User %s does not exist" % username, 404)
+    result = api_user_description(groupdb, username)
+    for group in result["groups"]:
+        groupdb.delete_user(username, group)
+    userdb.pop(username)
+    result["deleted"] = True
+    return result
+
+
+def api_set_membership(userdb, groupdb, username, group, member):
+    """Add user to group, or remove it if member is False. Nothing is done if already done
+    @return: user description"""
+    if group not in groupdb:
+        raise ApiError("Group %s does not exist" % group, 404)
+    if username not in userdb:
+        raise ApiError("User %s does not exist" % username, 404)
+    if member and not groupdb.is_user_in(username, group):
+        groupdb.add_user(username, group)
+    elif not member and groupdb.is_user_in(username, group):
+        groupdb.delete_user(username, group)
+    return api_user_description(groupdb, username)
+
+
+@app.template_global()
+def url_with(**changes):
+    """@return: url of current page with some query arguments changed"""
+    args = request.args.to_dict()
+    args.update(changes)
+    args.update(request.view_args)
+    return url_for(request.endpoint, **args)
+
+
+class Pagination(object):
+    """One page of a list"""
+
+    def __init__(self, items, page=1, per_page=None):
+        per_page = min(max(per_page or CONF["PAGE_SIZE"], 1), 1000)
+        self.total = len(items)
+        self.per_page = per_page
+        self.pages = max(int(math.ceil(self.total / float(per_page))), 1)
+        self.page = min(max(page, 1), self.pages)
+        self.items = items[(self.page - 1) * per_page : self.page * per_page]
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+
+class Identity(object):
+    """User doing current request, with its groups and admin rights. Created for each request by load_identity() and
+    shared by routes (g.identity) and templates. Groups are looked up once, on first use"""
+
+    def __init__(self, remote_user):
+        self.remote_user = remote_user
+        self._groups = None
+        self._admin_check = None
+
+    @property
+    def groups(self):
+        """Set of groups of remote user"""
+        if self._groups is None:
+            self._groups = get_groupdb().groups_of(self.remote_user) if self.remote_user else frozenset()
+        return self._groups
+
+    @property
+    def is_admin(self):
+        return self._check_admin()[0]
+
+    @property
+    def admin_error_message(self):
+        """Reason why user is not admin"""
+        return self._check_admin()[1]
+
+    def _check_admin(self):
+        if self._admin_check is None:
+            self._admin_check = check_user_is_admin(self.remote_user, self.groups)
+        return self._admin_check
+
+
+def check_user_is_admin(user, user_groups=None):
     """Ensure username is in admin group and that admin group exists
+    @param user_groups: groups of user if already known
     @:return: tuple (result, message), result is True if user is admin, else False. message indicate reason if False"""
-    with htpasswd.Group(CONF["GROUP_FILE"]) as groupsdb:
-        if CONF["ADMIN_GROUP"] not in groupsdb:
-            return (
-                False,
-                "Sorry admin group '%s' is not defined. You cannot change someone else password or create new user"
-                % CONF["ADMIN_GROUP"],
-            )
-        if not groupsdb.is_user_in(user, CONF["ADMIN_GROUP"]):
-            return (
-                False,
-                "Forbidden: only admin user allowed",
-            )
-        # Everything is fine
-        return (True, "")
+    groupsdb = get_groupdb()
+    if CONF["ADMIN_GROUP"] not in groupsdb:
+        return (
+            False,
+            "Sorry admin group '%s' is not defined. You cannot change someone else password or create new user"
+            % CONF["ADMIN_GROUP"],
+        )
+    if user_groups is None:
+        user_groups = groupsdb.groups_of(user)
+    if CONF["ADMIN_GROUP"] not in user_groups:
+        return (
+            False,
+            "Forbidden: only admin user allowed",
+        )
+    # Everything is fine
+    return (True, "")
+
+
+class _Echo(object):
+    """File like object that gives back what is written, to get csv module output line by line"""
+
+    def write(self, value):
+        return value
+
+
+def export_csv(header, rows):
+    """Iterate over CSV lines of rows. List values are joined with spaces"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow([" ".join(value) if isinstance(value, list) else value for value in row])
+
+
+def export_ndjson(header, rows):
+    """Iterate over rows as JSON objects, one per line"""
+    for row in rows:
+        yield json.dumps(dict(zip(header, row))) + "\n"
+
+
+def chunked(lines, size):
+    """Join lines by chunks of size, to send them with less overhead"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def hash_options():
+    """@return: keyword arguments giving hash scheme and cost of new passwords"""
+    return dict(scheme=CONF["HASH_SCHEME"], cost=CONF["HASH_COST"])
 
 
 def check_password(encrypted_passwd, clear_passwd, mode="md5"):
-    """check that password is correct against its hash
-    TODO: propose to python-htpasswd to integrate this code in his lib"""
-    salt = encrypted_passwd.split("$")[2]  # Extract salt from current encrypted password
-    new_encrypted_passwd = subprocess.check_output(["openssl", "passwd", "-apr1", "-salt", salt, clear_passwd]).decode(
-        "utf-8"
-    )
-    return encrypted_passwd == new_encrypted_passwd
+    """check that password is correct against its hash. Hash scheme (apr1, sha, bcrypt...) is read from the hash
+    itself, mode is kept for compatibility"""
+    return verify_password(encrypted_passwd, clear_passwd)
 
 
 def generate_random_password(length=10):
     """Generate a random password of the desired length, with 1 number, 1 upper case, 1 special char minimum
     @return a generated password of the desired length"""
-    number = random.sample(string.digits, 1)
-    lowercase = random.sample(string.ascii_lowercase, 1)
-    uppercase = random.sample(string.ascii_uppercase, 1)
-    specialchar = random.sample(CONF["PASSWORD_GENERATION_SPECIAL_CHAR"], 1)
-    others = random.sample(
-        string.digits + string.ascii_lowercase + string.ascii_uppercase + CONF["PASSWORD_GENERATION_SPECIAL_CHAR"],
-        length - 4,
+    return generate_password(length, CONF["PASSWORD_GENERATION_SPECIAL_CHAR"])
+
+
+def send_mail(result, mail_suffix, instance, recipients=None):
+    """Send a mail to the users with their newly created/updated password, within current request
+    @param recipients: dict username -> mail address, default to username + mail_suffix
+    @return: list of (username, error message) for mails that could not be sent"""
+    return send_messages(
+        [
+            (username, build_user_mail(username, password, action, mail_suffix, instance, recipients))
+            for username, password, action in result
+        ]
     )
-    bag = number + specialchar + lowercase + uppercase + others
-    random.shuffle(bag)
-    return "".join(bag)
 
 
-def send_mail(result, mail_suffix, instance):
-    """Send a mail to the users with their newly created/updated password"""
+def queue_mail(result, mail_suffix, instance, recipients=None):
+    """Queue a mail to the users with their newly created/updated password, sent in background
+    @param recipients: dict username -> mail address, default to username + mail_suffix
+    @return: mail batch id"""
+    mails = []
     for username, password, action in result:
-        mail = get_mail()
-        with mail.connect() as conn:
-            user_mail = username
-            if mail_suffix is not None:
-                user_mail = user_mail + mail_suffix
-
-            body = render_template(
-                "mail.html",
-                username=username,
-                password=password,
-                action=action,
-                produit=CONF["PRODUCT_NAME"],
-                instance=instance,
-            )
-            subject = "Votre accès à %s" % CONF["PRODUCT_NAME"]
+        message = build_user_mail(username, password, action, mail_suffix, instance, recipients)
+        mails.append((username, message.recipients[0], message.subject, message.body))
+    return get_mail_queue().submit(mails)
+
+
+def send_messages(messages):
+    """Send messages, a list of (key, message).
+    All messages share the same smtp connection, renewed every MAIL_MAX_EMAILS mails by flask-mail.
+    A failure for one recipient does not stop the others
+    @return: list of (key, error message) for messages that could not be sent"""
+    failures = []
+    pending = deque(messages)
+    MAIL_BATCH_SIZE.observe(len(pending))
+    start = time.perf_counter()
+    while pending:
+        connected = False
+        try:
+            with get_mail().connect() as conn:
+                connected = True
+                while pending:
+                    key, message = pending[0]
+                    try:
+                        conn.send(message)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, BadHeaderError) as e:
+                        # Server refused this mail only, connection is still usable
+                        failures.append((key, str(e) or e.__class__.__name__))
+                    pending.popleft()
+        except (smtplib.SMTPException, OSError) as e:
+            if not connected:
+                # Mail server unavailable, don't try again for each remaining message
+                failures.extend((key, str(e)) for key, message in pending)
+                pending.clear()
+            elif pending:
+                # Connection lost while sending current message. Reconnect for the next ones
+                failures.append((pending.popleft()[0], str(e)))
+    MAIL_SEND_SECONDS.observe(time.perf_counter() - start)
+    MAIL_FAILURES.inc(len(failures))
+    return failures
+
+
+def deliver_spooled_mails(mails):
+    """Send mails taken from the spool by a queue worker
+    @return: dict mail id -> error message for mails that could not be sent"""
+    with app.app_context():
+        messages = [
+            (mail_id, Message(body=body, subject=subject, recipients=[recipient]))
+            for mail_id, username, recipient, subject, body in mails
+        ]
+        return dict(send_messages(messages))
+
+
+def build_user_mail(username, password, action, mail_suffix, instance, recipients=None):
+    """@return: the message that gives its password to a user"""
+    user_mail = username
+    if recipients and recipients.get(username):
+        user_mail = recipients[username]
+    elif mail_suffix is not None:
+        user_mail = user_mail + mail_suffix
+
+    body = render_template(
+        "mail.html",
+        username=username,
+        password=password,
+        action=action,
+        produit=CONF["PRODUCT_NAME"],
+        instance=instance,
+    )
+    subject = "Votre accès à %s" % CONF["PRODUCT_NAME"]
 
-            message = Message(body=body, subject=subject, recipients=[user_mail])
-            conn.send(message)
+    return Message(body=body, subject=subject, recipients=[user_mail])
 
 
 def get_mail():
-    """@return an instance of the mail class"""
-    return Mail(app)
+    """@return the mail extension instance, created once for the application"""
+    global mail
+    if mail is None:
+        mail = Mail(app)
+    return mail
+
+
+def get_mail_queue():
+    """@return the background mail queue, created once per spool file"""
+    if CONF["MAIL_SPOOL"] not in mail_queues:
+        spool = MailSpool(CONF["MAIL_SPOOL"])
+        mail_queues[CONF["MAIL_SPOOL"]] = MailQueue(spool, deliver_spooled_mails, workers=CONF["MAIL_QUEUE_WORKERS"])
+    return mail_queues[CONF["MAIL_SPOOL"]]
+
+
+def get_hash_pool():
+    """@return: process pool hashing passwords of user batches, created once per number of workers, or None if
+    there is a single worker"""
+    workers = CONF["HASH_WORKERS"]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 2:
+        return None
+    if workers not in hash_pools:
+        # Forking this multi-threaded process is not safe: workers are forked from a clean server process instead
+        hash_pools[workers] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"))
+        atexit.register(hash_pools[workers].shutdown)
+    return hash_pools[workers]
+
+
+def get_store():
+    """@return: storage backend of users and groups, created once per configuration"""
+    key = (CONF["STORAGE"], CONF["STORAGE_DB"], CONF["PWD_FILE"], CONF["GROUP_FILE"])
+    key += (CONF["WRITE_DELAY"], CONF["WRITE_MAX_PENDING"])
+    key += (CONF["DBM_USERS_FILE"], CONF["DBM_GROUPS_FILE"], CONF["DBM_TYPE"])
+    key += (CONF["JOURNAL_FILE"], CONF["JOURNAL_MAX_ENTRIES"])
+    if key not in stores:
+        journal = Journal(CONF["JOURNAL_FILE"], CONF["JOURNAL_MAX_ENTRIES"]) if CONF["JOURNAL_FILE"] else None
+        users_dbm = groups_dbm = None
+        if CONF["DBM_USERS_FILE"]:
+            users_dbm = DbmFile(CONF["DBM_USERS_FILE"], "users", CONF["DBM_TYPE"])
+        if CONF["DBM_GROUPS_FILE"]:
+            groups_dbm = DbmFile(CONF["DBM_GROUPS_FILE"], "groups", CONF["DBM_TYPE"])
+        if CONF["STORAGE"] == "sqlite":
+            from pydentity_sqlite import SqliteStore
+
+            stores[key] = SqliteStore(
+                CONF["STORAGE_DB"],
+                CONF["PWD_FILE"],
+                CONF["GROUP_FILE"],
+                CONF["WRITE_DELAY"],
+                CONF["WRITE_MAX_PENDING"],
+                users_dbm,
+                groups_dbm,
+                journal,
+            )
+        else:
+            stores[key] = FileStore(
+                CONF["PWD_FILE"],
+                CONF["GROUP_FILE"],
+                users_cache,
+                groups_cache,
+                CONF["WRITE_DELAY"],
+                CONF["WRITE_MAX_PENDING"],
+                users_dbm,
+                groups_dbm,
+                journal,
+            )
+    return stores[key]
+
+
+def get_userdb():
+    """@return: users, shared between requests and read only. Use edit_userdb() to change them"""
+    return get_store().get_users()
+
+
+def get_groupdb():
+    """@return: groups, shared between requests and read only. Use edit_groupdb() to change them"""
+    return get_store().get_groups()
+
+
+def edit_userdb(flush=False):
+    """Open users for modification. They are saved at the end of the with block, only if modified.
+    Changes are written to disk after WRITE_DELAY, unless flush is True"""
+    return get_store().edit_users(flush)
+
+
+def edit_groupdb(flush=False):
+    """Open groups for modification. They are saved at the end of the with block, only if modified.
+    Changes are written to disk after WRITE_DELAY, unless flush is True"""
+    return get_store().edit_groups(flush)
 
 
 def get_remote_user(request):
@@ -0,0 +1,182 @@
+# coding: utf-8
+"""
+Check of http basic credentials and group membership for nginx auth_request, from an in-memory copy of htpasswd and
+htgroup files. It is served by pydentity itself or by the standalone WSGI application of this module
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+
+Usage: python pydentity_auth.py --users htpasswd --groups htgroup [--port 8081]
+"""
+
+import argparse
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from pydentity_metrics import AUTH_REQUESTS
+from pydentity_passwd import UnsupportedHashError, hash_password, verify_password
+from pydentity_store import FileStore
+
+
+class CredentialCache(object):
+    """Short lived LRU cache of successful password checks, so that repeated requests of a user skip the slow hash.
+    Entries are keyed by a HMAC of login and password with a secret of this process: clear passwords are not kept.
+    An entry is only valid for the password hash it was checked against: a password change invalidates it at once.
+    Passwords of unknown users are checked against a dummy hash of scheme and cost, the ones of new passwords"""
+
+    def __init__(self, size=10000, ttl=60, scheme="apr1", cost=None):
+        self.size = size
+        self.ttl = ttl
+        self.scheme = scheme
+        self.cost = cost
+        self._secret = secrets.token_bytes(32)
+        self._entries = OrderedDict()  # key -> (expiration time, password hash)
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+
+    def _key(self, user, password):
+        message = user.encode("utf-8") + b"\0" + password.encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def check(self, user, password, password_hash):
+        """Check password of user against its password_hash, from cache if it was checked recently
+        @return: tuple (True if password matches, True if answer comes from cache)"""
+        key = self._key(user, password)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now and entry[1] == password_hash:
+                    self._entries.move_to_end(key)
+                    return True, True
+                del self._entries[key]
+        try:
+            valid = verify_password(password_hash, password)
+        except UnsupportedHashError:
+            valid = False
+        if valid and self.size > 0:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, password_hash)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return valid, False
+
+    def check_unknown(self, password):
+        """Spend the time of a password check for a user that does not exist, so that answer time does not tell which
+        users exist"""
+        if self._dummy_hash is None:
+            self._dummy_hash = hash_password(secrets.token_urlsafe(16), self.scheme, self.cost)
+        verify_password(self._dummy_hash, password)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def parse_basic(authorization):
+    """@return: (user, password) from a http basic Authorization header value, or None if it is not one"""
+    if not authorization:
+        return None
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() != "basic":
+        return None
+    try:
+        decoded = base64.b64decode(credentials.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    try:
+        decoded = decoded.decode("utf-8")
+    except UnicodeDecodeError:
+        decoded = decoded.decode("latin-1")
+    user, separator, password = decoded.partition(":")
+    if not separator or not user:
+        return None
+    return user, password
+
+
+def required_groups(query_groups, header):
+    """@return: groups given as group query arguments and in X-Auth-Group header value, comma separated"""
+    return list(query_groups) + [group.strip() for group in (header or "").split(",") if group.strip()]
+
+
+def authenticate(store, cache, authorization, groups=()):
+    """Check credentials of an Authorization header, and that user belongs to one of groups if any is given
+    @param store: storage backend of users and groups (FileStore or SqliteStore)
+    @return: tuple (http status: 200, 401 or 403, user or None)"""
+    credentials = parse_basic(authorization)
+    if credentials is None:
+        AUTH_REQUESTS.inc(1, "missing")
+        return 401, None
+    user, password = credentials
+    try:
+        password_hash = store.get_users().get_hash(user)
+    except KeyError:
+        cache.check_unknown(password)
+        AUTH_REQUESTS.inc(1, "invalid")
+        return 401, None
+    valid, cached = cache.check(user, password, password_hash)
+    if not valid:
+        AUTH_REQUESTS.inc(1, "invalid")
+        return 401, None
+    # Membership is checked each time so that removal from a group applies at once
+    if groups and not store.get_groups().groups_of(user).intersection(groups):
+        AUTH_REQUESTS.inc(1, "forbidden")
+        return 403, user
+    AUTH_REQUESTS.inc(1, "cached" if cached else "verified")
+    return 200, user
+
+
+class AuthApp(object):
+    """Minimal WSGI application answering nginx auth_request subrequests, without pydentity pages. Required groups are
+    given as group query arguments (any of them is enough) or as a comma separated X-Auth-Group header"""
+
+    STATUS = {200: "200 OK", 401: "401 Unauthorized", 403: "403 Forbidden"}
+
+    def __init__(self, store, cache=None, realm="pydentity"):
+        self.store = store
+        self.cache = cache or CredentialCache()
+        self.realm = realm
+
+    def __call__(self, environ, start_response):
+        query_groups = parse_qs(environ.get("QUERY_STRING", "")).get("group", [])
+        groups = required_groups(query_groups, environ.get("HTTP_X_AUTH_GROUP"))
+        status, user = authenticate(self.store, self.cache, environ.get("HTTP_AUTHORIZATION"), groups)
+        headers = [("Content-Type", "text/plain"), ("Content-Length", "0"), ("Cache-Control", "no-store")]
+        if user is not None:
+            headers.append(("X-Auth-User", user))
+        if status == 401:
+            headers.append(("WWW-Authenticate", 'Basic realm="%s"' % self.realm))
+        start_response(self.STATUS[status], headers)
+        return [b""]
+
+
+def create_app(users_path, groups_path, cache_size=10000, ttl=60, realm="pydentity"):
+    """@return: standalone auth WSGI application for these htpasswd and htgroup files"""
+    return AuthApp(FileStore(users_path, groups_path), CredentialCache(cache_size, ttl), realm)
+
+
+def main(argv=None):
+    from wsgiref.simple_server import make_server
+
+    parser = argparse.ArgumentParser(description="Check credentials for nginx auth_request from htpasswd and htgroup")
+    parser.add_argument("--users", required=True, help="htpasswd file")
+    parser.add_argument("--groups", required=True, help="htgroup file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--cache-size", type=int, default=10000, help="successful checks kept in cache")
+    parser.add_argument("--ttl", type=float, default=60, help="seconds a successful check is kept")
+    parser.add_argument("--realm", default="pydentity")
+    args = parser.parse_args(argv)
+    app = create_app(args.users, args.groups, args.cache_size, args.ttl, args.realm)
+    make_server(args.host, args.port, app).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# coding: utf-8
+"""
+Benchmark of pydentity routes on synthetic htpasswd and htgroup files
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+
+Usage: python pydentity_bench.py --users 1000 10000 --groups 10 100 --output bench.json [--baseline baseline.json]
+       python pydentity_bench.py --tune-hash bcrypt --target-ms 100
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pydentity_passwd import SHA_CRYPT_DEFAULT_ROUNDS, hash_password, md5_crypt, verify_password
+
+ADMIN = "bench_admin"
+PASSWORD = "Bench!password1"
+# Hashing is slow on purpose: all synthetic users share the same hash
+PASSWORD_HASH = md5_crypt(PASSWORD, "benchslt")
+
+
+def generate_files(directory, users, groups, seed=0):
+    """Write htpasswd and htgroup files with users and groups. Membership is skewed: a few groups hold most users
+    and some users are in no group at all
+    @return: (htpasswd path, htgroup path, list of logins, list of groups)"""
+    rng = random.Random(seed)
+    logins = ["user%06d" % i for i in range(users)]
+    group_names = ["admin"] + ["group%04d" % i for i in range(groups - 1)]
+    weights = [1.0 / (i + 1) for i in range(len(group_names))]
+    members = dict((group, []) for group in group_names)
+    members["admin"].append(ADMIN)
+    for login in logins:
+        count = min(int(rng.expovariate(0.7)), len(group_names))
+        for group in set(rng.choices(group_names, weights, k=count)):
+            members[group].append(login)
+
+    passwd = os.path.join(directory, "htpasswd")
+    group_file = os.path.join(directory, "htgroup")
+    with open(passwd, "w") as f:
+        f.writelines("%s:%s\n" % (login, PASSWORD_HASH) for login in [ADMIN] + logins)
+    with open(group_file, "w") as f:
+        f.writelines("%s: %s\n" % (group, " ".join(members[group])) for group in group_names)
+    return passwd, group_file, logins, group_names
+
+
+def scenarios(logins, groups):
+    """@return: list of (name, method, url, request arguments) driven for each file size"""
+    rng = random.Random(1)
+    user = rng.choice(logins)
+    batch = "\r\n".join(rng.sample(logins, min(50, len(logins))) + ["bench_new%02d" % i for i in range(10)])
+    bulk = [{"op": "put_user", "username": "bench_bulk%03d" % i, "groups": [groups[-1]]} for i in range(100)]
+    return [
+        ("list_users", "GET", "/list_users", {}),
+        ("list_users_search", "GET", "/list_users?q=user00&sort=-groups&page=2", {}),
+        ("list_groups", "GET", "/list_groups", {}),
+        ("stats", "GET", "/stats", {}),
+        ("group", "GET", "/group/%s?candidate=user1" % groups[1 % len(groups)], {}),
+        ("user", "GET", "/user/%s" % user, {}),
+        (
+            "change_password",
+            "POST",
+            "/user/%s" % user,
+            {"data": {"new_password": PASSWORD, "repeat_password": PASSWORD, "old_password": ""}},
+        ),
+        ("batch_user_creation", "POST", "/batch_user_creation", {"data": {"users_login": batch, "group_admin": ""}}),
+        ("api_user", "GET", "/api/users/%s" % user, {}),
+        ("api_put_user", "PUT", "/api/users/%s" % user, {"json": {"groups": groups[:2]}}),
+        ("api_bulk", "POST", "/api/bulk", {"json": {"operations": bulk}}),
+    ]
+
+
+def percentile(values, fraction):
+    """@return: value below which fraction of sorted values are"""
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run(users, groups, requests=20, warmup=2, seed=0):
+    """Drive all scenarios on generated files
+    @return: dict scenario name -> measures. Latencies are in milliseconds, peak memory in KiB"""
+    from pydentity import CONF, app, groups_cache, stores, users_cache
+
+    directory = tempfile.mkdtemp(prefix="pydentity_bench")
+    saved_conf = dict(CONF)
+    try:
+        passwd, group_file, logins, group_names = generate_files(directory, users, groups, seed)
+        CONF.update(PWD_FILE=passwd, GROUP_FILE=group_file, ENABLE_MAIL_CAPABILITIES=False, URL_PREFIX="")
+        CONF["STORAGE_DB"] = os.path.join(directory, "pydentity.sqlite")
+        # Measure page rendering, not rendered page cache hits
+        CONF["PAGE_CACHE_SIZE"] = 0
+        users_cache.invalidate()
+        groups_cache.invalidate()
+        stores.clear()
+        client = app.test_client()
+        environ = {"REMOTE_USER": ADMIN}
+        results = {}
+        for name, method, url, kwargs in scenarios(logins, group_names):
+            for i in range(warmup):
+                response = client.open(url, method=method, environ_base=environ, **kwargs)
+                if response.status_code >= 400:
+                    raise RuntimeError("%s %s failed with status %s" % (method, url, response.status_code))
+            latencies = []
+            start = time.perf_counter()
+            for i in range(requests):
+                request_start = time.perf_counter()
+                client.open(url, method=method, environ_base=environ, **kwargs)
+                latencies.append((time.perf_counter() - request_start) * 1000)
+            elapsed = time.perf_counter() - start
+            # Memory is traced apart as tracing slows everything down
+            tracemalloc.start()
+            client.open(url, method=method, environ_base=environ, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            latencies.sort()
+            results[name] = {
+                "p50": round(percentile(latencies, 0.5), 3),
+                "p90": round(percentile(latencies, 0.9), 3),
+                "p99": round(percentile(latencies, 0.99), 3),
+                "mean": round(sum(latencies) / len(latencies), 3),
+                "throughput": round(requests / elapsed, 1),
+                "peak_memory": peak // 1024,
+            }
+        return results
+    finally:
+        stores.clear()
+        users_cache.invalidate()
+        groups_cache.invalidate()
+        CONF.update(saved_conf)
+        shutil.rmtree(directory)
+
+
+def verify_time(scheme, cost, samples=5):
+    """@return: median milliseconds to check a password hashed with scheme and cost"""
+    password_hash = hash_password(PASSWORD, scheme, cost)
+    timings = []
+    for i in range(samples):
+        start = time.perf_counter()
+        verify_password(password_hash, PASSWORD)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return percentile(timings, 0.5)
+
+
+def tune_cost(scheme, target_ms, samples=5):
+    """Find the cost (HASH_COST) of scheme whose password check takes the closest to target_ms on this machine
+    @return: (cost, check time in milliseconds)"""
+    if scheme == "bcrypt":
+        # Each cost step doubles check time
+        best = None
+        for cost in range(4, 32):
+            elapsed = verify_time(scheme, cost, samples)
+            if best is None or abs(elapsed - target_ms) < abs(best[1] - target_ms):
+                best = (cost, elapsed)
+            if elapsed >= target_ms:
+                break
+        return best
+    if scheme in ("sha256", "sha512"):
+        # Check time is proportional to rounds
+        elapsed = verify_time(scheme, SHA_CRYPT_DEFAULT_ROUNDS, samples)
+        cost = int(min(max(round(SHA_CRYPT_DEFAULT_ROUNDS * target_ms / elapsed, -3), 1000), 999999999))
+        return cost, verify_time(scheme, cost, samples)
+    raise ValueError("Hash scheme %s has no cost" % scheme)
+
+
+def compare(results, baseline, tolerance):
+    """@return: list of (size, scenario, measure, baseline value, value) that are more than tolerance times worse
+    than baseline"""
+    regressions = []
+    for size, measures in results["sizes"].items():
+        for name, values in measures.items():
+            reference = baseline.get("sizes", {}).get(size, {}).get(name)
+            if reference is None:
+                continue
+            for measure in ("p50", "p90", "peak_memory"):
+                if values[measure] > reference[measure] * tolerance:
+                    regressions.append((size, name, measure, reference[measure], values[measure]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pydentity routes on synthetic files")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000], help="numbers of users")
+    parser.add_argument("--groups", type=int, nargs="+", default=[10, 100], help="numbers of groups")
+    parser.add_argument("--requests", type=int, default=20, help="measured requests per route")
+    parser.add_argument("--storage", choices=("files", "sqlite"), default="files", help="storage backend")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slow down ratio against baseline")
+    parser.add_argument(
+        "--tune-hash", choices=("sha256", "sha512", "bcrypt"), help="only find HASH_COST of this scheme for --target-ms"
+    )
+    parser.add_argument("--target-ms", type=float, default=100, help="password check time wanted by --tune-hash")
+    args = parser.parse_args(argv)
+
+    if args.tune_hash:
+        cost, elapsed = tune_cost(args.tune_hash, args.target_ms)
+        print('HASH_SCHEME "%s", HASH_COST %s: password check takes %.1f ms' % (args.tune_hash, cost, elapsed))
+        return 0
+
+    from pydentity import CONF
+
+    CONF["STORAGE"] = args.storage
+    results = {"python": platform.python_version(), "storage": args.storage, "requests": args.requests, "sizes": {}}
+    for users in args.users:
+        for groups in args.groups:
+            size = "%s users, %s groups" % (users, groups)
+            print(size)
+            measures = run(users, groups, args.requests)
+            results["sizes"][size] = measures
+            for name, values in measures.items():
+                print(
+                    "  %-20s p50 %9.2f ms  p90 %9.2f ms  p99 %9.2f ms  %8.1f req/s  %8d KiB"
+                    % (name, values["p50"], values["p90"], values["p99"], values["throughput"], values["peak_memory"])
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for size, name, measure, reference, value in regressions:
+            print("REGRESSION %s, %s %s: %s -> %s" % (size, name, measure, reference, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# coding: utf-8
+"""
+Apache DBM user and group databases (mod_authn_dbm, mod_authz_dbm) kept in sync with htpasswd and htgroup files
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import importlib
+import os
+import shutil
+import tempfile
+
+
+class DbmFile(object):
+    """DBM database written from a htpasswd file (kind "users": login -> password hash, for AuthDBMUserFile) or from a
+    htgroup file (kind "groups": login -> comma separated groups, for AuthDBMGroupFile).
+    Apache finds a user with one lookup instead of scanning the whole text file.
+    Database is never changed in place: changed entries are written to a copy which replaces it, so apache never
+    reads a half written database. Replacement is atomic with single file DBM types (gnu, ndbm built on Berkeley DB)"""
+
+    def __init__(self, path, kind, dbm_type="gnu"):
+        self.path = path
+        self.kind = kind
+        self.module = importlib.import_module("dbm.%s" % dbm_type)
+        self.version = None  # version of the text file database was last written from
+        self.files = None  # names of files making up the database
+
+    def records(self, parsed):
+        """Iterate over (key, value) of all database entries, from parsed Users or Groups"""
+        if self.kind == "users":
+            for user in parsed:
+                yield user, parsed.get_hash(user)
+        else:
+            for user, groups in parsed.user_groups.items():
+                if groups:
+                    yield user, ",".join(sorted(groups))
+
+    def record(self, parsed, user):
+        """@return: database value of user, or None if it has no entry"""
+        if self.kind == "users":
+            return parsed.get_hash(user) if user in parsed else None
+        return ",".join(sorted(parsed.groups_of(user))) or None
+
+    def exists(self):
+        """@return: True if all files written last time are still there"""
+        if self.files is None:
+            return False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        return all(os.path.exists(os.path.join(directory, name)) for name in self.files)
+
+    def sync(self, parsed, changes, base_version, version):
+        """Update database after the text file went from base_version to version with changes. Only changed users are
+        written, unless the text file was changed by someone else since database was written: then all are"""
+        if base_version is None or base_version != self.version or not self.exists():
+            self.rebuild(parsed, version)
+            return
+        users = set(change[1] for change in changes)
+
+        def update(db):
+            for user in users:
+                value = self.record(parsed, user)
+                if value is not None:
+                    db[user.encode("utf-8")] = value.encode("utf-8")
+                elif user.encode("utf-8") in db:
+                    del db[user.encode("utf-8")]
+
+        self._write(update, copy=True)
+        self.version = version
+
+    def rebuild(self, parsed, version=None):
+        """Write all database entries from parsed Users or Groups"""
+
+        def fill(db):
+            for key, value in self.records(parsed):
+                db[key.encode("utf-8")] = value.encode("utf-8")
+
+        self._write(fill, copy=False)
+        self.version = version
+
+    def _write(self, fill, copy):
+        """Fill a new database, or a copy of the current one, in a private directory then move its files over the
+        current ones"""
+        directory, name = os.path.split(os.path.abspath(self.path))
+        tmp_dir = tempfile.mkdtemp(prefix=".%s." % name, dir=directory)
+        try:
+            tmp_path = os.path.join(tmp_dir, name)
+            if copy:
+                for file_name in self.files:
+                    shutil.copy2(os.path.join(directory, file_name), os.path.join(tmp_dir, file_name))
+            db = self.module.open(tmp_path, "w" if copy else "n", 0o644)
+            try:
+                fill(db)
+            finally:
+                db.close()
+            files = sorted(os.listdir(tmp_dir))
+            for file_name in files:
+                os.replace(os.path.join(tmp_dir, file_name), os.path.join(directory, file_name))
+            self.files = files
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,248 @@
+# coding: utf-8
+"""
+Sequenced journal of changes written to htpasswd and htgroup files, and replicas that pull them: other nodes get only
+the changes made since their last pull instead of whole files
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+
+Usage: python pydentity_journal.py --url https://master/journal --users htpasswd --groups htgroup [--interval 30]
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from pydentity_store import Groups, Users, atomic_write, file_lock, stat_version
+
+# Journaled files and their parser
+FILES = {"users": Users, "groups": Groups}
+
+
+def checksum(lines):
+    """@return: sha256 of file content given as lines"""
+    return hashlib.sha256("".join(lines).encode("utf-8")).hexdigest()
+
+
+def diff_users(old, new):
+    """@return: changes that turn Users old into new"""
+    changes = [
+        ("set", user, new.entries[user], user not in old) for user in new if old.entries.get(user) != new.entries[user]
+    ]
+    return changes + [("pop", user) for user in old if user not in new]
+
+
+def diff_groups(old, new):
+    """@return: changes that turn Groups old into new"""
+    changes = [("add_user", user, group) for group, user in new.memberships() if not old.is_user_in(user, group)]
+    deleted = [(user, group) for group, user in old.memberships() if not new.is_user_in(user, group)]
+    return changes + [("delete_user", user, group) for user, group in deleted]
+
+
+class Journal(object):
+    """Append only file of changes, one JSON object per line: {"seq": 12, "file": "users", "change": ["pop", "bob"]}.
+    Sequence numbers are shared by both files. Changes are "set" and "pop" for users, "add_user" and "delete_user" for
+    groups, as recorded by Users and Groups. Changes written at once are appended at once; the last one carries the
+    checksum of the file after them so that replicas detect drift (master file edited by hand for instance).
+    Journal is compacted to its last max_entries changes once it holds twice that many: replicas late by more than that
+    get whole files"""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._tail = None  # (journal version, number of changes, last sequence number)
+        self._lock = threading.Lock()
+
+    def _entries(self):
+        """@return: journal changes. An incomplete last line, being appended, is left out"""
+        try:
+            with open(self.path, "r") as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return []
+        return [json.loads(line) for line in lines if line.endswith("\n")]
+
+    def _last(self):
+        """@return: (number of changes, last sequence number), read again only if someone else appended"""
+        try:
+            version = stat_version(os.stat(self.path))
+        except FileNotFoundError:
+            return 0, 0
+        if self._tail is None or self._tail[0] != version:
+            entries = self._entries()
+            self._tail = (version, len(entries), entries[-1]["seq"] if entries else 0)
+        return self._tail[1:]
+
+    def last_seq(self):
+        """@return: sequence number of the last change"""
+        with self._lock:
+            return self._last()[1]
+
+    def append(self, name, changes, lines):
+        """Record changes written to file name ("users" or "groups"), whose content is now lines. Must be called under
+        the lock of that file so that journal order is the order of writes"""
+        if not changes:
+            return
+        with self._lock, file_lock(self.path):
+            count, seq = self._last()
+            entries = [{"seq": seq + i + 1, "file": name, "change": list(change)} for i, change in enumerate(changes)]
+            entries[-1]["checksum"] = checksum(lines)
+            data = "".join(json.dumps(entry) + "\n" for entry in entries).encode("utf-8")
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+                version = stat_version(os.fstat(fd))
+            finally:
+                os.close(fd)
+            self._tail = (version, count + len(entries), entries[-1]["seq"])
+            if self._tail[1] >= 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        """Keep only the last max_entries changes"""
+        entries = self._entries()[-self.max_entries :]
+        version = atomic_write(self.path, [json.dumps(entry) + "\n" for entry in entries])
+        self._tail = (version, len(entries), entries[-1]["seq"] if entries else 0)
+
+    def read(self, since):
+        """@return: {"last": sequence number, "changes": changes after since}, or None if they are not all in journal
+        anymore (or since is unknown): whole files are needed then, see snapshot()"""
+        entries = self._entries()
+        # Don't give a batch of changes being appended
+        while entries and "checksum" not in entries[-1]:
+            entries.pop()
+        last = entries[-1]["seq"] if entries else 0
+        first = entries[0]["seq"] if entries else 1
+        if since > last or since < first - 1:
+            return None
+        return {"last": last, "changes": [entry for entry in entries if entry["seq"] > since]}
+
+    def snapshot(self, paths):
+        """@param paths: dict of file name ("users" or "groups") -> path
+        @return: {"snapshot": {name: {"seq": sequence number content is up to date with, "content": text}}}"""
+        snapshot = {}
+        for name, path in paths.items():
+            # Changes of a file are appended under its lock: none can be missing from content nor counted twice
+            with file_lock(path):
+                with open(path, "r") as content_file:
+                    snapshot[name] = {"seq": self.last_seq(), "content": content_file.read()}
+        return {"snapshot": snapshot}
+
+
+class Replica(object):
+    """Local copy of htpasswd and htgroup files kept up to date from the journal of a pydentity master. Sequence number
+    each file is up to date with is kept in state_path"""
+
+    def __init__(self, users_path, groups_path, state_path):
+        self.paths = {"users": users_path, "groups": groups_path}
+        self.state_path = state_path
+
+    def load_state(self):
+        """@return: dict file name -> sequence number, or None if files were never pulled"""
+        try:
+            with open(self.state_path, "r") as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self, state):
+        atomic_write(self.state_path, [json.dumps(state, sort_keys=True) + "\n"])
+
+    def sync(self, fetch):
+        """Pull and apply changes made since last sync, or whole files on first sync or if drift is detected
+        @param fetch: function(since, snapshot) returning the answer of master journal page
+        @return: number of changes applied, or None if whole files were written"""
+        state = self.load_state()
+        if state is not None:
+            data = fetch(min(state.values()), False)
+            if "changes" in data:
+                applied = self.apply_changes(state, data)
+                if applied is not None:
+                    return applied
+            else:
+                self.apply_snapshot(data)
+                return None
+        self.apply_snapshot(fetch(0, True))
+        return None
+
+    def apply_changes(self, state, data):
+        """Apply changes of a journal read to files
+        @return: number of changes applied, or None if a file checksum does not match the master one"""
+        applied = 0
+        results = {}
+        for name, path in self.paths.items():
+            entries = [entry for entry in data["changes"] if entry["file"] == name and entry["seq"] > state[name]]
+            if not entries:
+                continue
+            parsed = FILES[name].from_file(path)
+            parsed.replay([tuple(entry["change"]) for entry in entries])
+            lines = parsed.serialize()
+            if checksum(lines) != entries[-1]["checksum"]:
+                return None
+            results[name] = lines
+            applied += len(entries)
+        for name, lines in results.items():
+            with file_lock(self.paths[name]):
+                atomic_write(self.paths[name], lines)
+        self.save_state(dict((name, max(state[name], data["last"])) for name in self.paths))
+        return applied
+
+    def apply_snapshot(self, data):
+        """Write whole files of a journal snapshot"""
+        for name, path in self.paths.items():
+            with file_lock(path):
+                atomic_write(path, [data["snapshot"][name]["content"]])
+        self.save_state(dict((name, data["snapshot"][name]["seq"]) for name in self.paths))
+
+
+def http_fetcher(url, user=None, password=None, timeout=30):
+    """@return: fetch function for Replica.sync() reading journal page of master at url, with http basic credentials"""
+
+    def fetch(since, snapshot):
+        query = {"since": since}
+        if snapshot:
+            query["snapshot"] = 1
+        request = urllib.request.Request(url + "?" + urllib.parse.urlencode(query))
+        if user is not None:
+            credentials = base64.b64encode(("%s:%s" % (user, password)).encode("utf-8")).decode("ascii")
+            request.add_header("Authorization", "Basic %s" % credentials)
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+
+    return fetch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep htpasswd and htgroup files in sync with a pydentity master")
+    parser.add_argument("--url", required=True, help="journal page of master, like https://master/journal")
+    parser.add_argument("--users", required=True, help="local htpasswd file")
+    parser.add_argument("--groups", required=True, help="local htgroup file")
+    parser.add_argument("--state", help="file keeping last sequence numbers. Default to htpasswd file + .seq")
+    parser.add_argument("--user", help="http basic login of a pydentity admin")
+    parser.add_argument("--password", default=os.environ.get("PYDENTITY_PASSWORD"), help="or PYDENTITY_PASSWORD")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between pulls. Default: pull once")
+    args = parser.parse_args(argv)
+    replica = Replica(args.users, args.groups, args.state or args.users + ".seq")
+    fetch = http_fetcher(args.url, args.user, args.password)
+    while True:
+        try:
+            applied = replica.sync(fetch)
+            print("Whole files written" if applied is None else "%s changes applied" % applied)
+        except Exception as e:
+            if not args.interval:
+                raise
+            print("Error while pulling changes: %s" % e, file=sys.stderr)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
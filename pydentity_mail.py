@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Persistent mail queue, delivered in background by a pool of worker threads
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mail (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id INTEGER NOT NULL REFERENCES batch(id),
+    username TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    claimed REAL
+);
+CREATE INDEX IF NOT EXISTS mail_status ON mail(status);
+CREATE INDEX IF NOT EXISTS mail_batch ON mail(batch_id);
+"""
+
+PENDING, SENDING, SENT, FAILED = "pending", "sending", "sent", "failed"
+
+
+class MailSpool(object):
+    """Mails waiting to be sent, stored in a SQLite database shared by all processes.
+    Mail body holds the user password: the file is only readable by its owner and bodies are wiped once sent"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        """@return: sqlite connection of current thread"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def add_batch(self, mails):
+        """Queue mails, a list of (username, recipient, subject, body)
+        @return: batch id"""
+        with self._transaction() as db:
+            batch_id = db.execute("INSERT INTO batch (created) VALUES (?)", (time.time(),)).lastrowid
+            db.executemany(
+                "INSERT INTO mail (batch_id, username, recipient, subject, body) VALUES (?, ?, ?, ?, ?)",
+                [(batch_id,) + tuple(mail) for mail in mails],
+            )
+        return batch_id
+
+    def claim(self, limit, stale_after):
+        """Take ownership of up to limit pending mails. Mails claimed more than stale_after seconds ago by a worker
+        that died are claimed again
+        @return: list of (id, username, recipient, subject, body)"""
+        worker = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE mail SET status = ?, worker = ?, claimed = ?, attempts = attempts + 1 WHERE id IN "
+                "(SELECT id FROM mail WHERE status = ? OR (status = ? AND claimed < ?) ORDER BY id LIMIT ?)",
+                (SENDING, worker, now, PENDING, SENDING, now - stale_after, limit),
+            )
+            return db.execute(
+                "SELECT id, username, recipient, subject, body FROM mail WHERE worker = ? ORDER BY id", (worker,)
+            ).fetchall()
+
+    def finish(self, mail_ids, failures):
+        """Record delivery result of claimed mails
+        @param failures: dict mail id -> error message for mails that were not sent"""
+        with self._transaction() as db:
+            for mail_id in mail_ids:
+                if mail_id in failures:
+                    db.execute(
+                        "UPDATE mail SET status = ?, error = ?, worker = NULL WHERE id = ?",
+                        (FAILED, failures[mail_id], mail_id),
+                    )
+                else:
+                    db.execute(
+                        "UPDATE mail SET status = ?, error = NULL, body = NULL, worker = NULL WHERE id = ?",
+                        (SENT, mail_id),
+                    )
+
+    def retry(self, batch_id):
+        """Queue again failed mails of a batch
+        @return: number of mails queued again"""
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE mail SET status = ?, error = NULL WHERE batch_id = ? AND status = ?",
+                (PENDING, batch_id, FAILED),
+            ).rowcount
+
+    def status(self, batch_id):
+        """@return: dict with count of mails per status and failures, a list of (username, recipient, error).
+        None if batch does not exist"""
+        db = self._db()
+        if db.execute("SELECT id FROM batch WHERE id = ?", (batch_id,)).fetchone() is None:
+            return None
+        counts = dict((status, 0) for status in (PENDING, SENDING, SENT, FAILED))
+        for status, count in db.execute(
+            "SELECT status, COUNT(*) FROM mail WHERE batch_id = ? GROUP BY status", (batch_id,)
+        ):
+            counts[status] = count
+        counts["failures"] = db.execute(
+            "SELECT username, recipient, error FROM mail WHERE batch_id = ? AND status = ? ORDER BY id",
+            (batch_id, FAILED),
+        ).fetchall()
+        return counts
+
+
+class MailQueue(object):
+    """Deliver spooled mails with a pool of background threads, started on first use.
+    deliver is called with a list of (id, username, recipient, subject, body) and returns a dict
+    mail id -> error message for mails that could not be sent"""
+
+    def __init__(self, spool, deliver, workers=2, chunk_size=50, poll_interval=5, stale_after=600):
+        self.spool = spool
+        self.deliver = deliver
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start worker threads if not already running"""
+        with self._lock:
+            self._stopped = False
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="pydentity-mail", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stop worker threads once they are done with their current mails"""
+        with self._lock:
+            self._stopped = True
+            threads, self._threads = self._threads, []
+        self._wakeup.set()
+        for thread in threads:
+            thread.join()
+
+    def submit(self, mails):
+        """Queue mails, a list of (username, recipient, subject, body), for background delivery
+        @return: batch id"""
+        batch_id = self.spool.add_batch(mails)
+        self.start()
+        self._wakeup.set()
+        return batch_id
+
+    def retry(self, batch_id):
+        """Queue again failed mails of a batch
+        @return: number of mails queued again"""
+        count = self.spool.retry(batch_id)
+        if count:
+            self.start()
+            self._wakeup.set()
+        return count
+
+    def status(self, batch_id):
+        """@return: delivery status of batch, see MailSpool.status()"""
+        return self.spool.status(batch_id)
+
+    def wait(self, batch_id, timeout=30):
+        """Wait until all mails of batch have been processed
+        @return: True if batch is done, False on timeout"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = self.status(batch_id)
+            if status is None or status[PENDING] + status[SENDING] == 0:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def _work(self):
+        while not self._stopped:
+            try:
+                mails = self.spool.claim(self.chunk_size, self.stale_after)
+                if not mails:
+                    # Poll from time to time for mails queued by other processes
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                try:
+                    failures = self.deliver(mails)
+                except Exception as e:
+                    failures = dict((mail[0], str(e)) for mail in mails)
+                self.spool.finish([mail[0] for mail in mails], failures)
+            except sqlite3.Error:
+                # Database busy or unavailable. Mails will be claimed again once stale
+                time.sleep(self.poll_interval)
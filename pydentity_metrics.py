@@ -0,0 +1,155 @@
+# coding: utf-8
+"""
+Counters and histograms of this process, exposed in Prometheus text format
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """All metrics of the process"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """@return: all metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(object):
+    """Value that only goes up, per label values"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ["%s%s %s" % (self.name, _labels(self.labels, key), _number(value)) for key, value in values]
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets, per label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values = {}  # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * len(self.buckets), 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe duration of the with block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        return sum(self._values.get(label_values, [()])[0])
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append("%s_bucket%s %s" % (self.name, _labels(self.labels, key, le), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, key), _number(total)))
+            lines.append("%s_count%s %s" % (self.name, _labels(self.labels, key), cumulative))
+        return lines
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram(
+    "pydentity_request_duration_seconds", "Time to handle a request", ("endpoint", "method", "status")
+)
+FILE_PARSE_SECONDS = Histogram("pydentity_file_parse_seconds", "Time to parse a htpasswd or htgroup file", ("file",))
+FILE_READ_BYTES = Counter("pydentity_file_read_bytes_total", "Bytes of htpasswd and htgroup files parsed", ("file",))
+FILE_WRITE_SECONDS = Histogram("pydentity_file_write_seconds", "Time to write a htpasswd or htgroup file", ("file",))
+FILE_WRITE_BYTES = Counter("pydentity_file_write_bytes_total", "Bytes of htpasswd and htgroup files written", ("file",))
+PASSWORD_HASH_SECONDS = Histogram("pydentity_password_hash_seconds", "Time to hash a new password", ("scheme",))
+PASSWORD_VERIFY_SECONDS = Histogram(
+    "pydentity_password_verify_seconds", "Time to check a password against its hash", ("scheme",)
+)
+PAGE_CACHE_REQUESTS = Counter(
+    "pydentity_page_cache_requests_total", "Requests of cached pages: hit, miss or not_modified", ("endpoint", "result")
+)
+AUTH_REQUESTS = Counter(
+    "pydentity_auth_requests_total",
+    "Credential checks by result: verified, cached, invalid, missing or forbidden",
+    ("result",),
+)
+MAIL_SEND_SECONDS = Histogram("pydentity_mail_send_seconds", "Time to send a batch of mails")
+MAIL_BATCH_SIZE = Histogram("pydentity_mail_batch_size", "Number of mails sent together", buckets=SIZE_BUCKETS)
+MAIL_FAILURES = Counter("pydentity_mail_failures_total", "Mails that could not be sent")
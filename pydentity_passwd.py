@@ -0,0 +1,309 @@
+# coding: utf-8
+"""
+Password hashes found in apache htpasswd files, computed in process
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import base64
+import hashlib
+import hmac
+import secrets
+import string
+import time
+
+from pydentity_metrics import PASSWORD_HASH_SECONDS, PASSWORD_VERIFY_SECONDS
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+try:
+    import crypt
+except ImportError:  # Removed from python 3.13
+    crypt = None
+
+
+ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Order in which digest bytes are encoded, by groups of three bytes
+MD5_CRYPT_ORDER = ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5))
+SHA256_CRYPT_ORDER = (
+    (0, 10, 20),
+    (21, 1, 11),
+    (12, 22, 2),
+    (3, 13, 23),
+    (24, 4, 14),
+    (15, 25, 5),
+    (6, 16, 26),
+    (27, 7, 17),
+    (18, 28, 8),
+    (9, 19, 29),
+)
+SHA512_CRYPT_ORDER = (
+    (0, 21, 42),
+    (22, 43, 1),
+    (44, 2, 23),
+    (3, 24, 45),
+    (25, 46, 4),
+    (47, 5, 26),
+    (6, 27, 48),
+    (28, 49, 7),
+    (50, 8, 29),
+    (9, 30, 51),
+    (31, 52, 10),
+    (53, 11, 32),
+    (12, 33, 54),
+    (34, 55, 13),
+    (56, 14, 35),
+    (15, 36, 57),
+    (37, 58, 16),
+    (59, 17, 38),
+    (18, 39, 60),
+    (40, 61, 19),
+    (62, 20, 41),
+)
+
+SHA_CRYPT_DEFAULT_ROUNDS = 5000
+BCRYPT_DEFAULT_COST = 12
+
+# Schemes new passwords can be hashed with, all understood by apache on Linux
+HASH_SCHEMES = ("apr1", "sha256", "sha512", "bcrypt")
+
+# Number of passwords generated and hashed by each task sent to a process pool
+HASH_CHUNK_SIZE = 50
+
+
+class UnsupportedHashError(Exception):
+    def __init__(self, scheme):
+        self.scheme = scheme
+
+    def __str__(self):
+        return "Password hash scheme %s is not supported on this system" % self.scheme
+
+
+def _to64(value, length):
+    """Encode the length lowest 6 bits groups of value with crypt alphabet"""
+    result = []
+    for i in range(length):
+        result.append(ITOA64[value & 0x3F])
+        value >>= 6
+    return "".join(result)
+
+
+def _encode(digest, order, tail):
+    """Encode digest with crypt alphabet, using bytes order then tail bytes (tuple of indexes and length)"""
+    result = []
+    for a, b, c in order:
+        result.append(_to64((digest[a] << 16) | (digest[b] << 8) | digest[c], 4))
+    indexes, length = tail
+    value = 0
+    for index in indexes:
+        value = (value << 8) | digest[index]
+    result.append(_to64(value, length))
+    return "".join(result)
+
+
+def md5_crypt(password, salt, magic="$apr1$"):
+    """MD5 based crypt. Apache flavour uses $apr1$ magic, glibc one uses $1$
+    @return: the full hash, with magic and salt"""
+    pw = password.encode("utf-8")
+    salt = salt[:8]
+    salt_bytes = salt.encode("utf-8")
+
+    final = hashlib.md5(pw + salt_bytes + pw).digest()
+    ctx = pw + magic.encode("utf-8") + salt_bytes
+    for length in range(len(pw), 0, -16):
+        ctx += final[: min(16, length)]
+    i = len(pw)
+    while i:
+        ctx += b"\0" if i & 1 else pw[:1]
+        i >>= 1
+    final = hashlib.md5(ctx).digest()
+
+    # 1000 rounds to slow down brute force
+    for i in range(1000):
+        ctx = pw if i & 1 else final
+        if i % 3:
+            ctx += salt_bytes
+        if i % 7:
+            ctx += pw
+        ctx += final if i & 1 else pw
+        final = hashlib.md5(ctx).digest()
+
+    return magic + salt + "$" + _encode(final, MD5_CRYPT_ORDER, ((11,), 2))
+
+
+def sha_crypt(password, salt, rounds=None, magic="$6$"):
+    """SHA-256 ($5$) or SHA-512 ($6$) based crypt as specified by Ulrich Drepper
+    @return: the full hash, with magic, rounds if not default and salt"""
+    if magic == "$5$":
+        hash_function, order, tail = hashlib.sha256, SHA256_CRYPT_ORDER, ((31, 30), 3)
+    else:
+        hash_function, order, tail = hashlib.sha512, SHA512_CRYPT_ORDER, ((63,), 2)
+    explicit_rounds = rounds is not None
+    rounds = min(max(rounds if explicit_rounds else SHA_CRYPT_DEFAULT_ROUNDS, 1000), 999999999)
+    pw = password.encode("utf-8")
+    salt = salt[:16]
+    salt_bytes = salt.encode("utf-8")
+
+    digest_b = hash_function(pw + salt_bytes + pw).digest()
+    ctx = pw + salt_bytes
+    for length in range(len(pw), 0, -len(digest_b)):
+        ctx += digest_b[: min(len(digest_b), length)]
+    i = len(pw)
+    while i:
+        ctx += digest_b if i & 1 else pw
+        i >>= 1
+    digest_a = hash_function(ctx).digest()
+
+    digest_p = hash_function(pw * len(pw)).digest()
+    p = (digest_p * (len(pw) // len(digest_p) + 1))[: len(pw)]
+    digest_s = hash_function(salt_bytes * (16 + digest_a[0])).digest()
+    s = (digest_s * (len(salt_bytes) // len(digest_s) + 1))[: len(salt_bytes)]
+
+    final = digest_a
+    for i in range(rounds):
+        ctx = p if i & 1 else final
+        if i % 3:
+            ctx += s
+        if i % 7:
+            ctx += p
+        ctx += final if i & 1 else p
+        final = hash_function(ctx).digest()
+
+    prefix = magic
+    if explicit_rounds:
+        prefix += "rounds=%s$" % rounds
+    return prefix + salt + "$" + _encode(final, order, tail)
+
+
+def generate_salt(length=8):
+    """@return: a random salt made of crypt alphabet chars"""
+    return "".join(secrets.choice(ITOA64) for i in range(length))
+
+
+def hash_password(password, scheme="apr1", cost=None):
+    """Hash password with scheme: apache MD5 flavour like htpasswd -m does, sha256 or sha512 crypt (cost is the
+    number of rounds) or bcrypt (cost is the log2 of the number of rounds). Default cost is used if None
+    @raise UnsupportedHashError: if scheme is unknown or needs an unavailable library
+    @return: the hash to store in htpasswd file"""
+    with PASSWORD_HASH_SECONDS.time(scheme):
+        return _hash(password, scheme, cost)
+
+
+def _hash(password, scheme="apr1", cost=None):
+    if scheme == "apr1":
+        return md5_crypt(password, generate_salt())
+    if scheme in ("sha256", "sha512"):
+        return sha_crypt(password, generate_salt(16), cost, "$5$" if scheme == "sha256" else "$6$")
+    if scheme == "bcrypt" and bcrypt is not None:
+        salt = bcrypt.gensalt(cost or BCRYPT_DEFAULT_COST)
+        # Same algorithm, but older apache versions only know the $2y$ prefix
+        return bcrypt.hashpw(password.encode("utf-8"), salt).decode("ascii").replace("$2b$", "$2y$", 1)
+    raise UnsupportedHashError(scheme)
+
+
+def generate_password(length=10, special_chars="!@#$%^&*+;?.!_=()[]{}"):
+    """Generate a random password of the desired length, with 1 number, 1 upper case, 1 special char minimum.
+    Chars are drawn from the system random source, which is safe to use from forked processes
+    @return a generated password of the desired length"""
+    rng = secrets.SystemRandom()
+    bag = rng.sample(string.digits, 1)
+    bag += rng.sample(special_chars, 1)
+    bag += rng.sample(string.ascii_lowercase, 1)
+    bag += rng.sample(string.ascii_uppercase, 1)
+    bag += rng.sample(string.digits + string.ascii_lowercase + string.ascii_uppercase + special_chars, length - 4)
+    rng.shuffle(bag)
+    return "".join(bag)
+
+
+def generate_and_hash(count, length=10, special_chars="!@#$%^&*+;?.!_=()[]{}", executor=None, scheme="apr1", cost=None):
+    """Generate count random passwords and hash them with scheme and cost, see hash_password(). With a
+    concurrent.futures executor, work is split in tasks of HASH_CHUNK_SIZE passwords so that hashing of large batches
+    uses several cores
+    @return: list of (password, hash)"""
+    if executor is None or count <= HASH_CHUNK_SIZE:
+        passwords = [generate_password(length, special_chars) for i in range(count)]
+        return [(password, hash_password(password, scheme, cost)) for password in passwords]
+    futures = [
+        executor.submit(_generate_and_hash, min(HASH_CHUNK_SIZE, count - start), length, special_chars, scheme, cost)
+        for start in range(0, count, HASH_CHUNK_SIZE)
+    ]
+    result = []
+    for future in futures:
+        for password, password_hash, seconds in future.result():
+            # Worker processes have their own metrics: record their timings here
+            PASSWORD_HASH_SECONDS.observe(seconds, scheme)
+            result.append((password, password_hash))
+    return result
+
+
+def _generate_and_hash(count, length, special_chars, scheme, cost):
+    """Task of generate_and_hash, run in a worker process
+    @return: list of (password, hash, hashing seconds)"""
+    result = []
+    for i in range(count):
+        password = generate_password(length, special_chars)
+        start = time.perf_counter()
+        password_hash = _hash(password, scheme, cost)
+        result.append((password, password_hash, time.perf_counter() - start))
+    return result
+
+
+def identify(password_hash):
+    """@return: hash scheme name of password_hash, or None if unknown"""
+    if password_hash.startswith("$apr1$"):
+        return "apr1"
+    if password_hash.startswith("$1$"):
+        return "md5"
+    if password_hash.startswith("$5$"):
+        return "sha256"
+    if password_hash.startswith("$6$"):
+        return "sha512"
+    if password_hash[:4] in ("$2y$", "$2b$", "$2a$"):
+        return "bcrypt"
+    if password_hash.startswith("{SHA}"):
+        return "sha1"
+    if len(password_hash) == 13:
+        return "crypt"
+    return None
+
+
+def verify_password(password_hash, password):
+    """Check password against a htpasswd hash. Comparison is made in constant time
+    @raise UnsupportedHashError: if hash scheme needs an unavailable library
+    @return: True if password matches"""
+    password_hash = password_hash.strip()
+    scheme = identify(password_hash)
+    with PASSWORD_VERIFY_SECONDS.time(scheme or "unknown"):
+        return _verify(password_hash, scheme, password)
+
+
+def _verify(password_hash, scheme, password):
+    if scheme in ("apr1", "md5"):
+        magic, salt = password_hash.split("$")[1:3]
+        computed = md5_crypt(password, salt, "$%s$" % magic)
+    elif scheme in ("sha256", "sha512"):
+        fields = password_hash.split("$")
+        rounds = None
+        if fields[2].startswith("rounds="):
+            rounds = int(fields[2][len("rounds=") :])
+            salt = fields[3]
+        else:
+            salt = fields[2]
+        computed = sha_crypt(password, salt, rounds, "$%s$" % fields[1])
+    elif scheme == "bcrypt":
+        if bcrypt is None:
+            raise UnsupportedHashError(scheme)
+        return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+    elif scheme == "sha1":
+        computed = "{SHA}" + base64.b64encode(hashlib.sha1(password.encode("utf-8")).digest()).decode("ascii")
+    elif scheme == "crypt":
+        if crypt is None:
+            raise UnsupportedHashError(scheme)
+        computed = crypt.crypt(password, password_hash[:2])
+    else:
+        return False
+    return hmac.compare_digest(computed.encode("utf-8"), password_hash.encode("utf-8"))
@@ -0,0 +1,112 @@
+# coding: utf-8
+"""
+Slow requests log and profiling, cheap enough to be left on in production
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("pydentity")
+
+
+class SlowRequestProfiler(object):
+    """WSGI middleware that logs requests slower than threshold_ms milliseconds. A sample of requests (sample_rate,
+    between 0 and 1) is profiled with cProfile: profiles of slow ones are written to directory, in pstats format
+    (python -m pstats, snakeviz, gprof2dot or flameprof can read them). Only the max_files most recent are kept"""
+
+    def __init__(self, app, directory, threshold_ms, sample_rate=0.1, max_files=100):
+        self.app = app
+        self.directory = directory
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        profiler = None
+        if random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            with self._profiling(profiler):
+                iterable = self.app(environ, start_response)
+        except BaseException:
+            self._finish(environ, profiler, start)
+            raise
+        return self._iterate(iterable, environ, profiler, start)
+
+    def _iterate(self, iterable, environ, profiler, start):
+        """Response body, profiled too as it may be generated while sent"""
+        try:
+            iterator = iter(iterable)
+            while True:
+                with self._profiling(profiler):
+                    try:
+                        chunk = next(iterator)
+                    except StopIteration:
+                        break
+                yield chunk
+        finally:
+            if hasattr(iterable, "close"):
+                with self._profiling(profiler):
+                    iterable.close()
+            self._finish(environ, profiler, start)
+
+    @contextmanager
+    def _profiling(self, profiler):
+        if profiler is None:
+            yield
+            return
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this process (python >= 3.12 allows only one)
+            profiler.incomplete = True
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+    def _finish(self, environ, profiler, start):
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms < self.threshold_ms:
+            return
+        path = environ.get("PATH_INFO", "")
+        logger.warning("Slow request: %s %s took %d ms", environ.get("REQUEST_METHOD"), path, duration_ms)
+        if profiler is None or getattr(profiler, "incomplete", False):
+            return
+        name = "%.6f-%s-%s-%dms.prof" % (
+            time.time(),
+            environ.get("REQUEST_METHOD"),
+            re.sub("[^A-Za-z0-9]+", "_", path).strip("_")[:80],
+            duration_ms,
+        )
+        profiler.dump_stats(os.path.join(self.directory, name))
+        self._rotate()
+
+    def _rotate(self):
+        """Remove oldest profiles beyond max_files"""
+        with self._lock:
+            profiles = sorted(name for name in os.listdir(self.directory) if name.endswith(".prof"))
+            for name in profiles[: max(len(profiles) - self.max_files, 0)]:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def profiles(self):
+        """@return: paths of kept profiles, oldest first"""
+        return [
+            os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if name.endswith(".prof")
+        ]
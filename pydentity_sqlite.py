@@ -0,0 +1,440 @@
+# coding: utf-8
+"""
+Users and groups stored in an indexed SQLite database, exported to htpasswd and htgroup files for apache
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from pydentity_journal import diff_groups, diff_users
+from pydentity_passwd import hash_password, identify
+from pydentity_store import (
+    Groups,
+    GroupNotExists,
+    ReadOnlyError,
+    UserAlreadyInAGroup,
+    UserExists,
+    UserNotExists,
+    UserNotInAGroup,
+    Users,
+    atomic_write,
+    file_lock,
+)
+
+# Row order is the order of the exported files: rowid grows with insertions
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS htuser (
+    name TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS htgroup (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS htmember (
+    grp TEXT NOT NULL REFERENCES htgroup(name),
+    user TEXT NOT NULL,
+    PRIMARY KEY (grp, user)
+);
+CREATE INDEX IF NOT EXISTS htmember_user ON htmember(user);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SqliteStore(object):
+    """Storage backend with the same interface as pydentity_store.FileStore. Lookups and single user changes are
+    indexed queries. The database is the reference: htpasswd and htgroup files are written from it after each change,
+    or after delay seconds to coalesce a burst of changes in a single export.
+    On first use, the database is filled with the content of existing files"""
+
+    def __init__(
+        self, path, users_path, groups_path, delay=0, max_pending=100, users_dbm=None, groups_dbm=None, journal=None
+    ):
+        self.path = path
+        self.users_path = users_path
+        self.groups_path = groups_path
+        self.delay = delay
+        self.max_pending = max_pending
+        # Optional DBM copies for apache (pydentity_dbm.DbmFile), written again with each export
+        self.users_dbm = users_dbm
+        self.groups_dbm = groups_dbm
+        # Optional journal of exported changes for replicas (pydentity_journal.Journal)
+        self.journal = journal
+        self._local = threading.local()
+        self._export_lock = threading.Lock()
+        self._pending = set()  # "users" and/or "groups" files to export
+        self._pending_count = 0
+        self._timer = None
+        atexit.register(self.flush)
+        self._db().executescript(SCHEMA)
+        with self._transaction() as db:
+            if db.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone() is None:
+                self._import(db)
+        self.sync_dbms()
+
+    def _db(self):
+        """@return: sqlite connection of current thread"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db = db
+            self._local.depth = 0
+        return db
+
+    @contextmanager
+    def _transaction(self, flush=False):
+        """Write transaction of current thread. Nested calls join the outermost transaction, so that user and group
+        changes of a request are committed together. Files are exported once it is committed, right away if flush is
+        True for any of the nested calls"""
+        db = self._db()
+        local = self._local
+        if local.depth:
+            local.flush = local.flush or flush
+            local.depth += 1
+            try:
+                yield db
+            finally:
+                local.depth -= 1
+            return
+        db.execute("BEGIN IMMEDIATE")
+        local.depth = 1
+        local.flush = flush
+        local.changed = set()
+        local.count = 0
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            local.depth = 0
+        if local.changed:
+            db.execute(
+                "INSERT INTO meta (key, value) VALUES ('version', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1"
+            )
+        db.execute("COMMIT")
+        if local.changed:
+            self._schedule_export(local.changed, local.count, local.flush)
+
+    def _changed(self, what):
+        """Record that users or groups were changed in current transaction"""
+        self._local.changed.add(what)
+        self._local.count += 1
+
+    def _schedule_export(self, changed, count, flush):
+        with self._export_lock:
+            self._pending.update(changed)
+            self._pending_count += count
+            if not flush and self.delay > 0 and self._pending_count < self.max_pending:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def version(self):
+        """@return: a value that changes whenever users or groups change, in this process or another one"""
+        row = self._db().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return (self.path, row[0] if row else 0)
+
+    def stats(self):
+        """@return: figures about users and groups, see pydentity_store.DirectoryStats.snapshot(). They are computed
+        by the database without loading users, but each call reads all users and memberships"""
+        db = self._db()
+        group_sizes = dict(
+            db.execute(
+                "SELECT htgroup.name, COUNT(htmember.user) FROM htgroup "
+                "LEFT JOIN htmember ON htmember.grp = htgroup.name GROUP BY htgroup.name"
+            )
+        )
+        unassigned = db.execute(
+            "SELECT name FROM htuser WHERE NOT EXISTS (SELECT 1 FROM htmember WHERE htmember.user = htuser.name) "
+            "ORDER BY name"
+        )
+        # Scheme only depends on hash prefix, or length of old crypt hashes
+        schemes = {}
+        for password_hash, count in db.execute(
+            "SELECT MIN(hash), COUNT(*) FROM htuser GROUP BY substr(hash, 1, 6), length(hash) = 13"
+        ):
+            scheme = identify(password_hash) or "unknown"
+            schemes[scheme] = schemes.get(scheme, 0) + count
+        return dict(
+            number_of_users=db.execute("SELECT COUNT(*) FROM htuser").fetchone()[0],
+            group_sizes=group_sizes,
+            unassigned_users=[row[0] for row in unassigned],
+            schemes=schemes,
+        )
+
+    def flush(self):
+        """Export files with pending changes right now"""
+        with self._export_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            what, self._pending, self._pending_count = self._pending, set(), 0
+        self.export(what)
+
+    def _import(self, db):
+        if os.path.exists(self.users_path):
+            db.executemany(
+                "INSERT OR REPLACE INTO htuser (name, hash) VALUES (?, ?)",
+                Users.from_file(self.users_path).entries.items(),
+            )
+        if os.path.exists(self.groups_path):
+            groups = Groups.from_file(self.groups_path)
+            for group in groups.groups:
+                db.execute("INSERT OR IGNORE INTO htgroup (name) VALUES (?)", (group,))
+                db.executemany(
+                    "INSERT OR IGNORE INTO htmember (grp, user) VALUES (?, ?)",
+                    [(group, user) for user in groups.members(group)],
+                )
+        db.execute("INSERT INTO meta (key, value) VALUES ('imported', '1')")
+
+    def get_users(self):
+        """@return: users, read only"""
+        return SqliteUsers(self, readonly=True)
+
+    def get_groups(self):
+        """@return: groups, read only"""
+        return SqliteGroups(self, readonly=True)
+
+    @contextmanager
+    def edit_users(self, flush=False):
+        """Yield users to be modified. Changes are committed at the end of the with block, or rolled back on error.
+        htpasswd file export is delayed to be coalesced with the next ones unless flush is True"""
+        with self._transaction(flush):
+            yield SqliteUsers(self)
+
+    @contextmanager
+    def edit_groups(self, flush=False):
+        """Yield groups to be modified. Changes are committed at the end of the with block, or rolled back on error.
+        htgroup file export is delayed to be coalesced with the next ones unless flush is True"""
+        with self._transaction(flush):
+            yield SqliteGroups(self)
+
+    def export(self, what=("users", "groups")):
+        """Write htpasswd and/or htgroup files from database content. Database is read under the file lock so that
+        the last writer always exports the latest content"""
+        db = self._db()
+        if "users" in what:
+            with file_lock(self.users_path):
+                users = self._db_users(db)
+                previous = self._previous(self.users_path, Users)
+                lines = users.serialize()
+                atomic_write(self.users_path, lines)
+                if self.journal is not None:
+                    self.journal.append("users", diff_users(previous, users), lines)
+                if self.users_dbm is not None:
+                    self.users_dbm.rebuild(users)
+        if "groups" in what:
+            with file_lock(self.groups_path):
+                groups = self._db_groups(db)
+                previous = self._previous(self.groups_path, Groups)
+                lines = groups.serialize()
+                atomic_write(self.groups_path, lines)
+                if self.journal is not None:
+                    self.journal.append("groups", diff_groups(previous, groups), lines)
+                if self.groups_dbm is not None:
+                    self.groups_dbm.rebuild(groups)
+
+    def _previous(self, path, cls):
+        """@return: content of path before export, as Users or Groups cls, if needed for journal. Database does not
+        keep changes: journaled ones are the difference between previous and new content of files"""
+        if self.journal is None:
+            return None
+        return cls.from_file(path) if os.path.exists(path) else cls()
+
+    def sync_dbms(self):
+        """Write DBM databases from database content"""
+        db = self._db()
+        if self.users_dbm is not None:
+            with file_lock(self.users_path):
+                self.users_dbm.rebuild(self._db_users(db))
+        if self.groups_dbm is not None:
+            with file_lock(self.groups_path):
+                self.groups_dbm.rebuild(self._db_groups(db))
+
+    def _db_users(self, db):
+        """@return: Users with database content"""
+        return Users(db.execute("SELECT name, hash FROM htuser ORDER BY rowid").fetchall())
+
+    def _db_groups(self, db):
+        """@return: Groups with database content"""
+        groups = Groups()
+        for group in db.execute("SELECT name FROM htgroup ORDER BY rowid"):
+            groups.entries[group[0]] = {}
+        for group, user in db.execute("SELECT grp, user FROM htmember ORDER BY rowid"):
+            groups.entries[group][user] = None
+            groups.user_groups.setdefault(user, set()).add(group)
+        return groups
+
+
+class SqliteUsers(object):
+    """Users of a SqliteStore, with the same API as pydentity_store.Users"""
+
+    def __init__(self, store, readonly=False):
+        self.store = store
+        self.readonly = readonly
+        self.changes = 0
+
+    def _query(self, sql, *args):
+        return self.store._db().execute(sql, args)
+
+    def _check_writable(self):
+        if self.readonly:
+            raise ReadOnlyError
+        self.changes += 1
+        self.store._changed("users")
+
+    @property
+    def dirty(self):
+        """True if modified"""
+        return bool(self.changes)
+
+    def __contains__(self, user):
+        return self._query("SELECT 1 FROM htuser WHERE name = ?", user).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self._query("SELECT name FROM htuser ORDER BY rowid"))
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM htuser").fetchone()[0]
+
+    @property
+    def users(self):
+        """Returns users in a list"""
+        return [row[0] for row in self._query("SELECT name FROM htuser ORDER BY rowid")]
+
+    def get_hash(self, user):
+        """@return: password hash of user"""
+        row = self._query("SELECT hash FROM htuser WHERE name = ?", user).fetchone()
+        if row is None:
+            raise KeyError(user)
+        return row[0]
+
+    def sorted_users(self):
+        """@return: users sorted by login"""
+        return [row[0] for row in self._query("SELECT name FROM htuser ORDER BY name")]
+
+    def search(self, query, contains=False):
+        """@return: users, sorted by login, whose login starts with query, or contains it if contains is True"""
+        if not query:
+            return self.sorted_users()
+        if contains:
+            rows = self._query("SELECT name FROM htuser WHERE instr(name, ?) > 0 ORDER BY name", query)
+        else:
+            rows = self._query(
+                "SELECT name FROM htuser WHERE name >= ? AND name < ? ORDER BY name", query, query + "\U0010ffff"
+            )
+        return [row[0] for row in rows]
+
+    def add(self, user, password, scheme="apr1", cost=None):
+        """Adds a user with password, hashed with scheme and cost (see pydentity_passwd.hash_password)"""
+        if user in self:
+            raise UserExists
+        self.set_hash(user, hash_password(password, scheme, cost))
+
+    def change_password(self, user, password, scheme="apr1", cost=None):
+        """Changes user password. New hash uses scheme and cost whatever the scheme of the previous one was"""
+        if user not in self:
+            raise UserNotExists
+        self.set_hash(user, hash_password(password, scheme, cost))
+
+    def set_hash(self, user, password_hash):
+        """Create user or change its password with an already hashed password"""
+        self._check_writable()
+        self._query(
+            "INSERT INTO htuser (name, hash) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET hash = excluded.hash",
+            user,
+            password_hash,
+        )
+
+    def pop(self, user):
+        """Deletes a user"""
+        if self.readonly:
+            raise ReadOnlyError
+        if user not in self:
+            raise UserNotExists
+        self._check_writable()
+        self._query("DELETE FROM htuser WHERE name = ?", user)
+
+
+class SqliteGroups(object):
+    """Groups of a SqliteStore, with the same API as pydentity_store.Groups"""
+
+    def __init__(self, store, readonly=False):
+        self.store = store
+        self.readonly = readonly
+        self.changes = 0
+
+    def _query(self, sql, *args):
+        return self.store._db().execute(sql, args)
+
+    def _check_writable(self):
+        if self.readonly:
+            raise ReadOnlyError
+        self.changes += 1
+        self.store._changed("groups")
+
+    @property
+    def dirty(self):
+        """True if modified"""
+        return bool(self.changes)
+
+    def __contains__(self, group):
+        return self._query("SELECT 1 FROM htgroup WHERE name = ?", group).fetchone() is not None
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM htgroup").fetchone()[0]
+
+    @property
+    def groups(self):
+        """Returns groups in a list"""
+        return [row[0] for row in self._query("SELECT name FROM htgroup ORDER BY rowid")]
+
+    def is_user_in(self, user, group):
+        """Returns True if user is in group"""
+        return self._query("SELECT 1 FROM htmember WHERE grp = ? AND user = ?", group, user).fetchone() is not None
+
+    def members(self, group):
+        """@return: users of group, in file order"""
+        return [row[0] for row in self._query("SELECT user FROM htmember WHERE grp = ? ORDER BY rowid", group)]
+
+    def groups_of(self, user):
+        """@return: set of groups user belongs to"""
+        return set(row[0] for row in self._query("SELECT grp FROM htmember WHERE user = ?", user))
+
+    def memberships(self):
+        """Iterate over (group, user) of all groups, in file order"""
+        for group in self.groups:
+            for row in self._query("SELECT user FROM htmember WHERE grp = ? ORDER BY rowid", group):
+                yield group, row[0]
+
+    def add_user(self, user, group):
+        """Adds user to a group, group is created if needed"""
+        if self.readonly:
+            raise ReadOnlyError
+        if self.is_user_in(user, group):
+            raise UserAlreadyInAGroup
+        self._check_writable()
+        self._query("INSERT OR IGNORE INTO htgroup (name) VALUES (?)", group)
+        self._query("INSERT INTO htmember (grp, user) VALUES (?, ?)", group, user)
+
+    def delete_user(self, user, group):
+        """Deletes user from group"""
+        if self.readonly:
+            raise ReadOnlyError
+        if group not in self:
+            raise GroupNotExists
+        if not self.is_user_in(user, group):
+            raise UserNotInAGroup
+        self._check_writable()
+        self._query("DELETE FROM htmember WHERE grp = ? AND user = ?", group, user)
@@ -0,0 +1,719 @@
+# coding: utf-8
+"""
+Parsed, in-process cache of apache htpasswd and htgroup files and the way to change them
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import atexit
+import fcntl
+import itertools
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from pydentity_metrics import FILE_PARSE_SECONDS, FILE_READ_BYTES, FILE_WRITE_BYTES, FILE_WRITE_SECONDS
+from pydentity_passwd import hash_password, identify
+
+# Each Users or Groups instance gets its own number, see DirectoryStats
+_generations = itertools.count()
+
+
+class UserExists(Exception):
+    def __str__(self):
+        return "User already exists"
+
+
+class UserNotExists(Exception):
+    def __str__(self):
+        return "User not exists"
+
+
+class GroupNotExists(Exception):
+    def __str__(self):
+        return "Group not exists"
+
+
+class UserAlreadyInAGroup(Exception):
+    def __str__(self):
+        return "User already in a group"
+
+
+class UserNotInAGroup(Exception):
+    def __str__(self):
+        return "User not in a group"
+
+
+class ReadOnlyError(Exception):
+    def __str__(self):
+        return "Shared parsed file can not be modified, use FileCache.edit()"
+
+
+class Users(object):
+    """Content of a htpasswd file. API is the same as htpasswd.Basic one.
+    Modifications are recorded in changes so that they can be replayed on a more recent version of the file"""
+
+    def __init__(self, entries=None):
+        # user -> password hash (without trailing new line)
+        self.entries = OrderedDict(entries or ())
+        # list of ("set", user, hash, True if user was created) or ("pop", user)
+        self.changes = []
+        # Set on instances shared through cache
+        self.readonly = False
+        # Users sorted by login, computed once for read only instances
+        self._sorted_users = None
+        self.generation = next(_generations)
+
+    @classmethod
+    def from_file(cls, path):
+        """Parse a htpasswd file
+        @return: a Users instance"""
+        users = cls()
+        with open(path, "r") as htpasswd_file:
+            for line in htpasswd_file:
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                user, password_hash = line.split(":", 1)
+                users.entries[user] = password_hash
+        return users
+
+    def copy(self):
+        """@return: an independent and writable copy"""
+        return Users(self.entries)
+
+    @property
+    def dirty(self):
+        """True if modified since parsed or copied"""
+        return bool(self.changes)
+
+    def serialize(self):
+        """@return: htpasswd file lines"""
+        return ["%s:%s\n" % entry for entry in self.entries.items()]
+
+    def __contains__(self, user):
+        return user in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __eq__(self, other):
+        return isinstance(other, Users) and self.entries == other.entries
+
+    @property
+    def users(self):
+        """Returns users in a list"""
+        return list(self.entries)
+
+    def get_hash(self, user):
+        """@return: password hash of user"""
+        return self.entries[user]
+
+    def sorted_users(self):
+        """@return: users sorted by login"""
+        if not self.readonly:
+            return sorted(self.entries)
+        if self._sorted_users is None:
+            self._sorted_users = sorted(self.entries)
+        return self._sorted_users
+
+    def search(self, query, contains=False):
+        """@return: users, sorted by login, whose login starts with query, or contains it if contains is True"""
+        users = self.sorted_users()
+        if not query:
+            return users
+        if contains:
+            return [user for user in users if query in user]
+        start = bisect_left(users, query)
+        return users[start : bisect_left(users, query + "\U0010ffff", start)]
+
+    def add(self, user, password, scheme="apr1", cost=None):
+        """Adds a user with password, hashed with scheme and cost (see pydentity_passwd.hash_password)"""
+        if user in self.entries:
+            raise UserExists
+        self.set_hash(user, hash_password(password, scheme, cost))
+
+    def change_password(self, user, password, scheme="apr1", cost=None):
+        """Changes user password. New hash uses scheme and cost whatever the scheme of the previous one was"""
+        if user not in self.entries:
+            raise UserNotExists
+        self.set_hash(user, hash_password(password, scheme, cost))
+
+    def set_hash(self, user, password_hash):
+        """Create user or change its password with an already hashed password"""
+        if self.readonly:
+            raise ReadOnlyError
+        created = user not in self.entries
+        self.entries[user] = password_hash
+        self.changes.append(("set", user, password_hash, created))
+
+    def pop(self, user):
+        """Deletes a user"""
+        if self.readonly:
+            raise ReadOnlyError
+        if user not in self.entries:
+            raise UserNotExists
+        self.entries.pop(user)
+        self.changes.append(("pop", user))
+
+    def replay(self, changes):
+        """Apply changes recorded on another copy. Changes already done (user already deleted...) are skipped, and so
+        are password changes of users deleted meanwhile: they are not created again"""
+        for change in changes:
+            if change[0] == "set":
+                # Changes without created flag come from older journals
+                if change[1] in self.entries or len(change) < 4 or change[3]:
+                    self.set_hash(change[1], change[2])
+            elif change[1] in self.entries:
+                self.pop(change[1])
+
+
+class Groups(object):
+    """Content of a htgroup file. API is the same as htpasswd.Group one.
+    Membership is indexed both ways so that lookups don't depend on the number of groups or members"""
+
+    def __init__(self):
+        # group -> users, a dict is used as an ordered set
+        self.entries = OrderedDict()
+        # user -> set of groups
+        self.user_groups = {}
+        # list of ("add_user", user, group, True if user existed in users) or ("delete_user", user, group)
+        self.changes = []
+        # Users of the htpasswd file when set, to tell additions of existing users from additions of users being created
+        self.users = None
+        # Set on instances shared through cache
+        self.readonly = False
+        self.generation = next(_generations)
+
+    @classmethod
+    def from_file(cls, path):
+        """Parse a htgroup file
+        @return: a Groups instance"""
+        groups = cls()
+        with open(path, "r") as htgroup_file:
+            content = re.sub("\\\\\n", "", htgroup_file.read())
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            group, users = line.split(":", 1)
+            members = groups.entries.setdefault(group, {})
+            for user in users.split():
+                members[user] = None
+                groups.user_groups.setdefault(user, set()).add(group)
+        return groups
+
+    def copy(self):
+        """@return: an independent and writable copy"""
+        groups = Groups()
+        groups.entries = OrderedDict((group, dict(members)) for group, members in self.entries.items())
+        groups.user_groups = dict((user, set(user_groups)) for user, user_groups in self.user_groups.items())
+        return groups
+
+    @property
+    def dirty(self):
+        """True if modified since parsed or copied"""
+        return bool(self.changes)
+
+    def serialize(self):
+        """@return: htgroup file lines. Empty groups are kept"""
+        return ["%s: %s\n" % (group, " ".join(members)) for group, members in self.entries.items()]
+
+    def __contains__(self, group):
+        return group in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __eq__(self, other):
+        return isinstance(other, Groups) and self.entries == other.entries
+
+    @property
+    def groups(self):
+        """Returns groups in a list"""
+        return list(self.entries)
+
+    def is_user_in(self, user, group):
+        """Returns True if user is in group"""
+        return user in self.entries.get(group, ())
+
+    def members(self, group):
+        """@return: users of group, in file order"""
+        return list(self.entries.get(group, ()))
+
+    def groups_of(self, user):
+        """@return: set of groups user belongs to"""
+        return self.user_groups.get(user, frozenset())
+
+    def memberships(self):
+        """Iterate over (group, user) of all groups, in file order"""
+        for group, members in self.entries.items():
+            for user in members:
+                yield group, user
+
+    def add_user(self, user, group):
+        """Adds user to a group, group is created if needed"""
+        if self.readonly:
+            raise ReadOnlyError
+        if self.is_user_in(user, group):
+            raise UserAlreadyInAGroup
+        self._add_user(user, group, self.users is not None and user in self.users)
+
+    def _add_user(self, user, group, existing):
+        self.entries.setdefault(group, {})[user] = None
+        self.user_groups.setdefault(user, set()).add(group)
+        self.changes.append(("add_user", user, group, existing))
+
+    def delete_user(self, user, group):
+        """Deletes user from group"""
+        if self.readonly:
+            raise ReadOnlyError
+        if group not in self.entries:
+            raise GroupNotExists
+        if not self.is_user_in(user, group):
+            raise UserNotInAGroup
+        del self.entries[group][user]
+        user_groups = self.user_groups[user]
+        user_groups.discard(group)
+        if not user_groups:
+            del self.user_groups[user]
+        self.changes.append(("delete_user", user, group))
+
+    def replay(self, changes, users=None):
+        """Apply changes recorded on another copy. Changes already done (user already in group...) are skipped. If
+        current users are given, so are additions of a user that existed when the change was made but has been deleted
+        meanwhile"""
+        for change in changes:
+            action, user, group = change[:3]
+            if action == "add_user":
+                if self.is_user_in(user, group):
+                    continue
+                # Changes without existing flag come from older journals
+                existing = len(change) > 3 and change[3]
+                if existing and users is not None and user not in users:
+                    continue
+                if self.readonly:
+                    raise ReadOnlyError
+                self._add_user(user, group, existing)
+            elif self.is_user_in(user, group):
+                self.delete_user(user, group)
+
+
+class DirectoryStats(object):
+    """Figures about users and groups: number of users, size of each group, users without group and users per password
+    hash scheme. Built once from Users and Groups with a linear pass, then updated with the changes of each edit.
+    users_generation and groups_generation tell which Users and Groups instances figures are up to date with"""
+
+    def __init__(self, users, groups):
+        self.users_generation = users.generation
+        self.groups_generation = groups.generation
+        self.number_of_users = len(users)
+        self.group_sizes = dict((group, len(members)) for group, members in groups.entries.items())
+        self.unassigned = set(user for user in users if not groups.groups_of(user))
+        self.schemes = Counter(identify(users.get_hash(user)) or "unknown" for user in users)
+
+    def is_for(self, users, groups):
+        """@return: True if figures are the ones of these users and groups instances"""
+        return self.users_generation == users.generation and self.groups_generation == groups.generation
+
+    def users_changed(self, previous, current, groups, changes):
+        """Update figures with changes that turned previous users into current ones. groups are the current ones"""
+        for user in set(change[1] for change in changes):
+            if user in previous:
+                self.number_of_users -= 1
+                self.schemes[identify(previous.get_hash(user)) or "unknown"] -= 1
+                self.unassigned.discard(user)
+            if user in current:
+                self.number_of_users += 1
+                self.schemes[identify(current.get_hash(user)) or "unknown"] += 1
+                if not groups.groups_of(user):
+                    self.unassigned.add(user)
+        self.users_generation = current.generation
+
+    def groups_changed(self, previous, current, users, changes):
+        """Update figures with changes that turned previous groups into current ones. users are the current ones"""
+        for change in changes:
+            user, group = change[1:3]
+            self.group_sizes[group] = len(current.entries.get(group, ()))
+            if user not in users:
+                continue
+            if current.groups_of(user):
+                self.unassigned.discard(user)
+            else:
+                self.unassigned.add(user)
+        self.groups_generation = current.generation
+
+    def snapshot(self):
+        """@return: dict of current figures, independent of next changes"""
+        return dict(
+            number_of_users=self.number_of_users,
+            group_sizes=dict(self.group_sizes),
+            unassigned_users=sorted(self.unassigned),
+            schemes=dict((scheme, count) for scheme, count in self.schemes.items() if count),
+        )
+
+
+class BatchPlan(object):
+    """Changes required to give a list of users the same groups, with a new password each.
+    The whole diff is computed first so that it can be previewed, then applied in one pass"""
+
+    def __init__(self, userdb, groupdb, logins, checked_groups):
+        self.logins = []
+        self.creates = []
+        self.updates = []
+        self.group_additions = []  # list of (user, group)
+        self.group_removals = []  # list of (user, group)
+        checked = set(checked_groups)
+        checked_groups = [group for group in groupdb.groups if group in checked]
+        seen = set()
+        for login in logins:
+            login = login.strip()
+            if not login or login in seen:
+                continue
+            seen.add(login)
+            self.logins.append(login)
+            if login in userdb:
+                self.updates.append(login)
+            else:
+                self.creates.append(login)
+            user_groups = groupdb.groups_of(login)
+            for group in checked_groups:
+                if group not in user_groups:
+                    self.group_additions.append((login, group))
+            for group in sorted(user_groups - checked):
+                self.group_removals.append((login, group))
+
+    def apply(self, userdb, groupdb, passwords, hashes):
+        """Apply changes. userdb and groupdb must be the ones the plan was computed from
+        @param passwords: dict login -> clear password
+        @param hashes: dict login -> hash of its password with configured scheme and cost, computed beforehand
+        @return: list of (login, password, action) with action "create" or "update\" """
+        result = []
+        creates = set(self.creates)
+        for login in self.logins:
+            userdb.set_hash(login, hashes[login])
+            result.append((login, passwords[login], "create" if login in creates else "update"))
+        for login, group in self.group_additions:
+            groupdb.add_user(login, group)
+        for login, group in self.group_removals:
+            groupdb.delete_user(login, group)
+        return result
+
+
+def file_version(path):
+    """@return: a tuple that changes whenever the file is replaced or modified"""
+    return stat_version(os.stat(path))
+
+
+def stat_version(st):
+    """@return: file version from a stat result"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock on path, shared by all threads and processes that write it.
+    A dedicated lock file is used as path itself is replaced on each write"""
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, lines):
+    """Replace path content with lines. A temporary file is renamed over path so that readers, apache included, never
+    see a partially written file. Permissions and owner of path are kept
+    @return: version of the new file"""
+    directory, name = os.path.split(os.path.abspath(path))
+    start = time.perf_counter()
+    fd, tmp_path = tempfile.mkstemp(prefix=".%s." % name, dir=directory)
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.writelines(lines)
+            tmp_file.flush()
+            # Kernel file times are coarse grained and inode numbers get reused: set a precise mtime so that two writes
+            # in the same clock tick still give two versions
+            mtime = time.time_ns()
+            try:
+                st = os.stat(path)
+                mtime = max(mtime, st.st_mtime_ns + 1)
+                os.fchmod(tmp_file.fileno(), stat.S_IMODE(st.st_mode))
+                try:
+                    os.fchown(tmp_file.fileno(), st.st_uid, st.st_gid)
+                except PermissionError:
+                    pass
+            except FileNotFoundError:
+                os.fchmod(tmp_file.fileno(), 0o644)
+            os.utime(tmp_file.fileno(), ns=(mtime, mtime))
+            os.fsync(tmp_file.fileno())
+            version = stat_version(os.fstat(tmp_file.fileno()))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    FILE_WRITE_SECONDS.observe(time.perf_counter() - start, name)
+    FILE_WRITE_BYTES.inc(version[2], name)
+    return version
+
+
+class FileCache(object):
+    """Keep parsed files in memory and parse them again only when they changed on disk.
+    Cached objects are shared between threads and must be considered as read only: use edit() to change a file.
+    Writes can be delayed to coalesce a burst of changes in a single rewrite of the file"""
+
+    def __init__(self, parser):
+        self.parser = parser
+        self._entries = {}  # path -> (version, parsed object)
+        self._pending = {}  # path -> changes applied in memory but not yet written
+        self._timers = {}  # path -> timer that will write pending changes
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        # Called with (path, previous content, new content, changes) after each edit, within write lock
+        self.listeners = []
+        # path -> function returning keyword arguments of replay() of changes on newer content of path
+        self.replay_kwargs = {}
+        # Called with (path, content, changes, previous file version, new file version) after each write of a file,
+        # within file lock. Changes are all the ones written since previous file version
+        self.write_listeners = []
+        # Don't lose delayed changes when process exits normally
+        atexit.register(self.flush)
+
+    def get(self, path):
+        """@return: parsed content of path, from cache if file did not change since last parsing"""
+        return self._get(path)[1]
+
+    def _get(self, path):
+        version = file_version(path)
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[0] == version:
+                return cached
+            with FILE_PARSE_SECONDS.time(os.path.basename(path)):
+                parsed = self.parser(path)
+            FILE_READ_BYTES.inc(version[2], os.path.basename(path))
+            if self._pending.get(path):
+                # File changed on disk: keep changes of this process that are not written yet on top of it
+                parsed.replay(self._pending[path], **self._replay_kwargs(path))
+                parsed.changes = []
+            parsed.readonly = True
+            self._entries[path] = (version, parsed)
+            return self._entries[path]
+
+    def _replay_kwargs(self, path):
+        function = self.replay_kwargs.get(path)
+        return function() if function is not None else {}
+
+    def put(self, path, version, parsed):
+        """Cache parsed as content of path for given file version. It becomes read only"""
+        parsed.readonly = True
+        with self._lock:
+            self._entries[path] = (version, parsed)
+
+    def invalidate(self, path=None):
+        """Forget cached content of path, or of all files if path is None. Changes not yet written are kept.
+        Needed when a file is changed twice with the same size in the same clock tick as mtime does not change"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    @contextmanager
+    def edit(self, path, delay=0, max_pending=100):
+        """Yield a private copy of path content to be modified. Once done, changes are applied on the latest content
+        of the file, read again if another thread or process changed it. Concurrent writers don't lose each other
+        updates. Nothing is locked nor written if the copy was not modified.
+        File is written back atomically, under an exclusive lock, right away if delay is 0. Otherwise changes are
+        visible at once in this process and written with the following ones after delay seconds, or as soon as
+        max_pending changes are waiting"""
+        current = self.get(path)
+        edited = current.copy()
+        yield edited
+        if not edited.dirty:
+            return
+        with self._write_lock:
+            version, latest = self._get(path)
+            if latest is not current:
+                changes = edited.changes
+                edited = latest.copy()
+                edited.replay(changes, **self._replay_kwargs(path))
+            changes, edited.changes = edited.changes, []
+            self._pending.setdefault(path, []).extend(changes)
+            self.put(path, version, edited)
+            for listener in self.listeners:
+                listener(path, latest, edited, changes)
+            pending = self._pending[path]
+            if delay <= 0 or len(pending) >= max_pending:
+                self.flush(path)
+            elif path not in self._timers:
+                timer = threading.Timer(delay, self.flush, (path,))
+                timer.daemon = True
+                self._timers[path] = timer
+                timer.start()
+
+    def flush(self, path=None):
+        """Write pending changes of path, or of all files if path is None, right now"""
+        with self._write_lock:
+            paths = list(self._pending) if path is None else [path]
+            for path in paths:
+                timer = self._timers.pop(path, None)
+                if timer is not None:
+                    timer.cancel()
+                if not self._pending.get(path):
+                    continue
+                with file_lock(path):
+                    # Read again if another process wrote the file meanwhile, pending changes are replayed on it
+                    base_version, parsed = self._get(path)
+                    version = atomic_write(path, parsed.serialize())
+                    changes = self._pending.pop(path)
+                    self.put(path, version, parsed)
+                    for listener in self.write_listeners:
+                        listener(path, parsed, changes, base_version, version)
+
+    def pending(self, path):
+        """@return: number of changes of path not yet written"""
+        return len(self._pending.get(path, ()))
+
+    def version(self, path):
+        """@return: version of path content as seen by this process. It changes when file changes on disk and when it
+        is edited by this process, even if changes are not written yet"""
+        return self._get(path)[0] + (self.pending(path),)
+
+
+class FileStore(object):
+    """Storage backend using htpasswd and htgroup files directly, kept parsed in memory.
+    Storage backends provide get_users() and get_groups() for read only access, edit_users() and edit_groups() context
+    managers to change them"""
+
+    def __init__(
+        self,
+        users_path,
+        groups_path,
+        users_cache=None,
+        groups_cache=None,
+        delay=0,
+        max_pending=100,
+        users_dbm=None,
+        groups_dbm=None,
+        journal=None,
+    ):
+        self.users_path = users_path
+        self.groups_path = groups_path
+        self.users_cache = users_cache or FileCache(Users.from_file)
+        self.groups_cache = groups_cache or FileCache(Groups.from_file)
+        # Writes coalescing, see FileCache.edit()
+        self.delay = delay
+        self.max_pending = max_pending
+        # Kept up to date by changes made through this process, built again if files are changed by someone else
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self.users_cache.listeners.append(self._users_changed)
+        self.groups_cache.listeners.append(self._groups_changed)
+        # Group additions are replayed on newer content only for users that still exist
+        self.groups_cache.replay_kwargs[groups_path] = lambda: dict(users=self.get_users())
+        # Optional DBM copies of files for apache (pydentity_dbm.DbmFile), updated each time files are written
+        self.dbms = {}
+        if users_dbm is not None:
+            self.dbms[users_path] = (users_dbm, self.users_cache)
+        if groups_dbm is not None:
+            self.dbms[groups_path] = (groups_dbm, self.groups_cache)
+        # Optional journal of written changes for replicas (pydentity_journal.Journal)
+        self.journal = journal
+        if self.dbms or journal is not None:
+            self.users_cache.write_listeners.append(self._file_written)
+            self.groups_cache.write_listeners.append(self._file_written)
+        self.sync_dbms()
+
+    def get_users(self):
+        """@return: users, shared between threads and read only"""
+        return self.users_cache.get(self.users_path)
+
+    def get_groups(self):
+        """@return: groups, shared between threads and read only"""
+        return self.groups_cache.get(self.groups_path)
+
+    def edit_users(self, flush=False):
+        """Yield users to be modified. File is written back atomically at the end of the with block, only if
+        modified. Write is delayed to be coalesced with the next ones unless flush is True"""
+        return self.users_cache.edit(self.users_path, 0 if flush else self.delay, self.max_pending)
+
+    def edit_groups(self, flush=False):
+        """Yield groups to be modified. File is written back atomically at the end of the with block, only if
+        modified. Write is delayed to be coalesced with the next ones unless flush is True"""
+        return self._edit_groups(0 if flush else self.delay)
+
+    @contextmanager
+    def _edit_groups(self, delay):
+        with self.groups_cache.edit(self.groups_path, delay, self.max_pending) as groupdb:
+            # So that additions of users deleted meanwhile by someone else are not replayed
+            groupdb.users = self.get_users()
+            yield groupdb
+
+    def version(self):
+        """@return: a value that changes whenever users or groups change"""
+        return (self.users_cache.version(self.users_path), self.groups_cache.version(self.groups_path))
+
+    def stats(self):
+        """@return: figures about users and groups, see DirectoryStats.snapshot()"""
+        users = self.get_users()
+        groups = self.get_groups()
+        with self._stats_lock:
+            stats = self._stats
+            if stats is None or not stats.is_for(users, groups):
+                stats = self._stats = DirectoryStats(users, groups)
+            return stats.snapshot()
+
+    def _users_changed(self, path, previous, current, changes):
+        if path != self.users_path:
+            return
+        groups = self.get_groups()
+        with self._stats_lock:
+            stats = self._stats
+            if stats is None:
+                return
+            if not stats.is_for(previous, groups):
+                # Changed by someone else too: build stats again on next use
+                self._stats = None
+                return
+            stats.users_changed(previous, current, groups, changes)
+
+    def _groups_changed(self, path, previous, current, changes):
+        if path != self.groups_path:
+            return
+        users = self.get_users()
+        with self._stats_lock:
+            stats = self._stats
+            if stats is None:
+                return
+            if not stats.is_for(users, previous):
+                self._stats = None
+                return
+            stats.groups_changed(previous, current, users, changes)
+
+    def _file_written(self, path, parsed, changes, base_version, version):
+        if path in self.dbms:
+            self.dbms[path][0].sync(parsed, changes, base_version, version)
+        if self.journal is not None and path in (self.users_path, self.groups_path):
+            self.journal.append("users" if path == self.users_path else "groups", changes, parsed.serialize())
+
+    def sync_dbms(self):
+        """Write DBM databases again from files, for changes made by someone else while this process was not running"""
+        for path, (dbm_file, cache) in self.dbms.items():
+            with file_lock(path):
+                version, parsed = cache._get(path)
+                dbm_file.rebuild(parsed, version)
+
+    def flush(self):
+        """Write delayed changes right now"""
+        self.users_cache.flush(self.users_path)
+        self.groups_cache.flush(self.groups_path)
@@ -9,12 +9,38 @@ Test suite for pydentity
 from pydentity import app, CONF
 
 import htpasswd
+import werkzeug.test
 
+import base64
+import dbm.dumb
+import io
+import json
 import unittest
+import unittest.mock
+import multiprocessing
 import os
+import pstats
+import re
+import shutil
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from os.path import dirname, join
 
-from pydentity import get_mail, generate_random_password
+from pydentity import get_mail, generate_random_password, users_cache, groups_cache, check_password, send_mail
+from pydentity import credential_cache, get_mail_queue, mail_queues, page_cache, stores, get_store, auth
+import pydentity_auth
+import pydentity_bench
+from pydentity_metrics import Counter, Histogram, Registry
+from pydentity_dbm import DbmFile
+from pydentity_journal import Journal, Replica, checksum
+from pydentity_profile import SlowRequestProfiler
+from pydentity_passwd import generate_and_hash, hash_password, identify, md5_crypt, sha_crypt, verify_password, bcrypt
+from pydentity_passwd import UnsupportedHashError
+from pydentity_sqlite import SqliteStore
+from pydentity_store import FileCache, Users, Groups, BatchPlan, atomic_write, file_version, UserExists, ReadOnlyError
+from pydentity_store import DirectoryStats, FileStore
 
 
 class BasicTestCase(unittest.TestCase):
@@ -33,11 +59,16 @@ class BasicTestCase(unittest.TestCase):
         app.config["TESTING"] = True
         CONF["PWD_FILE"] = self.passwd
         CONF["GROUP_FILE"] = self.group
+        # Files are rewritten by each test within the same clock tick, don't trust mtime
+        users_cache.invalidate()
+        groups_cache.invalidate()
+        page_cache.clear()
         self.client = app.test_client()
 
     def tearDown(self):
-        os.unlink(self.passwd)
-        os.unlink(self.group)
+        for path in (self.passwd, self.group, self.passwd + ".lock", self.group + ".lock"):
+            if os.path.exists(path):
+                os.unlink(path)
 
     def test_ok_pages(self):
         for page in ("/user/user1", "/list_users"):
@@ -134,6 +165,22 @@ class BasicTestCase(unittest.TestCase):
             data = r.data.decode()
             self.assertIn("User password updated", data)
 
+    def test_rehash_on_password_change(self):
+        self.addCleanup(CONF.update, HASH_SCHEME=CONF["HASH_SCHEME"], HASH_COST=CONF["HASH_COST"])
+        CONF.update(HASH_SCHEME="sha512", HASH_COST=1000)
+        self.assertEqual(identify(Users.from_file(self.passwd).get_hash("user2")), "apr1")
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/user/user2",
+            data={"old_password": "user2", "new_password": "New12345", "repeat_password": "New12345"},
+            environ_base={"REMOTE_USER": "user2"},
+        )
+        self.assertIn("User password updated", r.data.decode())
+        userdb = Users.from_file(self.passwd)
+        self.assertTrue(userdb.get_hash("user2").startswith("$6$rounds=1000$"))
+        self.assertTrue(verify_password(userdb.get_hash("user2"), "New12345"))
+        # Other users keep their hash until they change their password
+        self.assertEqual(identify(userdb.get_hash("user1")), "apr1")
+
     def test_new_user(self):
         r = self.client.get(CONF["URL_PREFIX"] + "/user/xxx", environ_base={"REMOTE_USER": "xxx"})
         self.assertEqual(r.status_code, 200)
@@ -260,6 +307,9 @@ class BasicTestCase(unittest.TestCase):
             self.assertFalse(groupdb.is_user_in("user14", "admin"))
 
     def test_batch_user_creation_with_mail(self):
+        # Synchronous sending, see MailTestCase for background delivery
+        self.addCleanup(CONF.__setitem__, "MAIL_QUEUE_WORKERS", CONF["MAIL_QUEUE_WORKERS"])
+        CONF["MAIL_QUEUE_WORKERS"] = 0
         mail = get_mail()
         with mail.record_messages() as outbox:
             r = self.client.get(CONF["URL_PREFIX"] + "/batch_user_creation", headers={"REMOTE_USER": "user1"})
@@ -287,6 +337,20 @@ class BasicTestCase(unittest.TestCase):
                 self.assertEqual(["user18@test.com"], outbox[0].recipients)
                 self.assertEqual(["user19@test.com"], outbox[1].recipients)
 
+    def test_batch_user_creation_dry_run(self):
+        before = (open(self.passwd).read(), open(self.group).read())
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/batch_user_creation",
+            data={"users_login": "user2\r\nuser13", "group_admin": "on", "dry_run": ""},
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertIn("Preview of batch user creation", data)
+        self.assertIn("user13 &rarr; admin", data)
+        self.assertIn("user2 &larr; users", data)
+        self.assertEqual((open(self.passwd).read(), open(self.group).read()), before)
+
     def test_batch_user_creation_without_admin(self):
         r = self.client.get(CONF["URL_PREFIX"] + "/batch_user_creation", environ_base={"REMOTE_USER": "user2"})
         self.assertEqual(r.status_code, 200)
@@ -302,6 +366,275 @@ class BasicTestCase(unittest.TestCase):
         data = r.data.decode()
         self.assertIn("Forbidden: only admin user allowed", data)
 
+    def test_read_only_pages_dont_write(self):
+        versions = (file_version(self.passwd), file_version(self.group))
+        for page in ("/list_users", "/list_groups", "/stats", "/user/user2", "/group/users", "/batch_user_creation"):
+            r = self.client.get(CONF["URL_PREFIX"] + page, environ_base={"REMOTE_USER": "user1"})
+            self.assertEqual(r.status_code, 200)
+        # Admin posting its page without any change
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/user/user1",
+            data={"new_password": "", "repeat_password": "", "group_admin": "on", "group_users": "on"},
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual((file_version(self.passwd), file_version(self.group)), versions)
+        self.assertFalse(os.path.exists(self.passwd + ".lock"))
+        self.assertFalse(os.path.exists(self.group + ".lock"))
+
+    def test_list_groups_and_stats(self):
+        with htpasswd.Basic(self.passwd, mode="md5") as userdb:
+            userdb.add("user3", "user3")
+        users_cache.invalidate()
+        r = self.client.get(CONF["URL_PREFIX"] + "/list_groups", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertIn('<th scope="row">users</th>', data)
+        self.assertIn("/user/user2", data)
+        self.assertNotIn("/user/user3", data)
+
+        r = self.client.get(CONF["URL_PREFIX"] + "/stats", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertIn("/user/user3", data)
+        self.assertNotIn("/user/user2", data)
+        self.assertIn('<a href="/group/users">users</a> (2)', data)
+        self.assertIn("apr1: 3", data)
+
+    def test_auth_request(self):
+        credential_cache.clear()
+        url = CONF["URL_PREFIX"] + "/auth"
+
+        def basic(user, password):
+            return {"Authorization": "Basic %s" % base64.b64encode(("%s:%s" % (user, password)).encode()).decode()}
+
+        def get(url, headers=None):
+            # Auth page is disabled by default: call its view directly
+            with app.test_request_context(url, headers=headers):
+                return app.make_response(auth())
+
+        self.assertEqual(self.client.get(url, headers=basic("user2", "user2")).status_code, 404)
+        r = get(url)
+        self.assertEqual(r.status_code, 401)
+        self.assertEqual(r.headers["WWW-Authenticate"], 'Basic realm="pydentity"')
+        self.assertEqual(get(url, headers=basic("user2", "wrong")).status_code, 401)
+        with unittest.mock.patch("pydentity_auth.verify_password", wraps=verify_password) as verify:
+            self.assertEqual(get(url, headers=basic("nobody", "user2")).status_code, 401)
+            # Hashed anyway, answer time does not tell that user does not exist
+            self.assertEqual(verify.call_count, 1)
+        with unittest.mock.patch("pydentity_auth.verify_password", wraps=verify_password) as verify:
+            for i in range(3):
+                r = get(url, headers=basic("user2", "user2"))
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.headers["X-Auth-User"], "user2")
+            # Password is hashed once, next requests are answered from cache
+            self.assertEqual(verify.call_count, 1)
+        self.assertEqual(get(url + "?group=admin", headers=basic("user2", "user2")).status_code, 403)
+        r = get(url + "?group=admin&group=users", headers=basic("user2", "user2"))
+        self.assertEqual(r.status_code, 200)
+        r = get(url, headers=dict(basic("user1", "user1"), **{"X-Auth-Group": "admin, other"}))
+        self.assertEqual(r.status_code, 200)
+
+        # Cached checks don't survive a password change
+        with htpasswd.Basic(self.passwd, mode="md5") as userdb:
+            userdb.change_password("user2", "New12345")
+        self.assertEqual(get(url, headers=basic("user2", "user2")).status_code, 401)
+        self.assertEqual(get(url, headers=basic("user2", "New12345")).status_code, 200)
+
+    def test_page_cache(self):
+        url = CONF["URL_PREFIX"] + "/stats"
+        admin = {"REMOTE_USER": "user1"}
+        r = self.client.get(url, environ_base=admin)
+        page, etag = r.data, r.headers["ETag"]
+        self.assertEqual(r.headers["Cache-Control"], "private, no-cache")
+        with unittest.mock.patch("pydentity.render_template") as render_template:
+            r = self.client.get(url, environ_base=admin)
+            self.assertEqual(r.headers["ETag"], etag)
+            self.assertEqual(r.data, page)
+            r = self.client.get(url, headers={"If-None-Match": etag}, environ_base=admin)
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.data, b"")
+            self.assertEqual(render_template.call_count, 0)
+        # Other users, pages or query arguments have their own version
+        r = self.client.get(url, environ_base={"REMOTE_USER": "user2"}, headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("Forbidden: only admin user allowed", r.data.decode())
+        r = self.client.get(url + "?x=1", headers={"If-None-Match": etag}, environ_base=admin)
+        self.assertEqual(r.status_code, 200)
+
+        # Changes made by this process or another one give a new version
+        r = self.client.put(CONF["URL_PREFIX"] + "/api/users/user3", json={"password": "Secret!3"}, environ_base=admin)
+        self.assertEqual(r.status_code, 201)
+        r = self.client.get(url, headers={"If-None-Match": etag}, environ_base=admin)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("/user/user3", r.data.decode())
+        etag = r.headers["ETag"]
+        with open(self.passwd, "a") as passwd:
+            passwd.write("user4:%s\n" % md5_crypt("user4", "saltsalt"))
+        r = self.client.get(url, headers={"If-None-Match": etag}, environ_base=admin)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("/user/user4", r.data.decode())
+
+    def test_list_users_pagination_and_search(self):
+        with htpasswd.Basic(self.passwd, mode="md5") as userdb:
+            for i in range(3, 8):
+                userdb.add("user%s" % i, "user%s" % i)
+            userdb.add("alice", "alice")
+        users_cache.invalidate()
+        url = CONF["URL_PREFIX"] + "/list_users"
+        r = self.client.get(url + "?per_page=3&page=2", environ_base={"REMOTE_USER": "user1"})
+        data = r.data.decode()
+        self.assertEqual(re.findall('<th scope="row">(.*)</th>', data), ["user3", "user4", "user5"])
+        self.assertIn("Page 2 / 3 (8)", data)
+
+        r = self.client.get(url + "?q=user&sort=-login&per_page=2", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(re.findall('<th scope="row">(.*)</th>', r.data.decode()), ["user7", "user6"])
+        r = self.client.get(url + "?q=lic&match=contains", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(re.findall('<th scope="row">(.*)</th>', r.data.decode()), ["alice"])
+        r = self.client.get(url + "?sort=-groups&per_page=1", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(re.findall('<th scope="row">(.*)</th>', r.data.decode()), ["user1"])
+
+    def test_group_page_search(self):
+        url = CONF["URL_PREFIX"] + "/group/users"
+        r = self.client.get(url + "?q=user2&candidate=user", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertIn("/user/user2", data)
+        self.assertNotIn("/user/user1", data)
+        # Members are not proposed again
+        self.assertNotIn('<option value="user2"', data)
+
+    def test_one_membership_lookup_per_request(self):
+        with unittest.mock.patch.object(Groups, "groups_of", autospec=True, side_effect=Groups.groups_of) as groups_of:
+            with unittest.mock.patch.object(Groups, "is_user_in", autospec=True) as is_user_in:
+                r = self.client.get(CONF["URL_PREFIX"] + "/user/user1", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("/list_users", r.data.decode())  # Admin menu
+        self.assertEqual(groups_of.call_count, 1)
+        self.assertEqual(is_user_in.call_count, 0)
+
+    def test_metrics(self):
+        self.client.get(CONF["URL_PREFIX"] + "/list_users", environ_base={"REMOTE_USER": "user1"})
+        r = self.client.get(CONF["URL_PREFIX"] + "/metrics", environ_base={"REMOTE_USER": "user2"})
+        self.assertEqual(r.status_code, 403)
+        r = self.client.get(CONF["URL_PREFIX"] + "/metrics", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertRegex(
+            data, 'pydentity_request_duration_seconds_count{endpoint="list_users",method="GET",status="200"} [1-9]'
+        )
+        self.assertRegex(data, 'pydentity_file_parse_seconds_count{file="test_group"} [1-9]')
+        self.assertIn("# TYPE pydentity_mail_failures_total counter", data)
+
+    def test_slow_request_profiles(self):
+        directory = join(dirname(__name__), "test_profiles")
+        self.addCleanup(shutil.rmtree, directory)
+        wsgi_app = app.wsgi_app
+        self.addCleanup(setattr, app, "wsgi_app", wsgi_app)
+        app.wsgi_app = SlowRequestProfiler(wsgi_app, directory, threshold_ms=0, sample_rate=1, max_files=2)
+        with self.assertLogs("pydentity", "WARNING") as logs:
+            for page in ("/list_users", "/stats", "/group/users"):
+                r = self.client.get(CONF["URL_PREFIX"] + page, environ_base={"REMOTE_USER": "user1"})
+                self.assertEqual(r.status_code, 200)
+                # Request ends once response is closed by the server
+                r.close()
+        self.assertIn("Slow request: GET %s/stats took" % CONF["URL_PREFIX"], logs.output[1])
+        profiles = app.wsgi_app.profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(profiles[1].endswith("ms.prof"))
+        self.assertIn("group_users", profiles[1])
+        self.assertTrue(pstats.Stats(profiles[1]).total_calls > 0)
+
+        # Not sampled: only logged
+        app.wsgi_app.sample_rate = 0
+        with self.assertLogs("pydentity", "WARNING"):
+            self.client.get(CONF["URL_PREFIX"] + "/list_users", environ_base={"REMOTE_USER": "user1"}).close()
+        self.assertEqual(app.wsgi_app.profiles(), profiles)
+
+    def test_export(self):
+        url = CONF["URL_PREFIX"] + "/export/"
+        r = self.client.get(url + "users.csv", environ_base={"REMOTE_USER": "user1"})
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(r.mimetype, "text/csv")
+        self.assertEqual(r.data.decode().splitlines(), ["username,groups", "user1,admin users", "user2,users"])
+        r = self.client.get(url + "memberships.ndjson", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(
+            [json.loads(line) for line in r.data.decode().splitlines()],
+            [
+                {"group": "admin", "username": "user1"},
+                {"group": "users", "username": "user1"},
+                {"group": "users", "username": "user2"},
+            ],
+        )
+        self.assertEqual(
+            self.client.get(url + "memberships.xml", environ_base={"REMOTE_USER": "user1"}).status_code, 404
+        )
+        r = self.client.get(url + "users.csv", environ_base={"REMOTE_USER": "user2"})
+        self.assertIn("Forbidden: only admin user allowed", r.data.decode())
+
+    def test_import_users(self):
+        saved_chunk_size = CONF["IMPORT_CHUNK_SIZE"]
+        self.addCleanup(CONF.__setitem__, "IMPORT_CHUNK_SIZE", saved_chunk_size)
+        CONF["IMPORT_CHUNK_SIZE"] = 2
+        hash3 = md5_crypt("Secret!3", "saltsalt")
+        content = "\n".join(
+            [
+                "login,email,groups,password_hash",
+                "user3,user3@test.com,admin users,%s" % hash3,
+                "user4,user4@test.com,users,",
+                "user2,,,",
+                "",
+                "user5,user5@test.com,unknown,",
+                "user6,not a mail,,",
+            ]
+        )
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/import_users",
+            data={"file": (io.BytesIO(content.encode("utf-8")), "users.csv")},
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        progress = [json.loads(line) for line in r.data.decode().splitlines()]
+        self.assertEqual([(p["rows"], p["created"], p["updated"]) for p in progress], [(2, 2, 0), (4, 2, 1), (5, 2, 1)])
+        self.assertTrue(progress[-1]["done"])
+        # Each line only has errors of its chunk
+        self.assertEqual(
+            [[(e["line"], e["login"]) for e in p["errors"]] for p in progress], [[], [(6, "user5")], [(7, "user6")]]
+        )
+        self.assertEqual(progress[-1]["error_count"], 2)
+        # Generated password of user4 is not mailed: it is given back
+        self.assertEqual([[p["login"] for p in line["passwords"]] for line in progress], [["user4"], [], []])
+        self.assertTrue(
+            check_password(Users.from_file(self.passwd).get_hash("user4"), progress[0]["passwords"][0]["password"])
+        )
+        userdb = Users.from_file(self.passwd)
+        self.assertEqual(userdb.get_hash("user3"), hash3)
+        self.assertTrue(check_password(userdb.get_hash("user2"), "user2"))
+        self.assertNotIn("user5", userdb)
+        groupdb = Groups.from_file(self.group)
+        self.assertEqual(groupdb.members("users"), ["user1", "user2", "user3", "user4"])
+        self.assertEqual(groupdb.members("admin"), ["user1", "user3"])
+
+        # CSV as request body
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/import_users",
+            data="user7,,,\n",
+            content_type="text/csv",
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        self.assertTrue(r.is_streamed)
+        progress = json.loads(r.data.decode())
+        self.assertEqual(progress["created"], 1)
+        # No mail address: generated password is given back
+        self.assertEqual([p["login"] for p in progress["passwords"]], ["user7"])
+        self.assertTrue(
+            check_password(Users.from_file(self.passwd).get_hash("user7"), progress["passwords"][0]["password"])
+        )
+
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/import_users", data="user8,,,", environ_base={"REMOTE_USER": "user2"}
+        )
+        self.assertIn("Forbidden: only admin user allowed", r.data.decode())
+
     def test_generate_password(self):
         password = generate_random_password()
         self.assertRegex(password, CONF["PASSWORD_PATTERN"])
@@ -310,5 +643,938 @@ class BasicTestCase(unittest.TestCase):
         self.assertEqual(len(password), 11)
 
 
+def concurrent_writer(passwd, group, worker, count):
+    """Add count users to passwd and group files, as another process would"""
+    users_cache = FileCache(Users.from_file)
+    groups_cache = FileCache(Groups.from_file)
+    for i in range(count):
+        user = "worker%s_%s" % (worker, i)
+        with users_cache.edit(passwd) as userdb:
+            userdb.set_hash(user, "$apr1$salt$hash")
+        with groups_cache.edit(group) as groupdb:
+            groupdb.add_user(user, "users")
+
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        BasicTestCase.setUp(self)
+
+    def tearDown(self):
+        BasicTestCase.tearDown(self)
+
+    def api(self, method, path, user="user1", **kwargs):
+        return self.client.open(
+            CONF["URL_PREFIX"] + "/api" + path, method=method, environ_base={"REMOTE_USER": user}, **kwargs
+        )
+
+    def test_forbidden(self):
+        r = self.api("GET", "/users", user="user2")
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(r.get_json()["error"], "Forbidden: only admin user allowed")
+        r = self.api("PUT", "/users/user3", user="user2", json={})
+        self.assertEqual(r.status_code, 403)
+        self.assertNotIn("user3", Users.from_file(self.passwd))
+
+    def test_users(self):
+        r = self.api("GET", "/users")
+        self.assertEqual(r.get_json(), {"users": ["user1", "user2"], "page": 1, "pages": 1, "total": 2})
+        r = self.api("GET", "/users/user1")
+        self.assertEqual(r.get_json(), {"username": "user1", "groups": ["admin", "users"]})
+        self.assertEqual(self.api("GET", "/users/user3").status_code, 404)
+
+        r = self.api("PUT", "/users/user3", json={"groups": ["users"]})
+        self.assertEqual(r.status_code, 201)
+        data = r.get_json()
+        self.assertTrue(data["created"])
+        self.assertTrue(check_password(Users.from_file(self.passwd).get_hash("user3"), data["password"]))
+        self.assertEqual(Groups.from_file(self.group).members("users"), ["user1", "user2", "user3"])
+
+        r = self.api("PUT", "/users/user3", json={"password": "Secret!42", "groups": ["admin"]})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json(), {"username": "user3", "groups": ["admin"], "created": False})
+        self.assertTrue(check_password(Users.from_file(self.passwd).get_hash("user3"), "Secret!42"))
+
+        self.assertEqual(self.api("PUT", "/users/user3", json={"password": "weak"}).status_code, 400)
+        self.assertEqual(self.api("PUT", "/users/user3", json={"groups": ["unknown"]}).status_code, 400)
+        self.assertEqual(self.api("PUT", "/users/us:er", json={}).status_code, 400)
+        r = self.api("PUT", "/users/eve", json={"password_hash": "$apr1$x$y\nroot:$apr1$zz$ww"})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Users.from_file(self.passwd).users, ["user1", "user2", "user3"])
+        self.assertEqual(self.api("PUT", "/users/user3", data="not json").status_code, 400)
+
+        r = self.api("DELETE", "/users/user3")
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("user3", Users.from_file(self.passwd))
+        self.assertNotIn("user3", Groups.from_file(self.group).members("admin"))
+        self.assertEqual(self.api("DELETE", "/users/user3").status_code, 404)
+
+    def test_groups(self):
+        r = self.api("GET", "/groups")
+        self.assertEqual(r.get_json(), {"groups": {"admin": ["user1"], "users": ["user1", "user2"]}})
+        r = self.api("PUT", "/groups/admin/members/user2")
+        self.assertEqual(r.get_json()["groups"], ["admin", "users"])
+        r = self.api("DELETE", "/groups/users/members/user2")
+        self.assertEqual(r.get_json()["groups"], ["admin"])
+        self.assertEqual(self.api("GET", "/groups/admin").get_json()["members"], ["user1", "user2"])
+        self.assertEqual(self.api("PUT", "/groups/unknown/members/user2").status_code, 404)
+        self.assertEqual(self.api("PUT", "/groups/admin/members/user3").status_code, 404)
+
+    def test_bulk(self):
+        operations = [{"op": "put_user", "username": "bulk%s" % i, "groups": ["users"]} for i in range(50)]
+        operations.append({"op": "add_to_group", "username": "user2", "group": "unknown"})
+        operations.append({"op": "delete_user", "username": "user2"})
+        r = self.api("POST", "/bulk", json={"operations": operations})
+        self.assertEqual(r.status_code, 200)
+        results = r.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [201] * 50 + [404, 200])
+        userdb = Users.from_file(self.passwd)
+        self.assertEqual(len(userdb), 51)
+        self.assertTrue(check_password(userdb.get_hash("bulk7"), results[7]["password"]))
+        self.assertEqual(len(Groups.from_file(self.group).members("users")), 51)
+
+        # Atomic batch: nothing is written on failure
+        versions = (file_version(self.passwd), file_version(self.group))
+        operations = [{"op": "delete_user", "username": "bulk1"}, {"op": "delete_user", "username": "user2"}]
+        r = self.api("POST", "/bulk", json={"operations": operations, "atomic": True})
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual((file_version(self.passwd), file_version(self.group)), versions)
+
+        self.assertEqual(
+            self.api("POST", "/bulk", json={"operations": [{"op": "rename"}]}).get_json()["results"][0]["status"], 400
+        )
+
+
+class DelayedApiTestCase(unittest.TestCase):
+    def setUp(self):
+        BasicTestCase.setUp(self)
+        self.saved_conf = dict(CONF)
+        CONF["WRITE_DELAY"] = 60
+
+    def tearDown(self):
+        users_cache.flush()
+        groups_cache.flush()
+        stores.clear()
+        CONF.update(self.saved_conf)
+        BasicTestCase.tearDown(self)
+
+    def test_burst_written_once(self):
+        version = file_version(self.passwd)
+        for i in range(10):
+            r = self.client.put(
+                CONF["URL_PREFIX"] + "/api/users/burst%s" % i, json={}, environ_base={"REMOTE_USER": "user1"}
+            )
+            self.assertEqual(r.status_code, 201)
+        self.assertEqual(file_version(self.passwd), version)
+        # Visible at once by this process
+        r = self.client.get(CONF["URL_PREFIX"] + "/api/users", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.get_json()["total"], 12)
+
+        r = self.client.delete(CONF["URL_PREFIX"] + "/api/users/burst0?flush=1", environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(Users.from_file(self.passwd)), 11)
+
+
+class SqliteApiTestCase(ApiTestCase):
+    """Same API tests, with users and groups stored in SQLite"""
+
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        self.saved_conf = dict(CONF)
+        CONF["STORAGE"] = "sqlite"
+        CONF["STORAGE_DB"] = join(dirname(__name__), "test_storage.sqlite")
+
+    def tearDown(self):
+        stores.clear()
+        os.unlink(CONF["STORAGE_DB"])
+        CONF.update(self.saved_conf)
+        ApiTestCase.tearDown(self)
+
+
+def dbm_content(path):
+    """@return: content of a dbm.dumb database as a dict of strings"""
+    with dbm.dumb.open(path, "r") as db:
+        return dict((key.decode(), db[key].decode()) for key in db.keys())
+
+
+class SqliteStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        BasicTestCase.setUp(self)
+        self.db = join(dirname(__name__), "test_storage.sqlite")
+        self.store = SqliteStore(self.db, self.passwd, self.group)
+
+    def tearDown(self):
+        os.unlink(self.db)
+        BasicTestCase.tearDown(self)
+
+    def test_import_and_export(self):
+        users = self.store.get_users()
+        groups = self.store.get_groups()
+        version = self.store.version()
+        self.assertEqual(users.users, ["user1", "user2"])
+        self.assertEqual(groups.groups, ["admin", "users"])
+        self.assertEqual(groups.groups_of("user1"), {"admin", "users"})
+        self.assertRaises(ReadOnlyError, users.pop, "user1")
+
+        with self.store.edit_users() as userdb:
+            with self.store.edit_groups() as groupdb:
+                userdb.add("alice", "alice")
+                groupdb.add_user("alice", "admin")
+                groupdb.delete_user("user1", "users")
+        self.assertTrue(check_password(Users.from_file(self.passwd).get_hash("alice"), "alice"))
+        self.assertEqual(Groups.from_file(self.group).members("admin"), ["user1", "alice"])
+        self.assertEqual(Groups.from_file(self.group).members("users"), ["user2"])
+        self.assertNotEqual(self.store.version(), version)
+        self.assertEqual(users.search("a"), ["alice"])
+        self.assertEqual(users.search("ser", contains=True), ["user1", "user2"])
+
+        self.assertEqual(list(users), ["user1", "user2", "alice"])
+        self.assertEqual(list(groups.memberships()), [("admin", "user1"), ("admin", "alice"), ("users", "user2")])
+
+        # Database is the reference, it is not imported again
+        self.assertEqual(SqliteStore(self.db, self.passwd, self.group).get_users().users, ["user1", "user2", "alice"])
+
+    def test_stats(self):
+        with self.store.edit_users() as userdb:
+            with self.store.edit_groups() as groupdb:
+                userdb.add("user3", "Secret!1", "sha256")
+                groupdb.delete_user("user2", "users")
+                groupdb.add_user("user4", "empty")
+                groupdb.delete_user("user4", "empty")
+        self.assertEqual(
+            self.store.stats(),
+            DirectoryStats(Users.from_file(self.passwd), Groups.from_file(self.group)).snapshot(),
+        )
+        self.assertEqual(self.store.stats()["group_sizes"]["empty"], 0)
+
+    def test_dbm_export(self):
+        groups_dbm = DbmFile(join(dirname(__name__), "test_storage_dbm_groups"), "groups", "dumb")
+        for suffix in (".dat", ".dir", ".bak"):
+            self.addCleanup(lambda path: os.path.exists(path) and os.unlink(path), groups_dbm.path + suffix)
+        store = SqliteStore(self.db, self.passwd, self.group, groups_dbm=groups_dbm)
+        with store.edit_groups() as groupdb:
+            groupdb.add_user("user2", "admin")
+        self.assertEqual(dbm_content(groups_dbm.path), {"user1": "admin,users", "user2": "admin,users"})
+
+    def test_journal_export(self):
+        journal = Journal(join(dirname(__name__), "test_storage_journal"))
+        for name in (journal.path, journal.path + ".lock"):
+            self.addCleanup(lambda name: os.path.exists(name) and os.unlink(name), name)
+        store = SqliteStore(self.db, self.passwd, self.group, journal=journal)
+        with store.edit_users() as userdb:
+            with store.edit_groups() as groupdb:
+                userdb.pop("user2")
+                groupdb.add_user("user1", "staff")
+        changes = [(entry["file"], entry["change"]) for entry in journal.read(0)["changes"]]
+        self.assertEqual(changes, [("users", ["pop", "user2"]), ("groups", ["add_user", "user1", "staff"])])
+
+    def test_rollback(self):
+        versions = (file_version(self.passwd), file_version(self.group))
+        with self.assertRaises(UserExists):
+            with self.store.edit_users() as userdb:
+                with self.store.edit_groups() as groupdb:
+                    groupdb.add_user("user2", "admin")
+                    userdb.add("user1", "user1")
+        self.assertFalse(self.store.get_groups().is_user_in("user2", "admin"))
+        self.assertEqual((file_version(self.passwd), file_version(self.group)), versions)
+
+    def test_delayed_export(self):
+        store = SqliteStore(self.db, self.passwd, self.group, delay=60, max_pending=3)
+        version = file_version(self.group)
+        with store.edit_groups() as groupdb:
+            groupdb.add_user("user2", "admin")
+        self.assertTrue(store.get_groups().is_user_in("user2", "admin"))
+        self.assertEqual(file_version(self.group), version)
+        with store.edit_groups() as groupdb:
+            groupdb.delete_user("user2", "users")
+            groupdb.delete_user("user1", "users")
+        # Too many changes waiting
+        self.assertEqual(Groups.from_file(self.group).members("users"), [])
+
+        with store.edit_users() as userdb:
+            userdb.pop("user2")
+        self.assertIn("user2", Users.from_file(self.passwd))
+        store.flush()
+        self.assertNotIn("user2", Users.from_file(self.passwd))
+
+
+class AuthTestCase(unittest.TestCase):
+    def test_parse_basic(self):
+        self.assertEqual(pydentity_auth.parse_basic("Basic dXNlcjE6cDp3"), ("user1", "p:w"))
+        self.assertEqual(pydentity_auth.parse_basic("basic " + base64.b64encode("é:é".encode()).decode()), ("é", "é"))
+        for header in (None, "", "Bearer dXNlcjE6cDp3", "Basic !!!", "Basic " + base64.b64encode(b"user1").decode()):
+            self.assertIsNone(pydentity_auth.parse_basic(header))
+
+    def test_credential_cache(self):
+        password_hash = md5_crypt("Secret!1", "saltsalt")
+        cache = pydentity_auth.CredentialCache(size=1, ttl=60)
+        self.assertEqual(cache.check("user1", "Secret!1", password_hash), (True, False))
+        self.assertEqual(cache.check("user1", "Secret!1", password_hash), (True, True))
+        self.assertEqual(cache.check("user1", "Secret!2", password_hash), (False, False))
+        # Only valid for the hash it was checked against
+        self.assertEqual(cache.check("user1", "Secret!1", md5_crypt("Secret!1", "othersal")), (True, False))
+        self.assertEqual(cache.check("user2", "Secret!1", password_hash), (True, False))
+        # Least recently used entry was dropped
+        self.assertEqual(cache.check("user1", "Secret!1", password_hash), (True, False))
+        cache = pydentity_auth.CredentialCache(ttl=0)
+        cache.check("user1", "Secret!1", password_hash)
+        self.assertEqual(cache.check("user1", "Secret!1", password_hash), (True, False))
+
+    def test_standalone_app(self):
+        BasicTestCase.setUp(self)
+        self.addCleanup(BasicTestCase.tearDown, self)
+        application = pydentity_auth.create_app(self.passwd, self.group)
+        client = werkzeug.test.Client(application)
+        r = client.get("/?group=admin", headers={"Authorization": "Basic dXNlcjE6dXNlcjE="})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["X-Auth-User"], "user1")
+        r = client.get("/", headers={"Authorization": "Basic dXNlcjE6dXNlcjI=", "X-Auth-Group": "admin"})
+        self.assertEqual(r.status_code, 401)
+        self.assertIn("WWW-Authenticate", r.headers)
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        BasicTestCase.setUp(self)
+
+    def tearDown(self):
+        BasicTestCase.tearDown(self)
+
+    def test_journal_replica(self):
+        journal_file = join(dirname(__name__), "test_journal")
+        replica_passwd = join(dirname(__name__), "test_replica_password")
+        replica_group = join(dirname(__name__), "test_replica_group")
+        for path in (journal_file, replica_passwd, replica_group, replica_passwd + ".seq"):
+            for name in (path, path + ".lock"):
+                self.addCleanup(lambda name: os.path.exists(name) and os.unlink(name), name)
+        CONF["JOURNAL_FILE"] = journal_file
+        self.addCleanup(CONF.__setitem__, "JOURNAL_FILE", None)
+        self.addCleanup(users_cache.write_listeners.clear)
+        self.addCleanup(groups_cache.write_listeners.clear)
+        store = get_store()
+
+        def fetch(since, snapshot):
+            query = {"since": since, "snapshot": 1} if snapshot else {"since": since}
+            r = self.client.get(
+                CONF["URL_PREFIX"] + "/journal", query_string=query, environ_base={"REMOTE_USER": "user1"}
+            )
+            self.assertEqual(r.status_code, 200)
+            return json.loads(r.data)
+
+        replica = Replica(replica_passwd, replica_group, replica_passwd + ".seq")
+        # Whole files at first
+        self.assertIsNone(replica.sync(fetch))
+        self.assertEqual(open(replica_passwd).read(), open(self.passwd).read())
+        with store.edit_users() as userdb:
+            with store.edit_groups() as groupdb:
+                userdb.add("user3", "Secret!1")
+                userdb.pop("user2")
+                groupdb.add_user("user3", "admin")
+                groupdb.delete_user("user2", "users")
+        self.assertEqual(replica.sync(fetch), 4)
+        self.assertEqual(replica.sync(fetch), 0)
+        self.assertEqual(open(replica_passwd).read(), open(self.passwd).read())
+        self.assertEqual(open(replica_group).read(), open(self.group).read())
+
+        # Master file edited by hand: drift is detected with next change, whole files are written again
+        with open(self.group, "a") as f:
+            f.write("others: user1\n")
+        groups_cache.invalidate()
+        with store.edit_groups() as groupdb:
+            groupdb.add_user("user3", "users")
+        self.assertIsNone(replica.sync(fetch))
+        self.assertEqual(open(replica_group).read(), open(self.group).read())
+
+        r = self.client.get(CONF["URL_PREFIX"] + "/journal", environ_base={"REMOTE_USER": "user2"})
+        self.assertEqual(r.status_code, 403)
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.passwd = join(dirname(__name__), "test_store_password")
+        self.group = join(dirname(__name__), "test_store_group")
+        with open(self.passwd, "w") as f:
+            f.write("user1:$apr1$salt$hash1\nuser2:$apr1$salt$hash2\n")
+        with open(self.group, "w") as f:
+            f.write("admin: user1\nusers: user1 \\\n user2\n")
+
+    def tearDown(self):
+        for path in (self.passwd, self.group, self.passwd + ".lock", self.group + ".lock"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_parse(self):
+        userdb = Users.from_file(self.passwd)
+        self.assertEqual(userdb.users, ["user1", "user2"])
+        self.assertIn("user2", userdb)
+        self.assertEqual(userdb.get_hash("user1"), "$apr1$salt$hash1")
+        groupdb = Groups.from_file(self.group)
+        self.assertEqual(groupdb.groups, ["admin", "users"])
+        self.assertTrue(groupdb.is_user_in("user2", "users"))
+        self.assertFalse(groupdb.is_user_in("user2", "admin"))
+        self.assertFalse(groupdb.is_user_in("user2", "unknown"))
+        self.assertEqual(groupdb.members("users"), ["user1", "user2"])
+        self.assertEqual(groupdb.groups_of("user1"), {"admin", "users"})
+        self.assertEqual(groupdb.groups_of("user3"), set())
+
+    def test_incremental_stats(self):
+        store = FileStore(self.passwd, self.group)
+        self.assertEqual(
+            store.stats(),
+            {
+                "number_of_users": 2,
+                "group_sizes": {"admin": 1, "users": 2},
+                "unassigned_users": [],
+                "schemes": {"apr1": 2},
+            },
+        )
+        stats = store._stats
+        with store.edit_users() as userdb:
+            with store.edit_groups() as groupdb:
+                userdb.add("user3", "Secret!1", "sha512")
+                userdb.add("user4", "Secret!1")
+                userdb.pop("user1")
+                groupdb.add_user("user3", "admin")
+                groupdb.delete_user("user2", "users")
+                groupdb.add_user("user5", "new")
+        figures = store.stats()
+        # Updated in place, not built again
+        self.assertIs(store._stats, stats)
+        self.assertEqual(figures, DirectoryStats(Users.from_file(self.passwd), Groups.from_file(self.group)).snapshot())
+        self.assertEqual(figures["number_of_users"], 3)
+        self.assertEqual(figures["group_sizes"], {"admin": 2, "users": 1, "new": 1})
+        self.assertEqual(figures["unassigned_users"], ["user2", "user4"])
+        self.assertEqual(figures["schemes"], {"apr1": 2, "sha512": 1})
+
+        # Changed by someone else
+        with open(self.group, "a") as f:
+            f.write("others: user2\n")
+        figures = store.stats()
+        self.assertIsNot(store._stats, stats)
+        self.assertEqual(figures["unassigned_users"], ["user4"])
+        self.assertEqual(figures["group_sizes"]["others"], 1)
+
+    def test_journal_compaction(self):
+        path = join(dirname(__name__), "test_store_journal")
+        for name in (path, path + ".lock"):
+            self.addCleanup(lambda name: os.path.exists(name) and os.unlink(name), name)
+        journal = Journal(path, max_entries=3)
+        self.assertEqual(journal.read(0), {"last": 0, "changes": []})
+        for i in range(5):
+            journal.append("users", [("pop", "user%s" % i)], ["content\n"])
+        self.assertEqual(
+            journal.read(3)["changes"],
+            [
+                {"seq": 4, "file": "users", "change": ["pop", "user3"], "checksum": checksum(["content\n"])},
+                {"seq": 5, "file": "users", "change": ["pop", "user4"], "checksum": checksum(["content\n"])},
+            ],
+        )
+        journal.append("groups", [("add_user", "user1", "admin"), ("delete_user", "user1", "users")], [])
+        # Compacted to last 3 changes: replicas late by more need whole files
+        self.assertEqual(len(open(path).readlines()), 3)
+        self.assertIsNone(journal.read(2))
+        self.assertEqual([entry["seq"] for entry in journal.read(4)["changes"]], [5, 6, 7])
+        self.assertIsNone(journal.read(8))
+        # Batch being appended by another process is not given
+        with open(path, "a") as f:
+            f.write('{"seq": 8, "file": "users", "change": ["pop", "user1"]}\n{"seq": 9, ')
+        self.assertEqual(journal.read(7), {"last": 7, "changes": []})
+        self.assertEqual(Journal(path).last_seq(), 8)
+
+    def test_dbm(self):
+        users_dbm = DbmFile(join(dirname(__name__), "test_store_dbm_users"), "users", "dumb")
+        groups_dbm = DbmFile(join(dirname(__name__), "test_store_dbm_groups"), "groups", "dumb")
+        for name in ("test_store_dbm_users", "test_store_dbm_groups"):
+            for suffix in (".dat", ".dir", ".bak"):
+                self.addCleanup(lambda path: os.path.exists(path) and os.unlink(path), name + suffix)
+        store = FileStore(self.passwd, self.group, users_dbm=users_dbm, groups_dbm=groups_dbm)
+        # Built at start
+        self.assertEqual(dbm_content(users_dbm.path), {"user1": "$apr1$salt$hash1", "user2": "$apr1$salt$hash2"})
+        self.assertEqual(dbm_content(groups_dbm.path), {"user1": "admin,users", "user2": "users"})
+
+        with unittest.mock.patch.object(DbmFile, "rebuild") as rebuild:
+            with store.edit_users() as userdb:
+                with store.edit_groups() as groupdb:
+                    userdb.add("user3", "Secret!1")
+                    userdb.pop("user1")
+                    groupdb.add_user("user3", "admin")
+                    groupdb.delete_user("user1", "admin")
+                    groupdb.delete_user("user1", "users")
+            # Only changed users are written
+            rebuild.assert_not_called()
+        users = dbm_content(users_dbm.path)
+        self.assertEqual(sorted(users), ["user2", "user3"])
+        self.assertTrue(verify_password(users["user3"], "Secret!1"))
+        self.assertEqual(dbm_content(groups_dbm.path), {"user2": "users", "user3": "admin"})
+        self.assertEqual([f for f in os.listdir(dirname(os.path.abspath(self.passwd))) if ".test_store_dbm" in f], [])
+
+        # Changed by someone else: written again from whole file
+        with open(self.group, "a") as f:
+            f.write("others: user2\n")
+        with store.edit_groups() as groupdb:
+            groupdb.add_user("user3", "users")
+        self.assertEqual(dbm_content(groups_dbm.path), {"user2": "others,users", "user3": "admin,users"})
+
+    def test_edit(self):
+        userdb = Users.from_file(self.passwd)
+        userdb.add("user3", "Secret!1")
+        self.assertRaises(UserExists, userdb.add, "user3", "Secret!1")
+        userdb.pop("user1")
+        self.assertTrue(verify_password(userdb.get_hash("user3"), "Secret!1"))
+        self.assertEqual(userdb.serialize()[0], "user2:$apr1$salt$hash2\n")
+
+        groupdb = Groups.from_file(self.group)
+        groupdb.delete_user("user1", "admin")
+        groupdb.add_user("user2", "admin")
+        self.assertEqual(groupdb.groups_of("user1"), {"users"})
+        self.assertEqual(groupdb.groups_of("user2"), {"admin", "users"})
+        groupdb.delete_user("user2", "admin")
+        # Empty groups are kept
+        self.assertEqual(groupdb.serialize(), ["admin: \n", "users: user1 user2\n"])
+
+    def test_cached_is_read_only(self):
+        cache = FileCache(Users.from_file)
+        self.assertRaises(ReadOnlyError, cache.get(self.passwd).pop, "user1")
+        with cache.edit(self.passwd) as userdb:
+            self.assertFalse(userdb.dirty)
+            userdb.pop("user1")
+            self.assertTrue(userdb.dirty)
+        self.assertRaises(ReadOnlyError, cache.get(self.passwd).set_hash, "user1", "hash")
+        groups_cache = FileCache(Groups.from_file)
+        self.assertRaises(ReadOnlyError, groups_cache.get(self.group).add_user, "user2", "admin")
+
+    def test_atomic_write(self):
+        os.chmod(self.passwd, 0o640)
+        version = atomic_write(self.passwd, ["user9:hash\n"])
+        self.assertEqual(open(self.passwd).read(), "user9:hash\n")
+        self.assertEqual(os.stat(self.passwd).st_mode & 0o777, 0o640)
+        self.assertEqual(version, file_version(self.passwd))
+        self.assertEqual([f for f in os.listdir(dirname(os.path.abspath(self.passwd))) if ".test_store" in f], [])
+
+    def test_cache_edit(self):
+        cache = FileCache(Groups.from_file)
+        groupdb = cache.get(self.group)
+        with cache.edit(self.group) as edited:
+            edited.add_user("user3", "admin")
+        self.assertFalse(groupdb.is_user_in("user3", "admin"))
+        self.assertTrue(cache.get(self.group).is_user_in("user3", "admin"))
+        self.assertTrue(Groups.from_file(self.group).is_user_in("user3", "admin"))
+
+    def test_replay_on_concurrent_change(self):
+        cache = FileCache(Users.from_file)
+        with cache.edit(self.passwd) as userdb:
+            userdb.pop("user1")
+            # Another process changes the file meanwhile
+            other = Users.from_file(self.passwd)
+            other.set_hash("user3", "$apr1$salt$hash3")
+            atomic_write(self.passwd, other.serialize())
+        self.assertEqual(Users.from_file(self.passwd).users, ["user2", "user3"])
+
+    def test_concurrent_writers(self):
+        workers, count = 8, 20
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=concurrent_writer, args=(self.passwd, self.group, worker, count))
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        # No lost update
+        self.assertEqual(len(Users.from_file(self.passwd)), 2 + workers * count)
+        self.assertEqual(len(Groups.from_file(self.group).members("users")), 2 + workers * count)
+
+    def test_concurrent_delete(self):
+        store = FileStore(self.passwd, self.group)
+        with store.edit_users() as userdb:
+            with store.edit_groups() as groupdb:
+                userdb.set_hash("user2", "$apr1$salt$hash3")
+                userdb.set_hash("user3", "$apr1$salt$hash3")
+                groupdb.add_user("user2", "admin")
+                groupdb.add_user("user3", "admin")
+                # Another process deletes user2 meanwhile
+                other_users = Users.from_file(self.passwd)
+                other_users.pop("user2")
+                atomic_write(self.passwd, other_users.serialize())
+                other_groups = Groups.from_file(self.group)
+                other_groups.delete_user("user2", "users")
+                atomic_write(self.group, other_groups.serialize())
+        # Deleted user is not brought back, created one is kept
+        self.assertEqual(Users.from_file(self.passwd).users, ["user1", "user3"])
+        self.assertEqual(Groups.from_file(self.group).members("admin"), ["user1", "user3"])
+        self.assertEqual(Groups.from_file(self.group).groups_of("user2"), set())
+
+    def test_concurrent_group_removal(self):
+        with open(self.passwd, "w") as f:
+            f.write("x:$apr1$salt$hash1\ny:$apr1$salt$hash2\n")
+        with open(self.group, "w") as f:
+            f.write("g1: x y\ng2: y\n")
+        store = FileStore(self.passwd, self.group)
+        with store.edit_groups() as groupdb:
+            groupdb.add_user("x", "g2")
+            # Another process removes x from its only other group meanwhile: x still exists
+            other = Groups.from_file(self.group)
+            other.delete_user("x", "g1")
+            atomic_write(self.group, other.serialize())
+        groupdb = Groups.from_file(self.group)
+        self.assertEqual(groupdb.members("g1"), ["y"])
+        self.assertEqual(groupdb.members("g2"), ["y", "x"])
+
+    def test_batch_plan(self):
+        userdb = Users.from_file(self.passwd)
+        groupdb = Groups.from_file(self.group)
+        plan = BatchPlan(userdb, groupdb, ["user3", "user1", "", "user3"], ["admin", "unknown"])
+        self.assertEqual(plan.logins, ["user3", "user1"])
+        self.assertEqual(plan.creates, ["user3"])
+        self.assertEqual(plan.updates, ["user1"])
+        self.assertEqual(plan.group_additions, [("user3", "admin")])
+        self.assertEqual(plan.group_removals, [("user1", "users")])
+        passwords = {"user3": "Secret!3", "user1": "Secret!1"}
+        hashes = dict((login, hash_password(password, "sha512")) for login, password in passwords.items())
+        result = plan.apply(userdb, groupdb, passwords, hashes)
+        self.assertEqual(result, [("user3", "Secret!3", "create"), ("user1", "Secret!1", "update")])
+        self.assertEqual(userdb.get_hash("user1"), hashes["user1"])
+        self.assertTrue(verify_password(userdb.get_hash("user1"), "Secret!1"))
+        self.assertEqual(groupdb.members("admin"), ["user1", "user3"])
+        self.assertEqual(groupdb.members("users"), ["user2"])
+
+    def test_search(self):
+        userdb = Users.from_file(self.passwd)
+        userdb.add("alice", "alice")
+        userdb.add("user10", "user10")
+        self.assertEqual(userdb.sorted_users(), ["alice", "user1", "user10", "user2"])
+        self.assertEqual(userdb.search("user1"), ["user1", "user10"])
+        self.assertEqual(userdb.search("bob"), [])
+        self.assertEqual(userdb.search("ser1", contains=True), ["user1", "user10"])
+        userdb.pop("user10")
+        self.assertEqual(userdb.search("user1"), ["user1"])
+
+    def test_delayed_writes(self):
+        cache = FileCache(Users.from_file)
+        version = file_version(self.passwd)
+        for i in range(3):
+            with cache.edit(self.passwd, delay=60) as userdb:
+                userdb.set_hash("user%s" % (i + 3), "hash")
+        self.assertEqual(cache.pending(self.passwd), 3)
+        self.assertEqual(len(cache.get(self.passwd)), 5)
+        self.assertEqual(file_version(self.passwd), version)
+
+        # Another process changes the file meanwhile: pending changes are kept on top of its content
+        with FileCache(Users.from_file).edit(self.passwd) as userdb:
+            userdb.pop("user1")
+        self.assertEqual(cache.get(self.passwd).users, ["user2", "user3", "user4", "user5"])
+
+        cache.flush()
+        self.assertEqual(cache.pending(self.passwd), 0)
+        self.assertEqual(Users.from_file(self.passwd).users, ["user2", "user3", "user4", "user5"])
+
+        # Written once enough changes are waiting, or once delay is over
+        with cache.edit(self.passwd, delay=60, max_pending=1) as userdb:
+            userdb.pop("user2")
+        self.assertNotIn("user2", Users.from_file(self.passwd))
+        with cache.edit(self.passwd, delay=0.01) as userdb:
+            userdb.pop("user3")
+        for i in range(100):
+            if not cache.pending(self.passwd):
+                break
+            time.sleep(0.01)
+        self.assertNotIn("user3", Users.from_file(self.passwd))
+
+    def test_cache_reused_until_file_changes(self):
+        cache = FileCache(Users.from_file)
+        userdb = cache.get(self.passwd)
+        self.assertIs(cache.get(self.passwd), userdb)
+
+        # Another writer replaces the file
+        tmp = self.passwd + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("user3:$apr1$salt$hash3\n")
+        os.replace(tmp, self.passwd)
+        self.assertEqual(cache.get(self.passwd).users, ["user3"])
+
+        # Same size, only mtime changed
+        stat = os.stat(self.passwd)
+        with open(self.passwd, "w") as f:
+            f.write("user4:$apr1$salt$hash4\n")
+        os.utime(self.passwd, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(cache.get(self.passwd).users, ["user4"])
+
+        userdb = cache.get(self.passwd)
+        cache.invalidate(self.passwd)
+        self.assertIsNot(cache.get(self.passwd), userdb)
+
+
+class PasswordTestCase(unittest.TestCase):
+    def test_apr1(self):
+        # Reference hash from openssl passwd -apr1 -salt abcdefgh 'Secret!1'
+        reference = "$apr1$abcdefgh$73jnu/FWmD6Ts0NEmfyBN1"
+        self.assertEqual(md5_crypt("Secret!1", "abcdefgh"), reference)
+        self.assertTrue(verify_password(reference, "Secret!1"))
+        self.assertTrue(verify_password(reference + "\n", "Secret!1"))
+        self.assertFalse(verify_password(reference, "Secret!2"))
+
+    def test_sha_crypt(self):
+        # Reference vectors from Ulrich Drepper's SHA-crypt specification
+        self.assertEqual(
+            sha_crypt("Hello world!", "saltstring", magic="$5$"),
+            "$5$saltstring$5B8vYYiY.CVt1RlTTf8KbXBH3hsxY/GNooZaBBGWEc5",
+        )
+        self.assertEqual(
+            sha_crypt("Hello world!", "saltstringsaltstring", 10000, "$6$"),
+            "$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHbbMCVNSnCM/UrjmM0Dp8vOuZeHBy/YTBmSK6H9"
+            "qs/y3RnOaw5v.",
+        )
+        self.assertTrue(verify_password("$5$saltstring$5B8vYYiY.CVt1RlTTf8KbXBH3hsxY/GNooZaBBGWEc5", "Hello world!"))
+        self.assertFalse(verify_password("$5$saltstring$5B8vYYiY.CVt1RlTTf8KbXBH3hsxY/GNooZaBBGWEc5", "Hello"))
+
+    def test_sha1(self):
+        self.assertTrue(verify_password("{SHA}qUqP5cyxm6YcTAhz05Hph5gvu9M=", "test"))
+        self.assertFalse(verify_password("{SHA}qUqP5cyxm6YcTAhz05Hph5gvu9M=", "Test"))
+
+    def test_generate_and_hash(self):
+        with unittest.mock.patch("pydentity_passwd.HASH_CHUNK_SIZE", 2):
+            with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("forkserver")) as executor:
+                generated = generate_and_hash(5, 12, "!?", executor)
+        self.assertEqual(len(generated), 5)
+        self.assertEqual(len(set(password for password, password_hash in generated)), 5)
+        for password, password_hash in generated:
+            self.assertEqual(len(password), 12)
+            self.assertRegex(password, "[!?]")
+            self.assertTrue(verify_password(password_hash, password))
+
+    def test_hash_schemes(self):
+        for scheme, cost, prefix in (
+            ("apr1", None, "$apr1$"),
+            ("sha256", None, "$5$"),
+            ("sha512", 2000, "$6$rounds=2000$"),
+            ("bcrypt", 4, "$2y$04$"),
+        ):
+            if scheme == "bcrypt" and bcrypt is None:
+                continue
+            password_hash = hash_password("Secret!1", scheme, cost)
+            self.assertTrue(password_hash.startswith(prefix))
+            self.assertEqual(identify(password_hash), scheme)
+            self.assertTrue(verify_password(password_hash, "Secret!1"))
+            self.assertFalse(verify_password(password_hash, "Secret!2"))
+        with self.assertRaises(UnsupportedHashError):
+            hash_password("Secret!1", "md5")
+
+    @unittest.skipIf(bcrypt is None, "bcrypt is not installed")
+    def test_bcrypt(self):
+        password_hash = bcrypt.hashpw(b"Secret!1", bcrypt.gensalt(4)).decode().replace("$2b$", "$2y$")
+        self.assertTrue(verify_password(password_hash, "Secret!1"))
+        self.assertFalse(verify_password(password_hash, "Secret!2"))
+
+    def test_unknown_scheme(self):
+        self.assertFalse(verify_password("plain_text_password", "plain_text_password"))
+        self.assertFalse(check_password("$apr1$abcdefgh$73jnu/FWmD6Ts0NEmfyBN1", "wrong"))
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = Counter("test_total", "Test counter", ("name",), registry=registry)
+        histogram = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1), registry=registry)
+        counter.inc(2, 'a"b')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(
+            registry.render().splitlines(),
+            [
+                "# HELP test_total Test counter",
+                "# TYPE test_total counter",
+                'test_total{name="a\\"b"} 2',
+                "# HELP test_seconds Test histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{le="0.1"} 1',
+                'test_seconds_bucket{le="1"} 2',
+                'test_seconds_bucket{le="+Inf"} 3',
+                "test_seconds_sum 5.55",
+                "test_seconds_count 3",
+            ],
+        )
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_run_and_compare(self):
+        page_cache.clear()
+        results = {"sizes": {"small": pydentity_bench.run(50, 3, requests=2, warmup=1)}}
+        # Pages are rendered each time, not served from cache
+        self.assertEqual(len(page_cache), 0)
+        self.assertEqual(
+            set(results["sizes"]["small"]), set(name for name, m, u, a in pydentity_bench.scenarios(["u"], ["g"]))
+        )
+        self.assertEqual(pydentity_bench.compare(results, results, 1.0), [])
+        slower = json.loads(json.dumps(results))
+        slower["sizes"]["small"]["stats"]["p50"] *= 2
+        self.assertEqual([r[:3] for r in pydentity_bench.compare(slower, results, 1.5)], [("small", "stats", "p50")])
+
+    def test_tune_cost(self):
+        cost, elapsed = pydentity_bench.tune_cost("sha256", 0.01, samples=1)
+        self.assertEqual(cost, 1000)
+        with self.assertRaises(ValueError):
+            pydentity_bench.tune_cost("apr1", 10)
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to let smtplib send mails"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost ESMTP")
+        in_data = False
+        for line in self.rfile:
+            line = line.decode().rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    in_data = False
+                    self.reply("250 OK")
+                continue
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif command == "RCPT":
+                recipient = line.split(":", 1)[1].strip(" <>")
+                if recipient in self.server.rejected:
+                    self.reply("550 No such user")
+                else:
+                    self.server.recipients.append(recipient)
+                    self.reply("250 OK")
+            elif command == "DATA":
+                in_data = True
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("250 OK")
+
+
+class MailTestCase(unittest.TestCase):
+    def setUp(self):
+        BasicTestCase.setUp(self)
+        self.spool = join(dirname(__name__), "test_mail_spool.sqlite")
+        self.saved_conf = CONF.copy()
+        CONF["MAIL_SPOOL"] = self.spool
+        CONF["ENABLE_MAIL_CAPABILITIES"] = True
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStandInHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.recipients = []
+        self.server.rejected = ["user3@test.com"]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.saved_config = app.config.copy()
+        app.config.update(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=self.server.server_address[1],
+            MAIL_USE_TLS=False,
+            MAIL_USE_SSL=False,
+            MAIL_USERNAME=None,
+            MAIL_DEFAULT_SENDER="pydentity@test.com",
+            MAIL_MAX_EMAILS=2,
+            MAIL_SUPPRESS_SEND=False,
+        )
+        get_mail().init_app(app)
+
+    def tearDown(self):
+        if self.spool in mail_queues:
+            mail_queues.pop(self.spool).stop()
+        if os.path.exists(self.spool):
+            os.unlink(self.spool)
+        CONF.update(self.saved_conf)
+        self.server.shutdown()
+        self.server.server_close()
+        app.config.clear()
+        app.config.update(self.saved_config)
+        get_mail().init_app(app)
+        BasicTestCase.tearDown(self)
+
+    def test_single_connection_per_batch(self):
+        self.assertIs(get_mail(), get_mail())
+        result = [("user%s" % i, "password", "create") for i in range(1, 6)]
+        with app.test_request_context():
+            failures = send_mail(result, "@test.com", "myclient")
+        self.assertEqual([username for username, error in failures], ["user3"])
+        self.assertEqual(
+            self.server.recipients, ["user1@test.com", "user2@test.com", "user4@test.com", "user5@test.com"]
+        )
+        # One connection, renewed every MAIL_MAX_EMAILS successfully sent mails
+        self.assertEqual(self.server.connections, 3)
+
+    def test_batch_mails_sent_in_background(self):
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/batch_user_creation",
+            data={
+                "users_login": "user5\r\nuser3\r\nuser4",
+                "send_mail": "on",
+                "mail_suffix": "@test.com",
+                "instance": "myclient",
+            },
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        self.assertEqual(r.status_code, 200)
+        data = r.data.decode()
+        self.assertIn("mails are being sent", data)
+        batch_id = int(re.search(r"/mail_batch/(\d+)", data).group(1))
+        queue = get_mail_queue()
+        self.assertTrue(queue.wait(batch_id))
+
+        r = self.client.get(CONF["URL_PREFIX"] + "/mail_batch/%s" % batch_id, environ_base={"REMOTE_USER": "user1"})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("user3@test.com", r.data.decode())
+        status = queue.status(batch_id)
+        self.assertEqual((status["sent"], status["failed"], status["pending"]), (2, 1, 0))
+        self.assertEqual(sorted(self.server.recipients), ["user4@test.com", "user5@test.com"])
+
+        self.server.rejected = []
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/mail_batch/%s" % batch_id, data={"retry": ""}, environ_base={"REMOTE_USER": "user1"}
+        )
+        self.assertIn("1 mail(s) queued again", r.data.decode())
+        self.assertTrue(queue.wait(batch_id))
+        status = queue.status(batch_id)
+        self.assertEqual((status["sent"], status["failed"]), (3, 0))
+
+        r = self.client.get(CONF["URL_PREFIX"] + "/mail_batch/%s" % batch_id, environ_base={"REMOTE_USER": "user2"})
+        self.assertIn("Forbidden: only admin user allowed", r.data.decode())
+
+        # No mail spool nor queue threads without mail capabilities
+        CONF["ENABLE_MAIL_CAPABILITIES"] = False
+        with unittest.mock.patch("pydentity.get_mail_queue") as get_queue:
+            r = self.client.get(CONF["URL_PREFIX"] + "/mail_batch/1", environ_base={"REMOTE_USER": "user1"})
+            get_queue.assert_not_called()
+        self.assertIn("Mail capabilities are disabled", r.data.decode())
+
+    def test_import_sends_password_to_given_address(self):
+        r = self.client.post(
+            CONF["URL_PREFIX"] + "/import_users",
+            data={
+                "file": (io.BytesIO(b"user5,five@test.org,users,\nuser2,two@test.org,,\n"), "users.csv"),
+                "send_mail": "on",
+                "instance": "myclient",
+            },
+            environ_base={"REMOTE_USER": "user1"},
+        )
+        progress = json.loads(r.data.decode())
+        self.assertEqual(len(progress["mail_batches"]), 1)
+        self.assertTrue(get_mail_queue().wait(progress["mail_batches"][0]))
+        # Only new users get a password, mailed instead of given back
+        self.assertEqual(self.server.recipients, ["five@test.org"])
+        self.assertEqual(progress["passwords"], [])
+
+    def test_server_unavailable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        result = [("user%s" % i, "password", "create") for i in range(1, 4)]
+        with app.test_request_context():
+            failures = send_mail(result, "@test.com", "myclient")
+        self.assertEqual([username for username, error in failures], ["user1", "user2", "user3"])
+
+
 if __name__ == "__main__":
     unittest.main()